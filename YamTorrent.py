@@ -10,27 +10,37 @@ from twisted.internet import reactor
 from twisted.internet.defer import Deferred
 from twisted.web.client import getPage
 
-from yamtorrent import PeerInfo, TorrentMetadata, PeerConnection, TrackerConnection, TorrentManager
+from yamtorrent import PeerInfo, TorrentMetadata, PeerConnection, TrackerConnection, TorrentManager, Settings, Session
 
 import logging
 
 def main():
     port = b'6881'
     peer_id = b'-YT0001-' + os.urandom(12)
-    meta_info = None
     logger = logging.getLogger('YamTorrent')
-    try:
-        if len(sys.argv) <= 1:
-            logger.error('NO TORRENT FILE NAME GIVEN')
-            filename = None
-        else:
-            filename = sys.argv[1]
-        meta_info = TorrentMetadata(filename, peer_id)
-    except FileNotFoundError:
-        logger.error('INVALID FILE NAME: ' + filename)
-        sys.exit(0)
-    torrent = TorrentManager(meta_info, port, peer_id)
-    torrent.start()
+    settings = Settings.from_argv(sys.argv[1:])
+    session = Session(port, peer_id, settings=settings)
+
+    # every argument that isn't an option is a torrent file or magnet link
+    filenames = [a for a in sys.argv[1:] if not a.startswith('--')]
+    if len(filenames) == 0:
+        logger.error('NO TORRENT FILE NAME GIVEN')
+        filenames = [None]
+    for filename in filenames:
+        if filename and filename.startswith('magnet:'):
+            try:
+                d = session.add_magnet(filename)
+            except ValueError as e:
+                logger.error('INVALID MAGNET LINK: ' + str(e))
+                sys.exit(0)
+            d.addErrback(lambda failure: logger.error('magnet link: %s', failure.getErrorMessage()))
+            continue
+        try:
+            session.add_torrent(TorrentMetadata(filename, peer_id))
+        except FileNotFoundError:
+            logger.error('INVALID FILE NAME: ' + str(filename))
+            sys.exit(0)
+    session.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+from twisted.trial import unittest
+from twisted.internet import reactor, task
+from twisted.internet.defer import DeferredList, inlineCallbacks
+
+from yamtorrent.settings import Settings
+from yamtorrent.dht import DHT, Node, KRPCError, K
+
+SWARM_SIZE = 16
+INFO_HASH = b'\x5a' * 20
+
+
+# fires once condition() is true, checking every 10 ms. fails the test if
+# that takes longer than timeout seconds
+@inlineCallbacks
+def wait_for(condition, timeout=5.0):
+    waited = 0.0
+    while not condition():
+        if waited > timeout:
+            raise AssertionError('condition not met in {} seconds'.format(timeout))
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        waited += 0.01
+
+
+# a swarm of DHT nodes on the loopback interface. the first node knows
+# nobody, the others bootstrap from it
+class DHTSwarmTest(unittest.TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        settings = Settings()
+        settings.dht_query_timeout = 1.0
+        self.nodes = []
+        for i in range(SWARM_SIZE):
+            bootstrap = [('127.0.0.1', self.nodes[0].listening_port())] if self.nodes else []
+            dht = DHT(reactor, settings, bootstrap=bootstrap)
+            self.assertTrue(dht.start(interface='127.0.0.1'))
+            self.nodes.append(dht)
+            yield wait_for(lambda: not dht._bootstrapping)
+
+        # the first nodes bootstrapped while the swarm was small, look
+        # around again now that everybody is here
+        for dht in self.nodes:
+            dht.bootstrap()
+        yield wait_for(lambda: not any(dht._bootstrapping for dht in self.nodes))
+
+    def tearDown(self):
+        return DeferredList([d for d in (dht.stop() for dht in self.nodes) if d is not None])
+
+    def holders(self, info_hash):
+        return [dht for dht in self.nodes if info_hash in dht._peers]
+
+    def test_bootstrap(self):
+        for dht in self.nodes:
+            self.assertGreaterEqual(len(dht.table), K)
+
+    @inlineCallbacks
+    def test_announce_and_get_peers(self):
+        announcer, searcher = self.nodes[3], self.nodes[12]
+        yield announcer.get_peers(INFO_HASH, port=6881)
+        yield wait_for(lambda: self.holders(INFO_HASH))
+        for dht in self.holders(INFO_HASH):
+            self.assertEqual(list(dht._peers[INFO_HASH]), [('127.0.0.1', 6881)])
+
+        found = []
+        peers = yield searcher.get_peers(INFO_HASH, on_peers=found.extend)
+        self.assertEqual([(p.ip, p.port) for p in peers], [('127.0.0.1', 6881)])
+        self.assertEqual([(p.ip, p.port) for p in found], [('127.0.0.1', 6881)])
+
+    @inlineCallbacks
+    def test_several_peers(self):
+        for i, dht in enumerate(self.nodes[:4]):
+            yield dht.get_peers(INFO_HASH, port=7000 + i)
+        yield wait_for(lambda: any(len(dht._peers.get(INFO_HASH, ())) == 4 for dht in self.nodes))
+
+        peers = yield self.nodes[-1].get_peers(INFO_HASH)
+        self.assertEqual(sorted(p.port for p in peers), [7000, 7001, 7002, 7003])
+
+    @inlineCallbacks
+    def test_get_peers_unknown_torrent(self):
+        peers = yield self.nodes[5].get_peers(b'\x01' * 20)
+        self.assertEqual(peers, [])
+
+    @inlineCallbacks
+    def test_announce_needs_token(self):
+        target = self.nodes[1]
+        node = Node(target.node_id, '127.0.0.1', target.listening_port())
+        args = {b'info_hash': INFO_HASH, b'port': 6881, b'token': b'bad token'}
+        yield self.assertFailure(self.nodes[2].query(node, b'announce_peer', args), KRPCError)
+        self.assertEqual(self.holders(INFO_HASH), [])
@@ -0,0 +1,41 @@
+from bitstring import BitArray
+from twisted.trial import unittest
+
+from yamtorrent.piecepicker import PriorityPicker
+from yamtorrent.blockscheduler import BlockScheduler
+
+
+class FakeMeta(object):
+
+    def num_pieces(self):
+        return 4
+
+    def piece_length(self):
+        return 2 * 16384
+
+    def full_length(self):
+        return 4 * 2 * 16384
+
+
+class PriorityPickerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.picker = PriorityPicker(4)
+        for piece_id in range(4):
+            self.picker.want(piece_id)
+        self.everything = BitArray(4)
+        self.everything.invert()
+        self.picker.add_peer(self.everything)
+
+    def test_skipped_pieces_are_not_counted(self):
+        self.picker.set_priority(3, 0)
+        self.assertEqual(self.picker.num_wanted(), 3)
+        self.picker.set_priority(3, 1)
+        self.assertEqual(self.picker.num_wanted(), 4)
+
+    def test_endgame_with_skipped_pieces(self):
+        self.picker.set_priority(3, 0)
+        scheduler = BlockScheduler(FakeMeta(), self.picker)
+        blocks = scheduler.request_blocks('peer 1', 6, self.everything)
+        self.assertEqual(len(blocks), 6)
+        self.assertTrue(scheduler.in_endgame())
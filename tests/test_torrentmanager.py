@@ -0,0 +1,82 @@
+import os
+import struct
+import hashlib
+import tempfile
+
+import bencodepy
+from bitstring import BitArray
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from yamtorrent import PeerInfo, Settings, TorrentMetadata, PeerConnection, TorrentManager
+
+PIECE_LENGTH = 4 * PeerConnection.BLOCK_SIZE
+NUM_PIECES = 8
+REQUEST = 6
+
+
+# stands in for the peer's connection, keeping the messages sent to it
+class FakeProtocol(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def tx_data(self, data):
+        self.sent.append(bytes(data))
+
+    def stop(self):
+        pass
+
+    # the (piece, offset) of the requests sent since the last call
+    def take_requests(self):
+        requests = [struct.unpack('!II', m[5:13]) for m in self.sent
+                    if len(m) == 17 and m[4] == REQUEST]
+        self.sent = []
+        return requests
+
+
+class ExpireRequestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        data = os.urandom(PIECE_LENGTH * NUM_PIECES)
+        pieces = b''.join(hashlib.sha1(data[i:i + PIECE_LENGTH]).digest()
+                          for i in range(0, len(data), PIECE_LENGTH))
+        info = {b'name': b'test.bin', b'length': len(data),
+                b'piece length': PIECE_LENGTH, b'pieces': pieces}
+        path = os.path.join(self.dir, 'test.torrent')
+        with open(path, 'wb') as f:
+            f.write(bencodepy.encode({b'announce': b'http://127.0.0.1/announce', b'info': info}))
+
+        self.clock = Clock()
+        self.settings = Settings()
+        self.settings.download_dir = self.dir
+        self.settings.dht = False
+        self.settings.min_request_timeout = 1.0
+        self.settings.max_request_timeout = 2.0
+        self.meta = TorrentMetadata(path, b'-YT0001-123456789012')
+        self.tm = TorrentManager(self.meta, 6881, self.meta.peer_id, reactor=self.clock,
+                                 settings=self.settings)
+
+    def connect(self, ip):
+        protocol = FakeProtocol()
+        peer = PeerConnection(self.meta, PeerInfo(ip, 6881), protocol=protocol,
+                              settings=self.settings, delegate=self.tm)
+        peer._reactor = self.clock
+        peer._bitfield = BitArray(NUM_PIECES)
+        peer._bitfield.invert()
+        self.tm.peer_did_connect(peer)
+        peer.rcv_unchoke(b'\x01', 1)
+        return peer, protocol
+
+    def test_stalled_peer_is_asked_again(self):
+        peer, protocol = self.connect('10.0.0.1')
+        requested = protocol.take_requests()
+        self.assertTrue(requested)
+
+        # nothing comes back: every request expires
+        self.clock.advance(3)
+        self.tm.expire_requests()
+        self.assertTrue(peer.snubbed)
+        self.assertEqual(len(peer.outstanding), 1)
+        self.assertEqual(len(protocol.take_requests()), 1)
@@ -0,0 +1,155 @@
+import struct
+import socket
+
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+
+from yamtorrent.settings import Settings
+from yamtorrent.udptracker import (UDPTrackerClient, UDPTrackerError, PROTOCOL_ID,
+                                   CONNECT, ANNOUNCE, SCRAPE, ERROR)
+
+INFO_HASH = b'\x11' * 20
+PEER_ID = b'-YT0001-123456789012'
+CONNECTION_ID = 0x1234567890abcdef
+
+
+# a UDP tracker on the loopback interface. it answers connect, announce and
+# scrape requests, dropping the first `drop` packets it gets so that the
+# client has to send them again, and keeps every packet it received
+class FakeTracker(DatagramProtocol):
+
+    def __init__(self, drop=0, error=None):
+        self.drop = drop
+        self.error = error
+        self.received = []
+        self.peers = [('10.0.0.1', 6881), ('10.0.0.2', 51413)]
+        self.scrapes = {INFO_HASH: (5, 12, 3)}
+
+    def datagramReceived(self, data, address):
+        self.received.append(data)
+        if self.drop > 0:
+            self.drop -= 1
+            return
+        connection_id, action, transaction_id = struct.unpack_from('!QII', data)
+        if self.error is not None and action != CONNECT:
+            self.reply(address, ERROR, transaction_id, self.error)
+        elif action == CONNECT:
+            if connection_id == PROTOCOL_ID:
+                self.reply(address, CONNECT, transaction_id, struct.pack('!Q', CONNECTION_ID))
+        elif connection_id != CONNECTION_ID:
+            self.reply(address, ERROR, transaction_id, b'bad connection id')
+        elif action == ANNOUNCE:
+            peers = b''.join(socket.inet_aton(ip) + struct.pack('!H', port) for ip, port in self.peers)
+            self.reply(address, ANNOUNCE, transaction_id, struct.pack('!III', 1800, 2, 7) + peers)
+        elif action == SCRAPE:
+            info_hashes = [data[i:i + 20] for i in range(16, len(data), 20)]
+            counts = [self.scrapes.get(info_hash, (0, 0, 0)) for info_hash in info_hashes]
+            self.reply(address, SCRAPE, transaction_id,
+                       b''.join(struct.pack('!III', *c) for c in counts))
+
+    def reply(self, address, action, transaction_id, payload):
+        self.transport.write(struct.pack('!II', action, transaction_id) + payload, address)
+
+    # the packets received with the given action
+    def packets(self, action):
+        return [p for p in self.received if struct.unpack_from('!I', p, 8)[0] == action]
+
+
+class UDPTrackerClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = Settings()
+        self.settings.udp_tracker_timeout = 0.05
+        self.settings.udp_tracker_retries = 3
+        self.client = UDPTrackerClient(reactor, self.settings)
+        self.client.start(interface='127.0.0.1')
+        self.tracker = FakeTracker()
+        self.port = reactor.listenUDP(0, self.tracker, interface='127.0.0.1')
+        self.address = ('127.0.0.1', self.port.getHost().port)
+
+    def tearDown(self):
+        self.client.stop()
+        return self.port.stopListening()
+
+    def announce(self, **params):
+        announce = {'info_hash': INFO_HASH, 'peer_id': PEER_ID, 'port': 6881,
+                    'uploaded': 10, 'downloaded': 20, 'left': 30, 'event': b'started'}
+        announce.update(params)
+        return self.client.announce(self.address, announce)
+
+    def test_announce(self):
+        def check(result):
+            self.assertEqual([(p.ip, p.port) for p in result['peers']], self.tracker.peers)
+            self.assertEqual(result['interval'], 1800)
+            self.assertEqual(result['complete'], 7)
+            self.assertEqual(result['incomplete'], 2)
+
+            packet, = self.tracker.packets(ANNOUNCE)
+            fields = struct.unpack('!QII20s20sQQQIIIiH', packet)
+            self.assertEqual(fields[0], CONNECTION_ID)
+            self.assertEqual(fields[3:9], (INFO_HASH, PEER_ID, 20, 30, 10, 2))
+            self.assertEqual(fields[11:], (-1, 6881))
+        return self.announce().addCallback(check)
+
+    def test_connection_id_reused(self):
+        d = self.announce()
+        d.addCallback(lambda result: self.announce(event=b''))
+        d.addCallback(lambda result: self.assertEqual(len(self.tracker.packets(CONNECT)), 1))
+        return d
+
+    def test_concurrent_requests_share_connect(self):
+        d1 = self.announce()
+        d2 = self.client.scrape(self.address, [INFO_HASH])
+        d = d1.addCallback(lambda result: d2)
+        d.addCallback(lambda result: self.assertEqual(len(self.tracker.packets(CONNECT)), 1))
+        return d
+
+    def test_scrape(self):
+        other = b'\x22' * 20
+
+        def check(result):
+            self.assertEqual(result, {INFO_HASH: (5, 12, 3), other: (0, 0, 0)})
+        return self.client.scrape(self.address, [INFO_HASH, other]).addCallback(check)
+
+    def test_retransmit(self):
+        # the connect request and its first retransmission are lost
+        self.tracker.drop = 2
+
+        def check(result):
+            self.assertEqual(len(result['peers']), 2)
+            connects = self.tracker.packets(CONNECT)
+            self.assertEqual(len(connects), 3)
+            # the same transaction is sent again
+            self.assertEqual(len(set(connects)), 1)
+        return self.announce().addCallback(check)
+
+    def test_timeout(self):
+        self.tracker.drop = 100
+
+        def check(failure):
+            failure.trap(UDPTrackerError)
+            self.assertIn('timed out', failure.getErrorMessage())
+            # the first attempt and `retries` retransmissions
+            self.assertEqual(len(self.tracker.received), 2)
+        d = self.client.announce(self.address, {'info_hash': INFO_HASH, 'peer_id': PEER_ID,
+                                                'port': 6881, 'uploaded': 0, 'downloaded': 0,
+                                                'left': 0}, retries=1)
+        d.addCallbacks(lambda result: self.fail('announce succeeded'), check)
+        return d
+
+    def test_error_response(self):
+        self.tracker.error = b'torrent not registered'
+
+        def check(failure):
+            failure.trap(UDPTrackerError)
+            self.assertIn('torrent not registered', failure.getErrorMessage())
+        d = self.announce()
+        d.addCallbacks(lambda result: self.fail('announce succeeded'), check)
+        return d
+
+    def test_stop_fails_pending_requests(self):
+        self.tracker.drop = 100
+        d = self.announce()
+        self.client.stop()
+        return self.assertFailure(d, UDPTrackerError)
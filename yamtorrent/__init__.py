@@ -1,5 +1,8 @@
+from .settings import Settings
 from .peerinfo import PeerInfo
+from .piecepicker import PiecePicker, RarestFirstPicker, SequentialPicker, PriorityPicker
 from .peerconnection import PeerConnection
 from .torrentmetadata import TorrentMetadata
 from .trackerconnection import TrackerConnection
-from .torrentmanager import TorrentManager
\ No newline at end of file
+from .torrentmanager import TorrentManager
+from .session import Session
\ No newline at end of file
@@ -0,0 +1,129 @@
+import re
+
+# a bencode decoder working on the raw bytes of a document, so that parts of
+# it can be located without decoding them: a value's span can be hashed in
+# place (the info hash is the SHA1 of the info dict exactly as encoded, which
+# re-encoding the decoded dict only reproduces if it was canonical), a long
+# string sliced without copying, and a large list decoded only when needed.
+#
+# positions are offsets into data, which must be bytes. spans are
+# (start, end) with end exclusive.
+
+# the tokens skip() steps over: the start of a list or dict, an end, an
+# integer, and the length prefix of a string
+_TOKEN = re.compile(rb'([ld])|(e)|(i-?[0-9]+e)|([0-9]+):')
+_OPEN, _END, _INT, _STRING = 1, 2, 3, 4
+
+
+class BencodeError(ValueError):
+    pass
+
+
+def _checked(f):
+    def wrapper(data, *args):
+        try:
+            return f(data, *args)
+        except BencodeError:
+            raise
+        except (IndexError, ValueError):
+            raise BencodeError('Invalid bencoded data')
+    wrapper.__name__ = f.__name__
+    wrapper.__doc__ = f.__doc__
+    return wrapper
+
+
+# decode a whole document
+def decode(data):
+    value, end = decode_at(data, 0)
+    if end != len(data):
+        raise BencodeError('Trailing data after bencoded value')
+    return value
+
+
+# decode the value at pos. returns (value, position after it)
+@_checked
+def decode_at(data, pos=0):
+    return _decode(data, pos)
+
+
+def _decode(data, pos):
+    c = data[pos]
+    if c == 0x69:   # i
+        end = data.index(b'e', pos)
+        return int(data[pos + 1:end]), end + 1
+    if 0x30 <= c <= 0x39:
+        start, end = _string(data, pos)
+        return data[start:end], end
+    if c == 0x6c:   # l
+        pos += 1
+        result = []
+        while data[pos] != 0x65:
+            value, pos = _decode(data, pos)
+            result.append(value)
+        return result, pos + 1
+    if c == 0x64:   # d
+        pos += 1
+        result = {}
+        while data[pos] != 0x65:
+            start, end = _string(data, pos)
+            value, pos = _decode(data, end)
+            result[data[start:end]] = value
+        return result, pos + 1
+    raise BencodeError('Invalid bencode type at {}'.format(pos))
+
+
+# the span of the contents of the string at pos
+@_checked
+def string_span(data, pos):
+    return _string(data, pos)
+
+
+def _string(data, pos):
+    colon = data.index(b':', pos)
+    length = int(data[pos:colon])
+    start = colon + 1
+    if length < 0 or start + length > len(data):
+        raise BencodeError('String at {} runs past the end of data'.format(pos))
+    return start, start + length
+
+
+# the position after the value at pos, found without decoding it. scanning
+# goes token by token with a regular expression, so that skipping a list of
+# a hundred thousand files doesn't build any objects
+@_checked
+def skip(data, pos=0):
+    depth = 0
+    match = _TOKEN.match
+    while True:
+        token = match(data, pos)
+        if token is None:
+            raise BencodeError('Invalid bencode type at {}'.format(pos))
+        pos = token.end()
+        kind = token.lastindex
+        if kind == _OPEN:
+            depth += 1
+        elif kind == _END:
+            depth -= 1
+            if depth < 0:
+                raise BencodeError('Unexpected end at {}'.format(pos - 1))
+        elif kind == _STRING:
+            pos += int(token.group(_STRING))
+        if depth == 0:
+            if pos > len(data):
+                raise BencodeError('String runs past the end of data')
+            return pos
+
+
+# the keys of the dict at pos, each mapped to the span of its encoded value
+@_checked
+def dict_spans(data, pos=0):
+    if data[pos] != 0x64:
+        raise BencodeError('Expected a dict at {}'.format(pos))
+    pos += 1
+    spans = {}
+    while data[pos] != 0x65:
+        start, end = _string(data, pos)
+        value_end = skip(data, end)
+        spans[data[start:end]] = (end, value_end)
+        pos = value_end
+    return spans
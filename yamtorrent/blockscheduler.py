@@ -0,0 +1,207 @@
+import hashlib
+import logging
+
+logger = logging.getLogger('BlockScheduler')
+
+BLOCK_SIZE = 16384 # 16KB
+
+
+# a piece being downloaded. keeps the state of every block so that any
+# number of peers can contribute blocks to it. the block data itself isn't
+# kept, it goes straight to storage. the piece hash is computed as the blocks
+# arrive for as long as they arrive in order, the rest is read back from
+# storage once the piece is complete
+class PartialPiece(object):
+
+    # block states
+    FREE = 0
+    REQUESTED = 1
+    RECEIVED = 2
+
+    def __init__(self, piece_id, size, block_size=BLOCK_SIZE):
+        self.piece_id = piece_id
+        self.size = size
+        self.block_size = block_size
+        self.num_blocks = (size + block_size - 1) // block_size
+        self.reset()
+
+    # forget everything downloaded so far, e.g. after a hash failure
+    def reset(self):
+        self.blocks = bytearray(self.num_blocks)
+        self.num_free = self.num_blocks
+        self.num_received = 0
+
+        # SHA1 of the first `hashed` bytes of the piece
+        self.hasher = hashlib.sha1()
+        self.hashed = 0
+
+        # block index -> set of peers the block is requested from. only
+        # blocks in the REQUESTED state have an entry
+        self.requesters = {}
+
+        # peers that sent us at least one block of this piece
+        self.contributors = set()
+
+    def block_length(self, index):
+        return min(self.block_size, self.size - index * self.block_size)
+
+    def is_complete(self):
+        return self.num_received == self.num_blocks
+
+
+# hands out blocks to peers at the torrent level. pieces are taken from the
+# piece picker as they're needed and kept as PartialPieces until every
+# block has arrived, whichever peers the blocks come from. blocks requested
+# from a peer that chokes us or goes away are put back up for grabs, the
+# ones already received are kept.
+class BlockScheduler(object):
+
+    def __init__(self, meta, picker, block_size=BLOCK_SIZE):
+        self.meta = meta
+        self.picker = picker
+        self.block_size = block_size
+        self.endgame = False
+
+        # piece_id -> PartialPiece, in the order they were started
+        self.partial = {}
+
+    def piece_size(self, piece_id):
+        if piece_id == self.meta.num_pieces() - 1:
+            return self.meta.full_length() - ((self.meta.num_pieces() - 1) * self.meta.piece_length())
+        return self.meta.piece_length()
+
+    # returns up to count blocks, as (piece_id, offset, length), that peer
+    # should request next. bitfield, if given, is the pieces that may be
+    # requested (otherwise whatever the peer has), and pieces in suggested
+    # are started before the picker's choice
+    def request_blocks(self, peer, count, bitfield=None, suggested=()):
+        if bitfield is None:
+            bitfield = peer.get_bitfield()
+        blocks = []
+
+        # finish pieces that are already started first
+        for piece in self.partial.values():
+            if len(blocks) >= count:
+                break
+            if piece.num_free and bitfield[piece.piece_id]:
+                self._take_free(piece, peer, count - len(blocks), blocks)
+
+        # then start new ones, the suggested ones first
+        for piece_id in suggested:
+            if len(blocks) >= count:
+                break
+            if bitfield[piece_id] and self.picker.is_wanted(piece_id):
+                self.picker.unwant(piece_id)
+                piece = PartialPiece(piece_id, self.piece_size(piece_id), self.block_size)
+                self.partial[piece_id] = piece
+                self._take_free(piece, peer, count - len(blocks), blocks)
+
+        while len(blocks) < count:
+            piece_id = self.picker.pick(bitfield)
+            if piece_id is None:
+                break
+            piece = PartialPiece(piece_id, self.piece_size(piece_id), self.block_size)
+            self.partial[piece_id] = piece
+            self._take_free(piece, peer, count - len(blocks), blocks)
+
+        # every remaining block is requested from somebody: endgame
+        if len(blocks) < count and self.in_endgame():
+            if not self.endgame:
+                logger.info('entering endgame with %d pieces left', len(self.partial))
+                self.endgame = True
+            self._take_endgame(peer, bitfield, count - len(blocks), blocks)
+
+        return blocks
+
+    def in_endgame(self):
+        return (self.picker.num_wanted() == 0 and len(self.partial) > 0 and
+                not any(piece.num_free for piece in self.partial.values()))
+
+    def _take_free(self, piece, peer, count, blocks):
+        index = piece.blocks.find(PartialPiece.FREE)
+        while count > 0 and index != -1:
+            piece.blocks[index] = PartialPiece.REQUESTED
+            piece.requesters[index] = set([peer])
+            piece.num_free -= 1
+            blocks.append((piece.piece_id, index * self.block_size, piece.block_length(index)))
+            count -= 1
+            index = piece.blocks.find(PartialPiece.FREE, index + 1)
+
+    # endgame: request blocks that are already requested from other peers,
+    # the ones with the fewest requesters first
+    def _take_endgame(self, peer, bitfield, count, blocks):
+        candidates = []
+        for piece in self.partial.values():
+            if not bitfield[piece.piece_id]:
+                continue
+            for index, requesters in piece.requesters.items():
+                if peer not in requesters:
+                    candidates.append((len(requesters), piece, index))
+
+        candidates.sort(key=lambda c: c[0])
+        for n, piece, index in candidates[:count]:
+            piece.requesters[index].add(peer)
+            blocks.append((piece.piece_id, index * self.block_size, piece.block_length(index)))
+
+    # mark a block received from peer. returns None if the block isn't
+    # wanted (and shouldn't be stored), otherwise the other peers the block was
+    # requested from, whose requests should be cancelled
+    def block_received(self, peer, piece_id, offset, block):
+        piece = self.partial.get(piece_id)
+        if piece is None:
+            logger.debug('block for piece %d which is not in progress', piece_id)
+            return None
+
+        index = offset // self.block_size
+        if (offset % self.block_size or index >= piece.num_blocks or
+                len(block) != piece.block_length(index)):
+            logger.warning('invalid block piece=%d offset=%d length=%d', piece_id, offset, len(block))
+            return None
+
+        state = piece.blocks[index]
+        if state == PartialPiece.RECEIVED:
+            return None
+        if state == PartialPiece.FREE:
+            piece.num_free -= 1
+
+        others = piece.requesters.pop(index, set())
+        others.discard(peer)
+
+        piece.blocks[index] = PartialPiece.RECEIVED
+        piece.num_received += 1
+        piece.contributors.add(peer)
+        if offset == piece.hashed:
+            piece.hasher.update(block)
+            piece.hashed += len(block)
+        return others
+
+    def piece_complete(self, piece_id):
+        piece = self.partial.get(piece_id)
+        return piece is not None and piece.is_complete()
+
+    # take a complete piece out of the scheduler to be verified
+    def finish_piece(self, piece_id):
+        return self.partial.pop(piece_id)
+
+    # a finished piece failed verification, download it again from scratch
+    def retry_piece(self, piece):
+        piece.reset()
+        self.partial[piece.piece_id] = piece
+
+    # peer won't be sending these blocks (choked, timed out or disconnected),
+    # let somebody else have them
+    def drop_requests(self, peer, blocks):
+        for piece_id, offset, length in blocks:
+            piece = self.partial.get(piece_id)
+            if piece is None:
+                continue
+            index = offset // self.block_size
+            requesters = piece.requesters.get(index)
+            if requesters is None:
+                continue
+            requesters.discard(peer)
+            if not requesters:
+                del piece.requesters[index]
+                piece.blocks[index] = PartialPiece.FREE
+                piece.num_free += 1
+                self.endgame = False
@@ -0,0 +1,90 @@
+import random
+import logging
+
+logger = logging.getLogger('Choker')
+
+
+# decides which peers we upload to (tit-for-tat). every round (choke_interval
+# seconds) the transfer rate of every peer is sampled, and the unchoke_slots
+# interested peers that upload the most to us are unchoked (or, when we're
+# seeding, the ones we upload to fastest). one more, optimistic, slot goes
+# to a random choked peer and moves on every optimistic_unchoke_interval
+# seconds so new peers get a chance to prove themselves.
+class Choker(object):
+
+    def __init__(self, reactor, settings):
+        self._reactor = reactor
+        self._settings = settings
+
+        # peer -> [bytes downloaded, bytes uploaded, download rate, upload rate]
+        self._rates = {}
+        self._last_run = None
+        self.optimistic = None
+        self._optimistic_since = None
+
+    def download_rate(self, peer):
+        return self._rates[peer][2] if peer in self._rates else 0.0
+
+    def upload_rate(self, peer):
+        return self._rates[peer][3] if peer in self._rates else 0.0
+
+    # a peer became interested: don't make it wait for the next round if a
+    # slot is free
+    def peer_interested(self, peer, peers):
+        unchoked = sum(1 for p in peers if not p.am_choking() and p.peer_interested())
+        if peer.am_choking() and unchoked <= self._settings.unchoke_slots:
+            peer.send_unchoke()
+
+    def forget(self, peer):
+        self._rates.pop(peer, None)
+        if peer is self.optimistic:
+            self.optimistic = None
+
+    def run(self, peers, seeding=False):
+        now = self._reactor.seconds()
+        self._update_rates(peers, now)
+
+        interested = [p for p in peers if p.peer_interested()]
+        random.shuffle(interested)  # so peers with equal rates take turns
+        if seeding:
+            interested.sort(key=self.upload_rate, reverse=True)
+        else:
+            interested.sort(key=self.download_rate, reverse=True)
+        unchoke = set(interested[:self._settings.unchoke_slots])
+
+        # rotate the optimistic unchoke
+        if (self.optimistic is None or self.optimistic not in interested or
+                now - self._optimistic_since >= self._settings.optimistic_unchoke_interval):
+            candidates = [p for p in interested if p not in unchoke]
+            self.optimistic = random.choice(candidates) if candidates else None
+            self._optimistic_since = now
+            if self.optimistic is not None:
+                logger.debug('optimistic unchoke: %s', str(self.optimistic.peer_info))
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+
+        for p in peers:
+            if p in unchoke:
+                if p.am_choking():
+                    p.send_unchoke()
+            elif not p.am_choking():
+                p.send_choke()
+
+    def _update_rates(self, peers, now):
+        elapsed = now - self._last_run if self._last_run is not None else None
+        self._last_run = now
+        alpha = self._settings.rate_smoothing
+
+        for p in peers:
+            rates = self._rates.get(p)
+            if rates is None:
+                self._rates[p] = [p.bytes_downloaded, p.bytes_uploaded, 0.0, 0.0]
+                continue
+            if not elapsed:
+                continue
+            down = (p.bytes_downloaded - rates[0]) / elapsed
+            up = (p.bytes_uploaded - rates[1]) / elapsed
+            rates[0] = p.bytes_downloaded
+            rates[1] = p.bytes_uploaded
+            rates[2] = (1 - alpha) * rates[2] + alpha * down
+            rates[3] = (1 - alpha) * rates[3] + alpha * up
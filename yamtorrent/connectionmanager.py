@@ -0,0 +1,178 @@
+import logging
+
+logger = logging.getLogger('ConnectionManager')
+
+
+# a peer we know about and may connect to, with its history
+class Candidate(object):
+
+    def __init__(self, peer_info):
+        self.peer_info = peer_info
+        self.failures = 0
+        self.next_attempt = 0
+        self.bytes_downloaded = 0
+        self.seconds_connected = 0.0
+
+    # bytes/s we got from it over all earlier connections
+    def rate(self):
+        if not self.seconds_connected:
+            return 0.0
+        return self.bytes_downloaded / self.seconds_connected
+
+    # higher is better: peers that served us well first, then ones we
+    # haven't tried, then ones that failed (the more often the worse)
+    def score(self):
+        return (self.rate(), -self.failures)
+
+
+# decides which peers to connect to and when. candidates come from the
+# tracker (or anywhere else) and are dialled best score first, keeping at
+# most max_half_open connection attempts and max_connections connections in
+# total. an attempt that doesn't get as far as the peer's bitfield (or
+# first message) within connect_timeout + handshake_timeout is dropped.
+# failed candidates are retried after an exponentially growing delay, and
+# ones that disconnect wait reconnect_backoff before being tried again.
+#
+# connections peers make to us count towards max_connections too.
+#
+# make_peer(peer_info) returns a new PeerConnection, on_connected(peer) is
+# called once it's ready.
+class ConnectionManager(object):
+
+    def __init__(self, reactor, settings, make_peer, on_connected):
+        self._reactor = reactor
+        self._settings = settings
+        self._make_peer = make_peer
+        self._on_connected = on_connected
+
+        self.max_connections = settings.max_connections
+        self.stopped = False
+
+        self.candidates = {}    # (ip, port) -> Candidate
+        self.half_open = {}     # PeerConnection -> timeout DelayedCall
+        self.established = {}   # PeerConnection -> time connected
+
+    def _key(self, peer_info):
+        return (peer_info.ip, peer_info.port)
+
+    def num_connections(self):
+        return len(self.half_open) + len(self.established)
+
+    def add_peers(self, peer_infos):
+        added = 0
+        for peer_info in peer_infos:
+            key = self._key(peer_info)
+            if key in self.candidates:
+                continue
+            if len(self.candidates) >= self._settings.max_candidates:
+                break
+            self.candidates[key] = Candidate(peer_info)
+            added += 1
+        if added:
+            logger.debug('%d new candidates, %d known', added, len(self.candidates))
+        self.fill()
+
+    # dial the best candidates until we're at the limits
+    def fill(self):
+        s = self._settings
+        if self.stopped:
+            return
+        while len(self.half_open) < s.max_half_open and self.num_connections() < self.max_connections:
+            candidate = self._best_candidate()
+            if candidate is None:
+                break
+            self._dial(candidate)
+
+    def _best_candidate(self):
+        now = self._reactor.seconds()
+        active = set(self._key(p.peer_info) for p in self.half_open)
+        active.update(self._key(p.peer_info) for p in self.established)
+        best = None
+        for key, candidate in self.candidates.items():
+            if candidate.next_attempt > now or key in active:
+                continue
+            if best is None or candidate.score() > best.score():
+                best = candidate
+        return best
+
+    def _dial(self, candidate):
+        s = self._settings
+        logger.info('Connecting to peer: %s', str(candidate.peer_info))
+        peer = self._make_peer(candidate.peer_info)
+        # don't try it again until this attempt is over
+        candidate.next_attempt = float('inf')
+        self.half_open[peer] = self._reactor.callLater(s.connect_timeout + s.handshake_timeout,
+                                                       self._timed_out, peer)
+        d = peer.connect(self._reactor, s.connect_timeout)
+        d.addCallbacks(self._connected, self._failed, errbackArgs=(peer,))
+
+    # a peer connected to us. returns False if we're at the connection limit
+    def add_inbound(self, peer):
+        if self.stopped or self.num_connections() >= self.max_connections:
+            return False
+        self.half_open[peer] = self._reactor.callLater(self._settings.handshake_timeout,
+                                                       self._timed_out, peer)
+        peer.done.addCallbacks(self._connected, self._failed, errbackArgs=(peer,))
+        return True
+
+    def _timed_out(self, peer):
+        if peer in self.half_open:
+            logger.info('handshake with %s timed out', str(peer.peer_info))
+            peer.stop()
+            self._attempt_failed(peer)
+
+    def _connected(self, peer):
+        timeout = self.half_open.pop(peer, None)
+        if timeout is None:
+            # gave up on it already
+            peer.stop()
+            return
+        if timeout.active():
+            timeout.cancel()
+        candidate = self.candidates.get(self._key(peer.peer_info))
+        if candidate is not None:
+            candidate.failures = 0
+        self.established[peer] = self._reactor.seconds()
+        self._on_connected(peer)
+        self.fill()
+
+    def _failed(self, failure, peer):
+        logger.info('failed to connect to peer %s: %s', str(peer.peer_info), failure.getErrorMessage())
+        if peer in self.half_open:
+            self._attempt_failed(peer)
+
+    def _attempt_failed(self, peer):
+        timeout = self.half_open.pop(peer)
+        if timeout.active():
+            timeout.cancel()
+        candidate = self.candidates.get(self._key(peer.peer_info))
+        if candidate is not None:
+            candidate.failures += 1
+            delay = min(self._settings.reconnect_backoff * 2 ** (candidate.failures - 1),
+                        self._settings.max_reconnect_backoff)
+            candidate.next_attempt = self._reactor.seconds() + delay
+        self.fill()
+
+    # drop every connection and stop making new ones
+    def stop(self):
+        self.stopped = True
+        for peer, timeout in list(self.half_open.items()):
+            if timeout.active():
+                timeout.cancel()
+            peer.stop()
+        self.half_open = {}
+        for peer in list(self.established):
+            peer.stop()
+
+    # an established connection went away
+    def peer_disconnected(self, peer):
+        connected_at = self.established.pop(peer, None)
+        if connected_at is None:
+            return
+        candidate = self.candidates.get(self._key(peer.peer_info))
+        if candidate is not None:
+            now = self._reactor.seconds()
+            candidate.bytes_downloaded += peer.bytes_downloaded
+            candidate.seconds_connected += now - connected_at
+            candidate.next_attempt = now + self._settings.reconnect_backoff
+        self.fill()
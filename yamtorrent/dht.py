@@ -0,0 +1,613 @@
+import os
+import bisect
+import random
+import socket
+import struct
+import hashlib
+import logging
+import bencodepy
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.error import CannotListenError
+from twisted.internet.task import LoopingCall
+
+from .peerinfo import PeerInfo
+from .settings import Settings
+
+logger = logging.getLogger('DHT')
+
+K = 8           # nodes per bucket, and how many closest nodes a lookup finds
+ALPHA = 3       # queries a lookup keeps in flight
+ID_SPACE = 1 << 160
+
+# a node that failed to answer this many queries in a row is replaced by
+# one waiting in its bucket's replacement cache
+MAX_FAILURES = 2
+
+# seconds: how often the token secret changes (tokens stay valid for two
+# of these), how long announced peers are kept, after how long without a
+# change a bucket is refreshed, and how often the maintenance runs
+TOKEN_INTERVAL = 300
+PEER_LIFETIME = 30 * 60
+BUCKET_REFRESH = 15 * 60
+MAINTENANCE_INTERVAL = 60
+SAVE_INTERVAL = 10 * 60
+
+# the most peers kept per torrent, and returned in one get_peers response
+MAX_STORED_PEERS = 500
+MAX_VALUES = 50
+
+# KRPC error codes
+GENERIC_ERROR = 201
+PROTOCOL_ERROR = 203
+METHOD_UNKNOWN = 204
+
+
+class KRPCError(Exception):
+    pass
+
+
+def distance(a, b):
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+
+def encode_nodes(nodes):
+    return b''.join(node.id + socket.inet_aton(node.ip) + struct.pack('!H', node.port)
+                    for node in nodes)
+
+
+def decode_nodes(data):
+    nodes = []
+    for i in range(0, len(data) - len(data) % 26, 26):
+        node_id, ip, port = struct.unpack_from('!20s4sH', data, i)
+        if port:
+            nodes.append(Node(node_id, socket.inet_ntoa(ip), port))
+    return nodes
+
+
+def encode_peer(ip, port):
+    return socket.inet_aton(ip) + struct.pack('!H', port)
+
+
+def decode_peers(values):
+    peers = []
+    for value in values:
+        if isinstance(value, bytes) and len(value) == 6:
+            ip, port = struct.unpack('!4sH', value)
+            if port:
+                peers.append(PeerInfo(socket.inet_ntoa(ip), port))
+    return peers
+
+
+# a DHT node. id is None for a bootstrap node we only know the address of
+class Node(object):
+
+    def __init__(self, node_id, ip, port):
+        self.id = node_id
+        self.ip = ip
+        self.port = port
+        self.last_seen = 0
+        self.failures = 0
+
+    @property
+    def address(self):
+        return (self.ip, self.port)
+
+    def __repr__(self):
+        return '<Node {}:{}>'.format(self.ip, self.port)
+
+
+# the nodes whose ids fall in [lo, hi), least recently seen first, and
+# those waiting for a place
+class Bucket(object):
+
+    def __init__(self, lo, hi):
+        self.lo = lo
+        self.hi = hi
+        self.nodes = []
+        self.replacements = []
+        self.last_changed = 0
+
+    def covers(self, n):
+        return self.lo <= n < self.hi
+
+
+# the Kademlia routing table: buckets of up to k nodes covering the id
+# space. only the bucket our own id falls in is split when full, so we know
+# many nodes close to us and a few far away
+class RoutingTable(object):
+
+    def __init__(self, node_id, k=K):
+        self.node_id = node_id
+        self.k = k
+        self._own = int.from_bytes(node_id, 'big')
+        self.buckets = [Bucket(0, ID_SPACE)]
+
+    def __len__(self):
+        return sum(len(bucket.nodes) for bucket in self.buckets)
+
+    def bucket_for(self, node_id):
+        n = int.from_bytes(node_id, 'big')
+        i = bisect.bisect_right([bucket.lo for bucket in self.buckets], n) - 1
+        return self.buckets[i]
+
+    def find(self, node_id):
+        for node in self.bucket_for(node_id).nodes:
+            if node.id == node_id:
+                return node
+        return None
+
+    def nodes(self):
+        return [node for bucket in self.buckets for node in bucket.nodes]
+
+    # a node answered or queried us. returns whether it's in the table
+    def add(self, node, now):
+        if node.id is None or node.id == self.node_id:
+            return False
+        bucket = self.bucket_for(node.id)
+        for i, known in enumerate(bucket.nodes):
+            if known.id == node.id:
+                if known.address != node.address:
+                    # don't let anyone take over a node that's still there
+                    return False
+                known.last_seen = now
+                known.failures = 0
+                bucket.nodes.append(bucket.nodes.pop(i))
+                return True
+
+        node.last_seen = now
+        node.failures = 0
+        if len(bucket.nodes) < self.k:
+            bucket.nodes.append(node)
+            bucket.last_changed = now
+            return True
+        if bucket.covers(self._own):
+            self._split(bucket)
+            return self.add(node, now)
+
+        for i, known in enumerate(bucket.nodes):
+            if known.failures >= MAX_FAILURES:
+                del bucket.nodes[i]
+                bucket.nodes.append(node)
+                bucket.last_changed = now
+                return True
+
+        bucket.replacements = [r for r in bucket.replacements if r.id != node.id]
+        bucket.replacements = bucket.replacements[-(self.k - 1):] + [node]
+        return False
+
+    # a node didn't answer. once it has failed too often it makes way for
+    # a replacement
+    def failed(self, node_id):
+        node = self.find(node_id)
+        if node is None:
+            return
+        node.failures += 1
+        bucket = self.bucket_for(node_id)
+        if node.failures >= MAX_FAILURES and bucket.replacements:
+            bucket.nodes.remove(node)
+            bucket.nodes.append(bucket.replacements.pop())
+
+    def _split(self, bucket):
+        i = self.buckets.index(bucket)
+        middle = (bucket.lo + bucket.hi) // 2
+        low, high = Bucket(bucket.lo, middle), Bucket(middle, bucket.hi)
+        for half in (low, high):
+            half.last_changed = bucket.last_changed
+            half.nodes = [n for n in bucket.nodes if half.covers(int.from_bytes(n.id, 'big'))]
+            half.replacements = [n for n in bucket.replacements
+                                 if half.covers(int.from_bytes(n.id, 'big'))]
+        self.buckets[i:i + 1] = [low, high]
+
+    # the count nodes closest to target that are answering
+    def closest(self, target, count=K):
+        nodes = [node for node in self.nodes() if node.failures < MAX_FAILURES]
+        nodes.sort(key=lambda node: distance(node.id, target))
+        return nodes[:count]
+
+
+# an iterative lookup of the nodes closest to target: the closest nodes
+# known are queried, ALPHA at a time, each answer bringing nodes closer
+# still, until the K closest that answered have all been asked. get_peers
+# lookups pass any peers found to on_peers as they arrive.
+#
+# deferred fires with the lookup once it's over
+class Lookup(object):
+
+    def __init__(self, dht, target, method, on_peers=None):
+        self.dht = dht
+        self.target = target
+        self.method = method
+        self.on_peers = on_peers
+        self.deferred = Deferred()
+        self.responded = []     # (distance, Node, token)
+        self.peers = set()      # (ip, port)
+        self._candidates = {}   # address -> Node
+        self._queried = set()   # addresses
+        self._in_flight = 0
+        self._finished = False
+
+    def start(self, nodes):
+        for node in nodes:
+            self._add(node)
+        self._step()
+        return self.deferred
+
+    def _distance(self, node):
+        # bootstrap nodes (no id) are asked only when nothing better is known
+        return distance(node.id, self.target) if node.id is not None else ID_SPACE
+
+    def _add(self, node):
+        if node.address not in self._queried and node.address not in self._candidates:
+            if node.id != self.dht.node_id:
+                self._candidates[node.address] = node
+
+    def _step(self):
+        if self._finished:
+            return
+        while self._in_flight < ALPHA and self._candidates:
+            best = min(self._candidates.values(), key=self._distance)
+            if len(self.responded) >= K and self._distance(best) >= self.responded[K - 1][0]:
+                break
+            del self._candidates[best.address]
+            self._queried.add(best.address)
+            self._in_flight += 1
+            args = {b'target' if self.method == b'find_node' else b'info_hash': self.target}
+            d = self.dht.query(best, self.method, args)
+            d.addCallbacks(self._answered, self._failed, errbackArgs=(best,))
+        if not self._in_flight:
+            self._finished = True
+            self.responded = self.responded[:K]
+            self.deferred.callback(self)
+
+    def _answered(self, result):
+        node, response = result
+        self._in_flight -= 1
+        token = response.get(b'token')
+        self.responded.append((self._distance(node), node, token))
+        self.responded.sort(key=lambda entry: entry[0])
+
+        nodes = response.get(b'nodes')
+        if isinstance(nodes, bytes):
+            for found in decode_nodes(nodes):
+                self._add(found)
+
+        values = response.get(b'values')
+        if isinstance(values, list):
+            peers = [p for p in decode_peers(values) if (p.ip, p.port) not in self.peers]
+            self.peers.update((p.ip, p.port) for p in peers)
+            if peers and self.on_peers is not None:
+                self.on_peers(peers)
+        self._step()
+
+    def _failed(self, failure, node):
+        self._in_flight -= 1
+        self._step()
+
+
+# a node of the mainline DHT (BEP 5). answers other nodes' queries, keeps
+# the routing table fresh and looks up peers for torrents. the node id and
+# the nodes known are saved to state_path so a restart needn't bootstrap
+# from scratch, bootstrap (a list of (host, port)) is only used when too
+# few nodes are known.
+class DHT(DatagramProtocol):
+
+    def __init__(self, reactor, settings=None, state_path=None, bootstrap=None):
+        self._reactor = reactor
+        self._settings = settings if settings else Settings()
+        self.state_path = state_path
+        self.bootstrap_nodes = bootstrap if bootstrap is not None else []
+        self.node_id = None
+        self.table = None
+        self._saved_nodes = []
+        self._load()
+        if self.node_id is None:
+            self.node_id = os.urandom(20)
+        self.table = RoutingTable(self.node_id)
+
+        self._transactions = {}     # transaction id -> (Deferred, DelayedCall, address, node)
+        self._next_transaction = random.getrandbits(16)
+        self._secrets = [os.urandom(20), os.urandom(20)]
+        self._peers = {}            # info_hash -> {(ip, port): time announced}
+        self._port = None
+        self._loop = None
+        self._ticks = 0
+        self._bootstrapping = False
+        self._bootstrapped = []     # Deferreds of lookups waiting for the bootstrap
+
+        # monitoring
+        self.queries_sent = 0
+        self.queries_received = 0
+        self.timeouts = 0
+
+    # start the node on a UDP port. returns whether it's running
+    def start(self, port=0, interface=''):
+        if self._port is not None:
+            return True
+        try:
+            self._port = self._reactor.listenUDP(port, self, interface=interface)
+        except CannotListenError as e:
+            logger.error('can\'t open the DHT port %d: %s', port, str(e))
+            return False
+        logger.info('DHT node listening on port %d', self.listening_port())
+        self._loop = LoopingCall(self.maintain)
+        self._loop.clock = self._reactor
+        self._loop.start(MAINTENANCE_INTERVAL, now=False)
+        self.bootstrap()
+        return True
+
+    def stop(self):
+        if self._port is None:
+            return
+        self.save()
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        port, self._port = self._port, None
+        transactions, self._transactions = self._transactions, {}
+        for d, call, address, node_id in transactions.values():
+            if call.active():
+                call.cancel()
+            d.errback(KRPCError('DHT stopped'))
+        return port.stopListening()
+
+    def listening_port(self):
+        return self._port.getHost().port if self._port is not None else None
+
+    ######## BOOTSTRAP AND MAINTENANCE  #################
+
+    # fill the routing table by looking ourselves up, starting from the
+    # nodes saved last time (and the bootstrap nodes if they're few)
+    def bootstrap(self):
+        if self._bootstrapping:
+            return
+        self._bootstrapping = True
+        nodes = self.table.nodes() + self._saved_nodes
+        self._saved_nodes = []
+        if len(nodes) >= K:
+            return self._lookup_self(nodes)
+
+        def resolved(results):
+            found = [Node(None, *address) for ok, address in results if ok]
+            return self._lookup_self(nodes + found)
+
+        ds = []
+        for host, port in self.bootstrap_nodes:
+            d = self._reactor.resolve(host)
+            d.addCallback(lambda ip, port=port: (ip, port))
+            ds.append(d)
+        return DeferredList(ds, consumeErrors=True).addCallback(resolved)
+
+    def _lookup_self(self, nodes):
+        def done(lookup):
+            self._bootstrapping = False
+            logger.info('DHT bootstrapped, %d nodes known', len(self.table))
+            waiting, self._bootstrapped = self._bootstrapped, []
+            for d in waiting:
+                d.callback(None)
+            return lookup
+        return Lookup(self, self.node_id, b'find_node').start(nodes).addCallback(done)
+
+    # ping a node we heard of (from a peer's PORT message, say)
+    def add_node(self, address):
+        if self._port is not None:
+            self.query(Node(None, address[0], address[1]), b'ping', {}).addErrback(lambda f: None)
+
+    def maintain(self):
+        self._ticks += 1
+        now = self._reactor.seconds()
+
+        if self._ticks % (TOKEN_INTERVAL // MAINTENANCE_INTERVAL) == 0:
+            self._secrets = [os.urandom(20), self._secrets[0]]
+
+        for info_hash in list(self._peers):
+            peers = self._peers[info_hash]
+            for address in [a for a, seen in peers.items() if now - seen > PEER_LIFETIME]:
+                del peers[address]
+            if not peers:
+                del self._peers[info_hash]
+
+        if len(self.table) < K:
+            self.bootstrap()
+        else:
+            # look up a random id in every bucket that hasn't changed for a while
+            for bucket in self.table.buckets:
+                if now - bucket.last_changed > BUCKET_REFRESH and bucket.nodes:
+                    bucket.last_changed = now
+                    target = random.randrange(bucket.lo, bucket.hi).to_bytes(20, 'big')
+                    Lookup(self, target, b'find_node').start(self.table.closest(target))
+
+        if self._ticks % (SAVE_INTERVAL // MAINTENANCE_INTERVAL) == 0:
+            self.save()
+
+    def _load(self):
+        if not self.state_path:
+            return
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = bencodepy.decode(f.read())
+            node_id = state[b'id']
+            nodes = decode_nodes(state[b'nodes'])
+        except FileNotFoundError:
+            return
+        except (OSError, KeyError, TypeError, bencodepy.exceptions.DecodingError):
+            logger.warning('could not read DHT state %s', self.state_path)
+            return
+        if isinstance(node_id, bytes) and len(node_id) == 20:
+            self.node_id = node_id
+        self._saved_nodes = nodes
+
+    def save(self):
+        if not self.state_path:
+            return
+        nodes = [node for node in self.table.nodes() if node.failures < MAX_FAILURES]
+        state = {b'id': self.node_id, b'nodes': encode_nodes(nodes)}
+        tmp = self.state_path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(bencodepy.encode(state))
+            os.replace(tmp, self.state_path)
+        except OSError as e:
+            logger.error('could not save DHT state %s: %s', self.state_path, str(e))
+
+    ######## LOOKUPS  #################
+
+    # find peers for info_hash, passing them to on_peers as they're found.
+    # if port is given we announce ourselves on it to the closest nodes.
+    # returns a Deferred that fires with every peer found. lookups made
+    # while we're bootstrapping wait until we know some nodes
+    def get_peers(self, info_hash, port=None, on_peers=None):
+        if self._bootstrapping:
+            d = Deferred()
+            self._bootstrapped.append(d)
+            return d.addCallback(lambda result: self.get_peers(info_hash, port, on_peers))
+        lookup = Lookup(self, info_hash, b'get_peers', on_peers)
+
+        def done(lookup):
+            if port is not None:
+                for d, node, token in lookup.responded:
+                    if token is not None:
+                        args = {b'info_hash': info_hash, b'port': port, b'token': token,
+                                b'implied_port': 0}
+                        self.query(node, b'announce_peer', args).addErrback(lambda f: None)
+            return [PeerInfo(ip, p) for ip, p in lookup.peers]
+        return lookup.start(self.table.closest(info_hash)).addCallback(done)
+
+    ######## KRPC  #################
+
+    # send a query. returns a Deferred that fires with (node, response
+    # arguments) or fails with KRPCError
+    def query(self, node, method, args):
+        d = Deferred()
+        if self._port is None:
+            d.errback(KRPCError('DHT not running'))
+            return d
+        self._next_transaction = (self._next_transaction + 1) & 0xffff
+        transaction_id = struct.pack('!H', self._next_transaction)
+        args = dict(args)
+        args[b'id'] = self.node_id
+        message = {b't': transaction_id, b'y': b'q', b'q': method, b'a': args}
+        call = self._reactor.callLater(self._settings.dht_query_timeout,
+                                       self._timed_out, transaction_id)
+        self._transactions[transaction_id] = (d, call, node.address, node.id)
+        self.queries_sent += 1
+        self._send(message, node.address)
+        return d
+
+    def _send(self, message, address):
+        try:
+            self.transport.write(bencodepy.encode(message), address)
+        except socket.error as e:
+            logger.debug('sending to %s:%d failed: %s', address[0], address[1], str(e))
+
+    def _timed_out(self, transaction_id):
+        d, call, address, node_id = self._transactions.pop(transaction_id)
+        self.timeouts += 1
+        if node_id is not None:
+            self.table.failed(node_id)
+        d.errback(KRPCError('query to {}:{} timed out'.format(*address)))
+
+    def datagramReceived(self, data, address):
+        try:
+            message = bencodepy.decode(data)
+        except Exception:
+            return
+        if not isinstance(message, dict) or not isinstance(message.get(b't'), bytes):
+            return
+        kind = message.get(b'y')
+        if kind == b'q':
+            self._handle_query(message, address)
+        elif kind in (b'r', b'e'):
+            self._handle_response(message, address)
+
+    def _handle_response(self, message, address):
+        transaction = self._transactions.get(message[b't'])
+        if transaction is None or transaction[2] != address:
+            return
+        d, call, address, node_id = self._transactions.pop(message[b't'])
+        call.cancel()
+
+        if message[b'y'] == b'e':
+            error = message.get(b'e')
+            d.errback(KRPCError('{}:{} answered with an error: {}'.format(address[0], address[1],
+                                                                         error)))
+            return
+        response = message.get(b'r')
+        if not isinstance(response, dict) or not self._valid_id(response.get(b'id')):
+            d.errback(KRPCError('bad response from {}:{}'.format(*address)))
+            return
+        if node_id is not None and response[b'id'] != node_id:
+            # it's a different node now
+            self.table.failed(node_id)
+        node = Node(response[b'id'], address[0], address[1])
+        self.table.add(node, self._reactor.seconds())
+        d.callback((node, response))
+
+    def _valid_id(self, node_id):
+        return isinstance(node_id, bytes) and len(node_id) == 20
+
+    def _handle_query(self, message, address):
+        self.queries_received += 1
+        args = message.get(b'a')
+        if not isinstance(args, dict) or not self._valid_id(args.get(b'id')):
+            return self._error(message, address, PROTOCOL_ERROR, b'invalid arguments')
+        if not args.get(b'ro'):
+            self.table.add(Node(args[b'id'], address[0], address[1]), self._reactor.seconds())
+
+        handler = {b'ping': self._rcv_ping,
+                   b'find_node': self._rcv_find_node,
+                   b'get_peers': self._rcv_get_peers,
+                   b'announce_peer': self._rcv_announce_peer}.get(message.get(b'q'))
+        if handler is None:
+            return self._error(message, address, METHOD_UNKNOWN, b'method unknown')
+        try:
+            response = handler(args, address)
+        except (KeyError, TypeError, ValueError):
+            return self._error(message, address, PROTOCOL_ERROR, b'invalid arguments')
+        if response is None:
+            return
+        response[b'id'] = self.node_id
+        self._send({b't': message[b't'], b'y': b'r', b'r': response}, address)
+
+    def _error(self, message, address, code, text):
+        self._send({b't': message[b't'], b'y': b'e', b'e': [code, text]}, address)
+
+    def _rcv_ping(self, args, address):
+        return {}
+
+    def _rcv_find_node(self, args, address):
+        target = args[b'target']
+        if not self._valid_id(target):
+            raise ValueError()
+        return {b'nodes': encode_nodes(self.table.closest(target))}
+
+    def _rcv_get_peers(self, args, address):
+        info_hash = args[b'info_hash']
+        if not self._valid_id(info_hash):
+            raise ValueError()
+        response = {b'token': self._token(address[0], self._secrets[0]),
+                    b'nodes': encode_nodes(self.table.closest(info_hash))}
+        peers = list(self._peers.get(info_hash, {}))
+        if peers:
+            random.shuffle(peers)
+            response[b'values'] = [encode_peer(ip, port) for ip, port in peers[:MAX_VALUES]]
+        return response
+
+    def _rcv_announce_peer(self, args, address):
+        info_hash = args[b'info_hash']
+        token = args[b'token']
+        if not self._valid_id(info_hash):
+            raise ValueError()
+        if token not in [self._token(address[0], secret) for secret in self._secrets]:
+            raise ValueError()
+        port = address[1] if args.get(b'implied_port') else args[b'port']
+        if not isinstance(port, int) or not 0 < port < 65536:
+            raise ValueError()
+
+        peers = self._peers.setdefault(info_hash, {})
+        if len(peers) < MAX_STORED_PEERS or (address[0], port) in peers:
+            peers[(address[0], port)] = self._reactor.seconds()
+        return {}
+
+    def _token(self, ip, secret):
+        return hashlib.sha1(secret + socket.inet_aton(ip)).digest()[:8]
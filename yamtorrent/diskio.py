@@ -0,0 +1,221 @@
+import time
+import logging
+import threading
+from collections import deque
+from twisted.internet.defer import Deferred
+
+logger = logging.getLogger('DiskWriter')
+
+
+# writes blocks to Storages on a dedicated thread so a slow disk doesn't
+# hold up the reactor. one writer can serve any number of torrents. queued
+# blocks that are adjacent on disk are merged into one larger write, and
+# files are fsynced every fsync_interval seconds (0 means only on flush()).
+# reads see blocks that are still queued.
+#
+# when more than memory_budget bytes are waiting to be written the writer is
+# congested and callers should stop requesting data, on_drain is called (on
+# the reactor thread) once the queue is back under half the budget.
+#
+# a block that can't be written is dropped, on_write_error(storage,
+# piece_id) is called (on the reactor thread) so the piece can be downloaded
+# again, and flushes waiting for it fail with IOError.
+class DiskWriter(object):
+
+    def __init__(self, reactor, fsync_interval=30.0, memory_budget=64 << 20, batch_bytes=4 << 20):
+        self._reactor = reactor
+        self.fsync_interval = fsync_interval
+        self.memory_budget = memory_budget
+        self.batch_bytes = batch_bytes
+        self.on_drain = None
+        self.on_write_error = None
+
+        self._cond = threading.Condition()
+        self._queue = deque()      # (storage, position, piece_id, offset, data, time queued)
+        self._pending = {}         # (storage, piece_id) -> {offset: data}, queued or being written
+        self._dirty = set()        # storages written to since the last fsync
+        self._flushes = []         # (Deferred, writes queued before it, errors before it)
+        self._thread = None
+        self._stopping = False
+        self._congested = False
+        self._last_fsync = time.time()
+        self._queued_total = 0
+
+        # monitoring
+        self.bytes_pending = 0
+        self.bytes_written = 0
+        self.writes = 0
+        self.errors = 0
+        self.write_latency = 0.0   # moving average, seconds from queued to written
+        self.last_batch_bytes = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='DiskWriter', daemon=True)
+        self._thread.start()
+        self._reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    # write everything still queued and stop the thread
+    def stop(self):
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+
+    # number of writes waiting
+    def queue_depth(self):
+        return len(self._queue)
+
+    def is_congested(self):
+        return self._congested
+
+    def write(self, storage, piece_id, offset, data):
+        self.start()
+        data = bytes(data)
+        position = piece_id * storage.meta.piece_length() + offset
+        with self._cond:
+            self._queue.append((storage, position, piece_id, offset, data, time.time()))
+            self._pending.setdefault((storage, piece_id), {})[offset] = data
+            self.bytes_pending += len(data)
+            self._queued_total += 1
+            if self.bytes_pending > self.memory_budget:
+                self._congested = True
+            self._cond.notify()
+
+    # read length bytes at offset in a piece, including any blocks not yet
+    # written. safe to call from any thread
+    def read(self, storage, piece_id, offset, length):
+        with self._cond:
+            queued = list(self._pending.get((storage, piece_id), {}).items())
+        data = storage.read(piece_id, offset, length)
+        if not queued:
+            return data
+
+        data = bytearray(data.ljust(length, b'\0'))
+        for block_offset, block in queued:
+            start = max(offset, block_offset)
+            end = min(offset + length, block_offset + len(block))
+            if start < end:
+                data[start - offset:end - offset] = block[start - block_offset:end - block_offset]
+        return bytes(data)
+
+    # returns a Deferred that fires once everything queued so far is written
+    # and synced to disk, or fails with IOError if some of it couldn't be
+    def flush(self):
+        self.start()
+        d = Deferred()
+        with self._cond:
+            self._flushes.append((d, self._queued_total, self.errors))
+            self._cond.notify()
+        return d
+
+    def _run(self):
+        written_total = 0
+        while True:
+            with self._cond:
+                while not self._queue and not self._flushes and not self._stopping:
+                    timeout = None
+                    if self.fsync_interval:
+                        timeout = max(0, self._last_fsync + self.fsync_interval - time.time())
+                    if not self._cond.wait(timeout) and self.fsync_interval:
+                        break
+                if self._stopping and not self._queue:
+                    break
+
+                # take a batch of writes
+                batch = []
+                size = 0
+                while self._queue and size < self.batch_bytes:
+                    item = self._queue.popleft()
+                    batch.append(item)
+                    size += len(item[4])
+
+            self._write_batch(batch)
+            written_total += len(batch)
+
+            sync = bool(self.fsync_interval) and time.time() - self._last_fsync >= self.fsync_interval
+            with self._cond:
+                done = [(d, errors) for d, count, errors in self._flushes if count <= written_total]
+                self._flushes = [flush for flush in self._flushes if flush[1] > written_total]
+            if done or sync:
+                self._fsync()
+            self._flushed(done)
+
+        self._fsync()
+        with self._cond:
+            done = [(d, errors) for d, count, errors in self._flushes]
+            self._flushes = []
+        self._flushed(done)
+
+    # fire the flushes in done, (Deferred, errors when it was asked for)
+    def _flushed(self, done):
+        for d, errors in done:
+            if self.errors > errors:
+                self._reactor.callFromThread(d.errback, IOError('writing to disk failed'))
+            else:
+                self._reactor.callFromThread(d.callback, None)
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        batch.sort(key=lambda item: (id(item[0]), item[1]))
+
+        # merge blocks that follow each other on disk into one write
+        runs = []
+        for item in batch:
+            storage, position, piece_id, offset, data, queued = item
+            if runs and runs[-1][0] is storage and runs[-1][1] + runs[-1][4] == position:
+                runs[-1][5].append(data)
+                runs[-1][4] += len(data)
+                runs[-1][6].add(piece_id)
+            else:
+                runs.append([storage, position, piece_id, offset, len(data), [data], {piece_id}])
+
+        for storage, position, piece_id, offset, length, chunks, piece_ids in runs:
+            try:
+                storage.write(piece_id, offset, b''.join(chunks) if len(chunks) > 1 else chunks[0])
+            except OSError as e:
+                self.errors += 1
+                logger.error('write of %d bytes at piece %d offset %d failed: %s',
+                             length, piece_id, offset, str(e))
+                if self.on_write_error is not None:
+                    for failed_id in sorted(piece_ids):
+                        self._reactor.callFromThread(self.on_write_error, storage, failed_id)
+
+        now = time.time()
+        size = 0
+        with self._cond:
+            for storage, position, piece_id, offset, data, queued in batch:
+                self._dirty.add(storage)
+                blocks = self._pending.get((storage, piece_id))
+                if blocks is not None and blocks.get(offset) is data:
+                    del blocks[offset]
+                    if not blocks:
+                        del self._pending[(storage, piece_id)]
+                self.bytes_pending -= len(data)
+                size += len(data)
+                self.write_latency = 0.8 * self.write_latency + 0.2 * (now - queued)
+            self.bytes_written += size
+            self.writes += len(runs)
+            self.last_batch_bytes = size
+            drained = self._congested and self.bytes_pending <= self.memory_budget // 2
+            if drained:
+                self._congested = False
+        if drained and self.on_drain is not None:
+            self._reactor.callFromThread(self.on_drain)
+
+    def _fsync(self):
+        with self._cond:
+            dirty, self._dirty = self._dirty, set()
+        for storage in dirty:
+            try:
+                storage.flush()
+            except OSError as e:
+                self.errors += 1
+                logger.error('fsync failed: %s', str(e))
+        self._last_fsync = time.time()
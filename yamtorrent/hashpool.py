@@ -0,0 +1,79 @@
+import logging
+from twisted.internet.defer import succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+logger = logging.getLogger('HashPool')
+
+
+class HashError(Exception):
+    pass
+
+
+# computes SHA1 digests on a pool of worker threads so that hashing large
+# pieces doesn't hold up the reactor (hashlib releases the GIL while it
+# works). the number of jobs waiting or running is bounded by max_pending,
+# callers are expected to check is_full() and hold back new work.
+class HashPool(object):
+
+    def __init__(self, reactor, threads=2, max_pending=8):
+        self._reactor = reactor
+        self.threads = threads
+        self.max_pending = max_pending
+        self._pool = None
+        self._pending = 0
+
+        # totals, for monitoring
+        self.jobs_done = 0
+        self.bytes_hashed = 0
+
+    def start(self):
+        if self._pool is not None:
+            return
+        self._pool = ThreadPool(minthreads=1, maxthreads=self.threads, name='HashPool')
+        self._pool.start()
+        self._reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.stop()
+            self._pool = None
+
+    # number of jobs queued or running
+    def pending(self):
+        return self._pending
+
+    def is_full(self):
+        return self._pending >= self.max_pending
+
+    # finish an incremental hash. bytes [start, end) weren't fed to hash_obj
+    # yet, they are read back with read(offset, length) on a worker thread
+    # and the Deferred fires with the final digest. read must be thread safe
+    def finish_sha1(self, hash_obj, read, start, end):
+        if start >= end:
+            return succeed(hash_obj.digest())
+        self.start()
+        self._pending += 1
+        d = deferToThreadPool(self._reactor, self._pool, _finish_sha1, hash_obj, read, start, end)
+        d.addBoth(self._job_done, end - start)
+        return d
+
+    def _job_done(self, result, length):
+        self._pending -= 1
+        self.jobs_done += 1
+        self.bytes_hashed += length
+        return result
+
+
+READ_CHUNK = 1 << 20
+
+
+def _finish_sha1(hash_obj, read, start, end):
+    offset = start
+    while offset < end:
+        chunk = read(offset, min(READ_CHUNK, end - offset))
+        if not chunk:
+            raise HashError('short read at offset {}'.format(offset))
+        hash_obj.update(chunk)
+        offset += len(chunk)
+    return hash_obj.digest()
@@ -0,0 +1,99 @@
+import logging
+from twisted.internet.protocol import Factory
+from twisted.internet.error import CannotListenError
+
+from .peerconnection import ProtocolAdapter
+
+logger = logging.getLogger('PeerListener')
+
+PSTR = b"BitTorrent protocol"
+
+
+# an incoming connection. the peer speaks first, so its handshake is read
+# here to learn which torrent it wants, then the connection is handed to
+# that torrent along with everything received so far
+class InboundProtocol(ProtocolAdapter):
+
+    def __init__(self, listener):
+        ProtocolAdapter.__init__(self, None)
+        self._listener = listener
+        self._buf = bytearray()
+
+    def dataReceived(self, data):
+        if self._delegate is not None:
+            self._delegate.rx_data(data)
+            return
+
+        self._buf += data
+        if len(self._buf) < 1:
+            return
+        pstrlen = self._buf[0]
+        if len(self._buf) < pstrlen + 29:
+            return
+        if self._buf[1:pstrlen + 1] != PSTR:
+            logger.info('bad handshake from %s', self.transport.getPeer().host)
+            self.stop()
+            return
+
+        info_hash = bytes(self._buf[pstrlen + 9:pstrlen + 29])
+        peer = self._listener.route(info_hash, self, self.transport.getPeer())
+        if peer is None:
+            self.stop()
+            return
+        self._delegate = peer
+        data, self._buf = bytes(self._buf), None
+        peer.rx_data(data)
+
+
+class InboundFactory(Factory):
+
+    def __init__(self, listener):
+        self._listener = listener
+
+    def buildProtocol(self, address):
+        return InboundProtocol(self._listener)
+
+
+# accepts peer connections on the listen port for any number of torrents,
+# each registered with the info_hash peers will ask for. a torrent is
+# anything with accept_peer(protocol, address), returning the PeerConnection
+# that takes over the connection or None to refuse it.
+class PeerListener(object):
+
+    def __init__(self, reactor):
+        self._reactor = reactor
+        self.torrents = {}  # info_hash -> torrent
+        self._port = None
+
+    def add(self, info_hash, torrent):
+        self.torrents[info_hash] = torrent
+
+    def remove(self, info_hash):
+        self.torrents.pop(info_hash, None)
+
+    # returns whether we're listening
+    def listen(self, port, interface=''):
+        try:
+            self._port = self._reactor.listenTCP(port, InboundFactory(self), interface=interface)
+        except CannotListenError as e:
+            logger.error('can\'t listen on port %d: %s', port, str(e))
+            return False
+        logger.info('listening for peers on port %d', port)
+        return True
+
+    # the port we're listening on, None if we aren't
+    def port(self):
+        return self._port.getHost().port if self._port is not None else None
+
+    def stop(self):
+        if self._port is not None:
+            d = self._port.stopListening()
+            self._port = None
+            return d
+
+    def route(self, info_hash, protocol, address):
+        torrent = self.torrents.get(info_hash)
+        if torrent is None:
+            logger.info('%s asked for a torrent we don\'t have', address.host)
+            return None
+        return torrent.accept_peer(protocol, address)
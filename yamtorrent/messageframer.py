@@ -0,0 +1,68 @@
+import struct
+import logging
+
+logger = logging.getLogger('MessageFramer')
+
+
+# splits the byte stream from a peer into handshake and length-prefixed
+# wire messages. data is appended to one read buffer and messages are handed
+# out as memoryview slices of it, so nothing is copied per message. consumed
+# bytes are only dropped from the front of the buffer once enough of them
+# have piled up.
+class MessageFramer(object):
+
+    HANDSHAKE_BASE_LENGTH = 49  # handshake length minus the pstr itself
+    COMPACT_THRESHOLD = 65536
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+
+    # number of received bytes not handed out yet
+    def pending(self):
+        return len(self._buf) - self._pos
+
+    def feed(self, data):
+        try:
+            self._buf += data
+        except BufferError:
+            # somebody is still holding a view of the buffer, so it can't be
+            # resized in place. move the unread bytes to a fresh buffer
+            self._buf = self._buf[self._pos:] + data
+            self._pos = 0
+
+    # returns a view of the complete handshake at the front of the buffer,
+    # or None if it hasn't all arrived yet
+    def next_handshake(self):
+        if self.pending() < 1:
+            return None
+        length = self.HANDSHAKE_BASE_LENGTH + self._buf[self._pos]
+        return self._take(length)
+
+    # returns a view of the next complete message including its 4 byte
+    # length prefix, or None if it hasn't all arrived yet
+    def next_message(self):
+        if self.pending() < 4:
+            return None
+        msg_length = struct.unpack_from('!I', self._buf, self._pos)[0]
+        return self._take(4 + msg_length)
+
+    def _take(self, length):
+        if self.pending() < length:
+            return None
+        start = self._pos
+        self._pos += length
+        return memoryview(self._buf)[start:start + length]
+
+    # drop consumed bytes. cheap when everything has been read, otherwise only
+    # done once the consumed prefix is large and at least half the buffer
+    def compact(self):
+        if self._pos == 0:
+            return
+        if self._pos == len(self._buf) or (self._pos >= self.COMPACT_THRESHOLD and
+                                           self._pos * 2 >= len(self._buf)):
+            try:
+                del self._buf[:self._pos]
+            except BufferError:
+                self._buf = self._buf[self._pos:]
+            self._pos = 0
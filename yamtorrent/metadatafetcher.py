@@ -0,0 +1,293 @@
+import math
+import hashlib
+import logging
+from twisted.internet.defer import Deferred, CancelledError
+from twisted.internet.task import LoopingCall
+
+from . import PeerInfo
+from .peerconnection import PeerConnection
+from .trackerconnection import TrackerConnection
+from .connectionmanager import ConnectionManager
+from .pex import MAX_PEERS
+
+logger = logging.getLogger('MetadataFetcher')
+
+# bytes left we announce while the size of the torrent isn't known. anything
+# but 0, which would make trackers take us for a seed
+UNKNOWN_LEFT = 16384
+
+# the most peers a piece is requested from at once. a second one keeps a
+# slow peer from holding up the end of the fetch
+MAX_REQUESTERS = 2
+
+
+# fetches the info dict of a magnet link from peers (BEP 9). peers come from
+# the link's trackers, the DHT and peer exchange. every peer that has the
+# metadata is asked for up to metadata_queue_depth of its 16 KiB pieces at
+# a time, pieces nobody was asked for first and none from more than two
+# peers at once, so that a large info dict comes from several peers in
+# parallel. once every piece is here the whole is checked against the info
+# hash, and if it doesn't match the pieces are fetched again without the
+# peers that sent them. a peer that rejects a request, or doesn't answer one
+# within metadata_timeout, is dropped.
+#
+# done fires with the metadata, its info now set. it fails with ValueError
+# if the info dict isn't valid, or CancelledError if the fetcher is stopped
+# first.
+class MetadataFetcher(object):
+
+    def __init__(self, meta, session, reactor, settings):
+        self.meta = meta
+        self.session = session
+        self._reactor = reactor
+        self._settings = settings
+        self.done = Deferred()
+        self.tracker = None  # TrackerConnection
+        self._loop = None
+        self._shutdown_trigger = None
+
+        # who to connect to, and the connected peers that have the metadata
+        self.connections = ConnectionManager(self._reactor, self._settings,
+                                             self.make_peer, self.peer_did_connect)
+        self._peers = []
+
+        # the pieces of the info dict: the data of each (None until it's
+        # here) and the address of the peer that sent it, and for pieces
+        # that are requested, the peers asked and when
+        self.size = None
+        self._pieces = []
+        self._senders = []
+        self._requested = {}    # piece -> {PeerConnection: time requested}
+        self._banned = set()    # ips of peers that sent bad pieces
+
+        self._dht_last = None
+        self._dht_lookup = False
+
+    def start(self):
+        logger.info('fetching metadata of %s', self.meta.name().decode('utf-8', 'replace'))
+        self.tracker = TrackerConnection(self.meta, self.session.port, self.session.peer_id,
+                                         self._reactor, self._settings, delegate=self,
+                                         udp_client=self.session.udp_tracker)
+        self.tracker.start().addErrback(self._tracker_failed)
+        self.find_dht_peers()
+
+        self._shutdown_trigger = self._reactor.addSystemEventTrigger('before', 'shutdown',
+                                                                     self.stop)
+        self._loop = LoopingCall(self.timer_tick)
+        self._loop.clock = self._reactor
+        self._loop.start(self._settings.timeout_check_interval, now=False)
+
+    # give up. returns a Deferred that fires once the trackers are told
+    def stop(self):
+        d = self._close()
+        if not self.done.called:
+            self.done.errback(CancelledError('metadata fetch stopped'))
+        return d
+
+    def _close(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        if self._shutdown_trigger is not None:
+            self._reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._shutdown_trigger = None
+        self.connections.stop()
+        if self.tracker is not None:
+            return self.tracker.stop()
+
+    def _tracker_failed(self, failure):
+        logger.error('metadata fetch: %s', failure.getErrorMessage())
+
+    # drop peers that don't answer, and look for more while there are few
+    def timer_tick(self):
+        now = self._reactor.seconds()
+        for piece, requesters in list(self._requested.items()):
+            for peer, requested_at in list(requesters.items()):
+                if now - requested_at > self._settings.metadata_timeout:
+                    logger.info('%s didn\'t send metadata piece %d in time', str(peer.peer_info), piece)
+                    peer.stop()
+
+        if len(self._peers) < self._settings.low_peer_threshold:
+            self.tracker.need_peers()
+        if self._dht_last is None or now - self._dht_last >= self._settings.dht_announce_interval:
+            self.find_dht_peers()
+
+    # look for peers in the DHT. we don't announce ourselves, there's
+    # nothing to get from us yet
+    def find_dht_peers(self):
+        if self.session.dht_port() is None or self._dht_lookup:
+            return
+        self._dht_lookup = True
+        self._dht_last = self._reactor.seconds()
+
+        def done(peers):
+            self._dht_lookup = False
+            logger.info('DHT lookup found %d peers.', len(peers))
+
+        d = self.session.dht.get_peers(self.meta.info_hash(), on_peers=self.tracker_did_return_peers)
+        d.addCallback(done)
+
+    def _set_size(self, size):
+        self.size = size
+        num_pieces = int(math.ceil(size / PeerConnection.METADATA_PIECE_SIZE))
+        self._pieces = [None] * num_pieces
+        self._senders = [None] * num_pieces
+
+    def _piece_size(self, piece):
+        return min(PeerConnection.METADATA_PIECE_SIZE,
+                   self.size - piece * PeerConnection.METADATA_PIECE_SIZE)
+
+    # ask peer for as many pieces as it may have outstanding: ones nobody
+    # was asked for first, then ones asked of one other peer
+    def request_pieces(self, peer):
+        count = self._settings.metadata_queue_depth - len(peer.metadata_requests)
+        if count <= 0:
+            return
+        missing = [piece for piece, data in enumerate(self._pieces)
+                   if data is None and peer not in self._requested.get(piece, ()) and
+                   len(self._requested.get(piece, ())) < MAX_REQUESTERS]
+        missing.sort(key=lambda piece: len(self._requested.get(piece, ())))
+        now = self._reactor.seconds()
+        for piece in missing[:count]:
+            self._requested.setdefault(piece, {})[peer] = now
+            peer.send_metadata_request(piece)
+
+    def request_all(self):
+        for peer in list(self._peers):
+            self.request_pieces(peer)
+
+    # every piece is here: check them against the info hash
+    def _check(self):
+        info = b''.join(self._pieces)
+        if hashlib.sha1(info).digest() != self.meta.info_hash():
+            logger.warning('metadata of %s doesn\'t match its info hash, fetching it again',
+                           self.meta.name().decode('utf-8', 'replace'))
+            self._banned.update(ip for ip, port in self._senders)
+            self._set_size(self.size)
+            for peer in list(self._peers):
+                if peer.peer_info.ip in self._banned:
+                    peer.stop()
+            self.request_all()
+            return
+
+        # it's what the link points to, but not something we can download
+        try:
+            self.meta.set_info(info)
+        except ValueError as e:
+            logger.error('metadata of %s: %s', self.meta.name().decode('utf-8', 'replace'), str(e))
+            self._close()
+            self.done.errback(e)
+            return
+
+        logger.info('fetched metadata of %s, %d bytes from %d peers',
+                    self.meta.name().decode('utf-8', 'replace'), len(info), len(set(self._senders)))
+        self._close()
+        self.done.callback(self.meta)
+
+    ######## TRACKER CALLBACKS  #################
+
+    def tracker_stats(self):
+        return 0, 0, UNKNOWN_LEFT
+
+    def tracker_did_return_peers(self, peers):
+        self.connections.add_peers(peers)
+
+    ######## PEER CALLBACKS  #################
+
+    def make_peer(self, peer_info):
+        peer = PeerConnection(self.meta, peer_info, settings=self._settings, delegate=self)
+        peer.dht_port = self.session.dht_port()
+        return peer
+
+    def peer_did_connect(self, peer):
+        if peer.peer_info.ip in self._banned or not peer.remote_reserved[5] & 0x10:
+            # it can't give us the metadata
+            peer.stop()
+
+    # the peer told us which extensions it supports, and how large the
+    # metadata is if it has it. the first peer to tell decides the size
+    def peer_did_extended_handshake(self, peer):
+        if peer in self._peers or self.done.called:
+            return
+        if not peer.supports_extension(b'ut_metadata') or not peer.metadata_size:
+            peer.stop()
+            return
+        if self.size is None:
+            if peer.metadata_size > self._settings.max_metadata_size:
+                logger.warning('%s says the metadata is %d bytes, too large',
+                               str(peer.peer_info), peer.metadata_size)
+                peer.stop()
+                return
+            self._set_size(peer.metadata_size)
+        elif peer.metadata_size != self.size:
+            logger.info('%s has metadata of a different size', str(peer.peer_info))
+            peer.stop()
+            return
+        self._peers.append(peer)
+        self.request_pieces(peer)
+
+    def peer_did_send_metadata(self, peer, piece, total_size, data):
+        requesters = self._requested.get(piece, {})
+        requesters.pop(peer, None)
+        if total_size != self.size or piece >= len(self._pieces) or len(data) != self._piece_size(piece):
+            logger.info('bad metadata piece %d from %s', piece, str(peer.peer_info))
+            peer.stop()
+            return
+
+        if self._pieces[piece] is None:
+            self._pieces[piece] = data
+            self._senders[piece] = (peer.peer_info.ip, peer.peer_info.port)
+            # the others asked needn't answer any more
+            for other in self._requested.pop(piece, {}):
+                other.metadata_requests.discard(piece)
+            if all(data is not None for data in self._pieces):
+                self._check()
+                return
+        self.request_all()
+
+    def peer_did_reject_metadata(self, peer, piece):
+        logger.info('%s rejected metadata piece %d', str(peer.peer_info), piece)
+        self._requested.get(piece, {}).pop(peer, None)
+        peer.stop()
+
+    def peer_connection_lost(self, peer):
+        self.connections.peer_disconnected(peer)
+        if peer not in self._peers:
+            return
+        self._peers.remove(peer)
+
+        # give back the pieces it was asked for
+        for piece, requesters in list(self._requested.items()):
+            requesters.pop(peer, None)
+            if not requesters:
+                del self._requested[piece]
+        if not self.done.called:
+            self.request_all()
+
+    # a peer with the metadata has pieces too, but we don't know which yet:
+    # it gets nothing from us, and we ask it for nothing but the metadata
+    def peer_did_handshake(self, peer):
+        if peer.fast:
+            peer.send_have_none()
+
+    def peer_did_have(self, peer, piece_id):
+        pass
+
+    def peer_interest_changed(self, peer):
+        pass
+
+    def peer_request_blocks(self, peer, count):
+        return []
+
+    def peer_did_request(self, peer, piece_id, offset, length):
+        return False
+
+    def peer_did_drop_requests(self, peer, blocks):
+        pass
+
+    def peer_did_send_port(self, peer, port):
+        if self.session.dht_port() is not None:
+            self.session.dht.add_node((peer.peer_info.ip, port))
+
+    def peer_did_send_pex(self, peer, added, dropped):
+        self.connections.add_peers([PeerInfo(ip, port) for ip, port in added[:MAX_PEERS]])
@@ -0,0 +1,103 @@
+import logging
+from collections import OrderedDict
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+logger = logging.getLogger('Metrics')
+
+PREFIX = 'yamtorrent_'
+
+
+# a registry of metrics, read in-process with snapshot() or scraped over HTTP
+# in the Prometheus text format (see serve_metrics). nothing is computed at
+# scrape time: every metric is a function returning a value the owner keeps
+# up to date as things happen, either a number or, for labelled metrics, a
+# list of (labels dict, number). labels given to the registry are added to
+# every metric.
+class Metrics(object):
+
+    def __init__(self, labels=None):
+        self.labels = labels if labels else {}
+        self._metrics = []  # (name, type, help, fn)
+
+    def counter(self, name, help, fn):
+        self._metrics.append((PREFIX + name, 'counter', help, fn))
+
+    def gauge(self, name, help, fn):
+        self._metrics.append((PREFIX + name, 'gauge', help, fn))
+
+    # [(name, type, help, [(labels, value)])]
+    def collect(self):
+        result = []
+        for name, kind, help, fn in self._metrics:
+            value = fn()
+            if isinstance(value, (list, tuple)):
+                samples = [(dict(self.labels, **labels), v) for labels, v in value]
+            else:
+                samples = [(self.labels, value)]
+            result.append((name, kind, help, samples))
+        return result
+
+    # name -> value, or for labelled metrics name -> [(labels, value)]
+    def snapshot(self):
+        result = {}
+        for name, kind, help, fn in self._metrics:
+            value = fn()
+            result[name[len(PREFIX):]] = list(value) if isinstance(value, (list, tuple)) else value
+        return result
+
+    def render(self):
+        return render(self.collect())
+
+
+# the Prometheus text format for the result of one or more collect()s.
+# samples of the same metric from several registries are grouped together
+def render(collected):
+    families = OrderedDict()
+    for name, kind, help, samples in collected:
+        if name not in families:
+            families[name] = (kind, help, [])
+        families[name][2].extend(samples)
+
+    lines = []
+    for name, (kind, help, samples) in families.items():
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for labels, value in samples:
+            lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class MetricsResource(Resource):
+
+    isLeaf = True
+
+    # source is anything with a render() method returning the text format
+    def __init__(self, source):
+        Resource.__init__(self)
+        self._source = source
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self._source.render().encode('utf-8')
+
+
+# serve the metrics of source on http://interface:port/ (any path)
+def serve_metrics(reactor, source, port, interface='127.0.0.1'):
+    logger.info('serving metrics on %s:%d', interface, port)
+    return reactor.listenTCP(port, Site(MetricsResource(source)), interface=interface)
@@ -1,6 +1,8 @@
 import sys
+import math
 import struct
-import hashlib
+import socket
+import bencodepy
 from bitstring import BitArray
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred
@@ -8,6 +10,11 @@ from twisted.internet.protocol import ClientFactory, Protocol
 from twisted.internet.endpoints import TCP4ClientEndpoint
 from enum import Enum
 import logging
+from collections import deque
+
+from . import bencode
+from .settings import Settings
+from .messageframer import MessageFramer
 
 logger = logging.getLogger('PeerConnection')
 
@@ -16,21 +23,73 @@ class PeerConnection(object):
 
     PIECE_HASH_SIZE = 20 # BitTorrent standard
     BLOCK_SIZE = 16384 # 16KB
+    MAX_REQUEST_LENGTH = 131072 # larger requests are refused
+    MAX_SUGGESTED = 16 # suggested pieces remembered, the oldest are forgotten
+
+    # extension messages (BEP 10) we understand, and the ids peers are to
+    # send them to us with
+    EXTENSIONS = {b'ut_pex': 1, b'ut_metadata': 2}
+
+    # torrent metadata (BEP 9) is exchanged in pieces of this size
+    METADATA_PIECE_SIZE = 16384
+
+    # ut_metadata message types
+    METADATA_REQUEST = 0
+    METADATA_DATA = 1
+    METADATA_REJECT = 2
 
     class _States(Enum):
         WAIT_CONNECT = 0
         WAIT_HANDSHAKE = 1
         LATER = 2
 
-    def __init__(self, meta, peer_info, protocol=None):
+    def __init__(self, meta, peer_info, protocol=None, settings=None, delegate=None):
         self.meta = meta
         self.peer_info = peer_info
+        self._delegate = delegate
         self.bitfield = None
         self.state = self._States.WAIT_CONNECT
         self._protocol = protocol
         self._bitfield = None
-        self.buf = bytearray()
-        self.piece_deferreds = {}
+        self._settings = settings if settings else Settings()
+        self._reactor = reactor
+        self.framer = MessageFramer()
+        self.remote_peer_id = None
+        self.remote_reserved = bytes(8)
+        self.inbound = False
+
+        # the port of our DHT node, if we have one for this torrent. it's
+        # advertised in the handshake and sent to peers that have one too
+        self.dht_port = None
+
+        # extension protocol: the port we listen on and whether we offer
+        # peer exchange, sent in our extension handshake. from the peer's:
+        # the extensions it supports (name -> the id to send them with),
+        # the port it listens on and its client name
+        self.listen_port = None
+        self.pex = True
+        self.extensions = {}
+        self.remote_listen_port = None
+        self.client = None
+
+        # metadata exchange: the size of the info dict the peer has (from
+        # its extension handshake), and the pieces of it we asked for
+        self.metadata_size = None
+        self.metadata_requests = set()
+
+        # fast extension (BEP 6), if both of us support it: the pieces the
+        # peer lets us request while it chokes us, the ones we let it
+        # request while we choke it, and the pieces it suggested we get
+        self.fast = False
+        self.allowed_fast = set()
+        self.allowed_fast_sent = set()
+        self.suggested = deque()
+        self._suggested_set = set()
+
+        # fires with self once the peer has told us what it has (its bitfield,
+        # or any other message if it has nothing), fails if the connection
+        # doesn't get that far
+        self.done = Deferred()
 
         # need to keep track of choking/interested state for self and peer
         # connections start out as choking and not interested
@@ -39,101 +98,224 @@ class PeerConnection(object):
         self._peer_choking = True
         self._peer_interested = False
 
-        # storing the blocks of the piece we're working on until we get a full piece to
-        # return to TorrentManager (or should we return every block on reciept and have
-        # TorrentManager keep track of blocks in addition to pieces?)
-        # In this model the blocks of a piece are downloaded in order (0 to piece length/BLOCK_SIZE)
-        # self.piece_number = 0
-        # self.next_offset = 0
-        # self.piece_array = bytearray()
-        # self.start_tick = 0
-        self.reset_download_info()
-
-    def reset_download_info(self):
-        self.piece_number = 0
-        self.next_offset = 0
-        self.piece_array = bytearray()
-        self.start_tick = 0
-
-        # vars for the last piece and block
-        self.last_piece_size = 0
-        self.last_block_size = 0
-        self.last_block_number = 0
-        self.last_piece_offset = 0
-
-    # called by TorrentManager to start download when this connection is unchoked
-    def start_piece_download(self, piece_number, start_tick):
-
-        logger.info('starting download piece %i', piece_number)
-        self.send_interested()
-
-        self.reset_download_info()
-        self.piece_number = piece_number
-        self.start_tick = start_tick
-
-
-        if self._peer_choking:
-            logger.warning('piece download requested but I\'m being choked...')
-            return None # return error?
-
-        if self.is_last_piece():
-            logger.info('is last piece')
-            # handle last piece
-            self.calculate_last_piece()
-            # figure out the block size for the initial request
-            if self.last_block_number == 0:
-                initial_block_size = self.last_block_size
-            else:
-                initial_block_size = self.BLOCK_SIZE
-            # send the initial request
-            self.send_request(self.piece_number, self.last_piece_offset, initial_block_size)
-            d = Deferred()
-            self.piece_deferreds[piece_number] = d
-        else:
-            # send initial request
-            self.send_request(self.piece_number, self.next_offset * self.BLOCK_SIZE, self.BLOCK_SIZE)
-            d = Deferred()
-            self.piece_deferreds[piece_number] = d
-            return d
-
-
-    def calculate_last_piece(self):
-        # find out how large last piece is supposed to be: lengthoffile - ((numpieces - 1) * piecesize):
-        self.last_piece_size = self.meta.full_length() - ((self.meta.num_pieces() - 1) * self.meta.piece_length())
-
-        # find out how large last block will be: last_piece_size % BLOCK_SIZE
-        self.last_block_size = self.last_piece_size % self.BLOCK_SIZE
-        # find (zero-based) index of last block
-        self.last_block_number = int(self.last_piece_size / self.BLOCK_SIZE)
-        if self.last_block_size == 0:
-            self.last_block_number = self.last_block_number - 1
-
-
-    # check to see if the current piece number is the last piece in the torrent
-    def is_last_piece(self):
-        piece_num = self.piece_number
-        total_pieces = self.meta.num_pieces()
-        if piece_num == total_pieces - 1:
-            return True
-        else:
-            return False
-
+        # request pipeline. queue_depth blocks are kept requested at once and
+        # the depth adapts to the measured download rate and block round trip
+        # time. which blocks to request is up to the delegate (TorrentManager)
+        self.queue_depth = self._settings.initial_queue_depth
+        self.download_rate = 0.0
+
+        # smoothed block round trip time and its variation (as for TCP, RFC
+        # 6298), used to decide when a request has taken too long. a peer that
+        # keeps missing deadlines is snubbed and only gets one request at a time.
+        # only a request sent into an empty pipeline is timed (the one in
+        # _rtt_probe), the others wait behind our own requests
+        self.srtt = None
+        self.rttvar = None
+        self._rtt_probe = None
+        self.missed_deadlines = 0
+        self.snubbed = False
+        self._rate_bytes = 0
+        self._rate_start = None
+        self.bytes_downloaded = 0
+
+        # the requests in flight: (piece, offset) -> (length, time requested)
+        self.outstanding = {}
+
+        # blocks the peer asked us for, (piece, offset, length) in the order
+        # requested. the one at the front is being read while _reading is set
+        self.upload_queue = deque()
+        self._reading = None
+        self._serving = False
+        self.bytes_uploaded = 0
+
+        # message id -> handler, see handle_message
+        self._handlers = {
+            0: self.rcv_choke,
+            1: self.rcv_unchoke,
+            2: self.rcv_interested,
+            3: self.rcv_notinterested,
+            4: self.rcv_have,
+            5: self.rcv_bitfield,
+            6: self.rcv_request,
+            7: self.rcv_piece,
+            8: self.rcv_cancel,
+            9: self.rcv_port,
+            13: self.rcv_suggest,
+            14: self.rcv_have_all,
+            15: self.rcv_have_none,
+            16: self.rcv_reject,
+            17: self.rcv_allowed_fast,
+            20: self.rcv_extended
+        }
 
-    def get_start_tick(self):
-        return self.start_tick
+    # keep up to queue_depth block requests outstanding, asking the delegate
+    # which blocks to request. while the peer chokes us only its allowed
+    # fast pieces can be requested
+    def fill_pipeline(self):
+        if self._delegate is None or self._protocol is None:
+            return
+        if self._peer_choking and not self.allowed_fast:
+            return
+        count = self.queue_depth - len(self.outstanding)
+        if count <= 0:
+            return
 
-    def get_piece_number(self):
-        return self.piece_number
+        if not self.outstanding:
+            # start a fresh rate sample so idle time isn't counted against the peer
+            self._rate_start = self._reactor.seconds()
+            self._rate_bytes = 0
+
+        now = self._reactor.seconds()
+        for piece_number, offset, length in self._delegate.peer_request_blocks(self, count):
+            if not self.outstanding:
+                self._rtt_probe = (piece_number, offset)
+            self.outstanding[(piece_number, offset)] = (length, now)
+            self.send_request(piece_number, offset, length)
+
+    # the outstanding requests as a list of (piece, offset, length)
+    def outstanding_requests(self):
+        return [(piece_number, offset, length)
+                for (piece_number, offset), (length, requested_at) in self.outstanding.items()]
+
+    # forget every outstanding request and return them. the peer is told
+    # with a cancel message unless it already dropped them itself (choke)
+    def drop_outstanding(self, send_cancel=True):
+        dropped = self.outstanding_requests()
+        if send_cancel:
+            for piece_number, offset, length in dropped:
+                self.send_cancel(piece_number, offset, length)
+        self.outstanding = {}
+        return dropped
+
+    # cancel a single outstanding request, e.g. because another peer sent
+    # the block first (endgame)
+    def cancel_request(self, piece_number, offset):
+        request = self.outstanding.pop((piece_number, offset), None)
+        if request is not None:
+            self.send_cancel(piece_number, offset, request[0])
+
+    # how long a block request may take before it's given to someone else:
+    # the usual srtt + 4 * rttvar, plus the time it takes to receive
+    # everything outstanding at the current rate
+    def request_timeout(self):
+        s = self._settings
+        if self.srtt is None:
+            return s.max_request_timeout
+        timeout = self.srtt + 4 * self.rttvar
+        if self.download_rate:
+            pending = sum(length for length, requested_at in self.outstanding.values())
+            timeout += pending / self.download_rate
+        return max(s.min_request_timeout, min(s.max_request_timeout, timeout))
+
+    # cancel and return the requests that are past their deadline, and
+    # snub the peer if it keeps missing them. every expired block counts, so
+    # a peer that drops a whole pipeline is snubbed at once
+    def expire_requests(self, now):
+        timeout = self.request_timeout()
+        expired = [(piece_number, offset, length)
+                   for (piece_number, offset), (length, requested_at) in self.outstanding.items()
+                   if now - requested_at > timeout]
+        if not expired:
+            return expired
+
+        for piece_number, offset, length in expired:
+            self.cancel_request(piece_number, offset)
+        self.missed_deadlines += len(expired)
+        if not self.snubbed and self.missed_deadlines >= self._settings.snub_threshold:
+            logger.info('%s is snubbing us', str(self.peer_info))
+            self.snubbed = True
+            self.queue_depth = 1
+        return expired
+
+    # called for every block received, updates the round trip time (if the
+    # block is the one being timed) and download rate estimates and resizes
+    # the pipeline
+    def update_rate(self, length, requested_at, timed=False):
+        now = self._reactor.seconds()
+        alpha = self._settings.rate_smoothing
+
+        sample = now - requested_at
+        if timed:
+            self._rtt_probe = None
+            if self.srtt is None:
+                self.srtt = sample
+                self.rttvar = sample / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+                self.srtt = 0.875 * self.srtt + 0.125 * sample
+
+        # a block on time, the peer is back in business
+        if sample <= self.request_timeout():
+            self.missed_deadlines = 0
+            if self.snubbed:
+                logger.info('%s is no longer snubbing us', str(self.peer_info))
+                self.snubbed = False
+                self.adapt_queue_depth()
+
+        self._rate_bytes += length
+        elapsed = now - self._rate_start
+        if elapsed >= self._settings.rate_sample_interval:
+            rate = self._rate_bytes / elapsed
+            if self.download_rate:
+                self.download_rate = (1 - alpha) * self.download_rate + alpha * rate
+            else:
+                self.download_rate = rate
+            self._rate_bytes = 0
+            self._rate_start = now
+            self.adapt_queue_depth()
+
+    # size the pipeline to hold request_queue_time seconds of data at the
+    # current rate (and at least two round trips on high latency links).
+    # srtt doesn't grow with the pipeline, it's timed on an empty one
+    def adapt_queue_depth(self):
+        if self.snubbed:
+            return
+        s = self._settings
+        window = max(s.request_queue_time, 2 * (self.srtt or 0))
+        desired = int(math.ceil(self.download_rate * window / self.BLOCK_SIZE))
+        self.queue_depth = max(s.min_queue_depth, min(s.max_queue_depth, desired))
+        logger.debug('queue depth for %s: %d (rate=%.0f B/s srtt=%.3fs)',
+                     str(self.peer_info), self.queue_depth, self.download_rate, self.srtt or 0)
+
+    # send the blocks the peer asked for, one at a time, reading them through
+    # the delegate. stops while we're choking the peer
+    def serve_requests(self):
+        if self._serving:
+            return
+        self._serving = True
+        try:
+            while (self._reading is None and self.upload_queue and
+                   self._protocol is not None and self._delegate is not None):
+                request = self.upload_queue[0]
+                if self._am_choking and request[0] not in self.allowed_fast_sent:
+                    break
+                self._reading = request
+                d = self._delegate.peer_read_block(self, *request)
+                d.addCallbacks(self._block_read, self._block_read_failed,
+                               callbackArgs=(request,), errbackArgs=(request,))
+        finally:
+            self._serving = False
+
+    def _block_read(self, data, request):
+        self._reading = None
+        # it may have been cancelled (or we choked the peer) meanwhile
+        if self.upload_queue and self.upload_queue[0] == request and self._protocol is not None:
+            self.upload_queue.popleft()
+            self.send_piece(request[0], request[1], data)
+        self.serve_requests()
+
+    def _block_read_failed(self, failure, request):
+        logger.error('could not read piece %d offset %d for %s: %s', request[0], request[1],
+                     str(self.peer_info), str(failure.value))
+        self._reading = None
+        if self.upload_queue and self.upload_queue[0] == request:
+            self.upload_queue.popleft()
+        self.serve_requests()
 
     # returns whether the piece is in our bitfield
     def piece_in_bitfield(self, piece_number):
         return self._bitfield[piece_number]
 
-    # should callback to TorrentManager
-    # called when a piece is complete. the piece is in piece_array
-    def piece_downloaded(self, piece_number, piece_array):
-        self.piece_deferreds[piece_number].callback((self, piece_number, piece_array))
-
     def am_choking(self):
         return self._am_choking
 
@@ -146,45 +328,68 @@ class PeerConnection(object):
     def peer_interested(self):
         return self._peer_interested
 
-    def connect(self, reactor):
+    def connect(self, reactor, timeout=30):
         logger.debug('calling connect')
-        self.done = Deferred()
-        d = (TCP4ClientEndpoint(reactor, self.peer_info.ip, self.peer_info.port)
+        self._reactor = reactor
+        d = (TCP4ClientEndpoint(reactor, self.peer_info.ip, self.peer_info.port, timeout)
              .connect(ProtocolAdapterFactory(self)))
         d.addErrback(lambda res: self.connection_failed(res))
         self.state = self._States.WAIT_CONNECT
 
         return self.done
 
+    def send_handshake(self):
+        reserved = bytearray(8)
+        reserved[5] |= 0x10
+        reserved[7] |= 0x04
+        if self.dht_port:
+            reserved[7] |= 0x01
+        msg = struct.pack('!B', 19) + b"BitTorrent protocol" + reserved + self.meta.info_hash() + self.meta.peer_id
+        self._protocol.tx_data(msg)
+
     def request_handshake(self):
         logger.debug('request_handshake()')
-        msg = struct.pack('!B', 19) + b"BitTorrent protocol" + bytearray(8) + self.meta.info_hash() + self.meta.peer_id
-        self._protocol.tx_data(msg)
+        self.send_handshake()
         self.state = self._States.WAIT_HANDSHAKE
 
+    # returns whether the handshake is for our torrent
     def rcv_handshake(self, data):
         logger.info('rcv_handshake: len = %d', len(data))
-        pass
+        pstrlen = data[0]
+        pstr = data[1:pstrlen + 1]
+        info_hash = data[pstrlen + 9:pstrlen + 29]
+
+        # check that this is the handshake receipt
+        if (pstr != b"BitTorrent protocol") or (info_hash != self.meta.info_hash()):
+            logger.info('bad handshake from %s, dropping connection', str(self.peer_info))
+            return False
+
+        self.remote_peer_id = bytes(data[pstrlen + 29:pstrlen + 49])
+        self.remote_reserved = bytes(data[pstrlen + 1:pstrlen + 9])
+        self.fast = bool(self.remote_reserved[7] & 0x04)
+        self.state = self._States.LATER
+        logger.debug('handshake match.')
+        return True
+
+    # bitfield is a BitArray of the pieces we have, sent right after the
+    # handshake
+    def send_bitfield(self, bitfield):
+        logger.debug('send_bitfield to %s', str(self.peer_info))
+        payload = bitfield.tobytes()
+        msg = struct.pack('!IB', len(payload) + 1, 5) + payload
+        self._protocol.tx_data(msg)
+
+    def send_have(self, piece_number):
+        logger.debug('send_have %d to %s', piece_number, str(self.peer_info))
+        msg = struct.pack('!IBI', 5, 4, piece_number)
+        self._protocol.tx_data(msg)
+
+    def send_piece(self, piece_number, offset, block):
+        logger.debug('send_piece piece %d offset=%d length=%d to %s', piece_number, offset, len(block), str(self.peer_info))
+        msg = struct.pack('!IBII', len(block) + 9, 7, piece_number, offset) + block
+        self._protocol.tx_data(msg)
+        self.bytes_uploaded += len(block)
 
-    # NOT USING RIGHT NOW
-    def send_bitfield(self):
-        # construct message
-        msg = bytearray(2)
-        # self.transport.write(msg)
-        # self.state = self._States.WAIT_BITFIELD
-
-
-    # Once a piece is downloaded, validate it using the hash in torrent file before returning to TorrentManager
-    def validate_piece(self, piece_array):
-        thishash = hashlib.sha1(piece_array).digest()
-        start = self.piece_number * self.PIECE_HASH_SIZE
-        if thishash == self.meta.piece_hashes()[start:start + self.PIECE_HASH_SIZE]:
-            logger.info('validating piece %i: hash matched!', self.piece_number)
-            self.piece_downloaded(self.piece_number, piece_array)
-        else:
-            logger.info('validating piece %i: hash did not match!', self.piece_number)
-            # restart piece download? disconnect?
-        pass
 
     def send_request(self, piece_number, offset, length):
         logger.debug('send_request piece %d  offset=%d  length=%d to %s', piece_number, offset, length, str(self.peer_info))
@@ -205,14 +410,21 @@ class PeerConnection(object):
         msg = struct.pack('!I', 1) + struct.pack('!B', 0)
         self._protocol.tx_data(msg)
         self._am_choking = True
-        pass
+
+        # choking discards the peer's requests. with the fast extension the
+        # peer is told, and requests for allowed fast pieces are still served
+        if self.fast:
+            for request in [r for r in self.upload_queue if r[0] not in self.allowed_fast_sent]:
+                self.upload_queue.remove(request)
+                self.send_reject(*request)
+        else:
+            self.upload_queue.clear()
 
     def send_unchoke(self):
         logger.info('send_unchoke to %s', str(self.peer_info))
         msg = struct.pack('!I', 1) + struct.pack('!B', 1)
         self._protocol.tx_data(msg)
         self._am_choking = False
-        pass
 
     def send_interested(self):
         logger.info('send_interested to %s', str(self.peer_info))
@@ -227,15 +439,82 @@ class PeerConnection(object):
         self._am_interested = False
         pass
 
-    # self.send_request(self.piece_number, self.next_offset * self.BLOCK_SIZE, self.BLOCK_SIZE)
+    def send_port(self, port):
+        logger.debug('send_port %d to %s', port, str(self.peer_info))
+        msg = struct.pack('!IBH', 3, 9, port)
+        self._protocol.tx_data(msg)
+
+    def send_have_all(self):
+        logger.debug('send_have_all to %s', str(self.peer_info))
+        self._protocol.tx_data(struct.pack('!IB', 1, 14))
 
-    def cancel_current_download(self):
-        self.send_cancel(self.piece_number, self.next_offset * self.BLOCK_SIZE, self.BLOCK_SIZE)
-        # self.piece_deferreds[self.piece_number].errback(CancelError("piece number " + str(self.piece_number) + "was cancelled"))
-        self.piece_deferreds.pop(self.piece_number,None)
+    def send_have_none(self):
+        logger.debug('send_have_none to %s', str(self.peer_info))
+        self._protocol.tx_data(struct.pack('!IB', 1, 15))
 
-        self.reset_download_info()
+    def send_reject(self, piece_number, offset, length):
+        logger.debug('send_reject piece %d offset=%d length=%d to %s', piece_number, offset, length, str(self.peer_info))
+        self._protocol.tx_data(struct.pack('!IBIII', 13, 16, piece_number, offset, length))
 
+    # let the peer request piece_number while we choke it
+    def send_allowed_fast(self, piece_number):
+        logger.debug('send_allowed_fast %d to %s', piece_number, str(self.peer_info))
+        self._protocol.tx_data(struct.pack('!IBI', 5, 17, piece_number))
+        self.allowed_fast_sent.add(piece_number)
+
+    def send_suggest(self, piece_number):
+        logger.debug('send_suggest %d to %s', piece_number, str(self.peer_info))
+        self._protocol.tx_data(struct.pack('!IBI', 5, 13, piece_number))
+
+    def send_extended(self, extension_id, payload):
+        msg = struct.pack('!IBB', len(payload) + 2, 20, extension_id) + payload
+        self._protocol.tx_data(msg)
+
+    def send_extended_handshake(self):
+        logger.debug('send_extended_handshake to %s', str(self.peer_info))
+        m = dict((name, extension_id) for name, extension_id in self.EXTENSIONS.items()
+                 if name != b'ut_pex' or self.pex)
+        handshake = {b'm': m, b'v': b'YamTorrent', b'reqq': self._settings.max_upload_queue}
+        if self.listen_port:
+            handshake[b'p'] = self.listen_port
+        if self.meta.has_info():
+            handshake[b'metadata_size'] = len(self.meta.info_bytes())
+        self.send_extended(0, bencodepy.encode(handshake))
+
+    def supports_extension(self, name):
+        return name in self.extensions
+
+    # added is a list of ((ip, port), flags), dropped a list of (ip, port)
+    def send_pex(self, added, dropped):
+        logger.debug('send_pex %d added %d dropped to %s', len(added), len(dropped),
+                     str(self.peer_info))
+        message = {b'added': b''.join(_compact(address) for address, flags in added),
+                   b'added.f': bytes(flags for address, flags in added),
+                   b'dropped': b''.join(_compact(address) for address in dropped)}
+        self.send_extended(self.extensions[b'ut_pex'], bencodepy.encode(message))
+
+    # ask for piece of the info dict, the answer goes to the delegate's
+    # peer_did_send_metadata or peer_did_reject_metadata
+    def send_metadata_request(self, piece):
+        logger.debug('send_metadata_request %d to %s', piece, str(self.peer_info))
+        self.metadata_requests.add(piece)
+        message = {b'msg_type': self.METADATA_REQUEST, b'piece': piece}
+        self.send_extended(self.extensions[b'ut_metadata'], bencodepy.encode(message))
+
+    # answer a request for piece of the info dict, with the data if we have
+    # it
+    def send_metadata(self, piece):
+        info = self.meta.info_bytes() if self.meta.has_info() else b''
+        start = piece * self.METADATA_PIECE_SIZE
+        if start >= len(info):
+            logger.debug('send_metadata reject %d to %s', piece, str(self.peer_info))
+            message = {b'msg_type': self.METADATA_REJECT, b'piece': piece}
+            self.send_extended(self.extensions[b'ut_metadata'], bencodepy.encode(message))
+            return
+        logger.debug('send_metadata %d to %s', piece, str(self.peer_info))
+        message = {b'msg_type': self.METADATA_DATA, b'piece': piece, b'total_size': len(info)}
+        data = info[start:start + self.METADATA_PIECE_SIZE]
+        self.send_extended(self.extensions[b'ut_metadata'], bencodepy.encode(message) + bytes(data))
 
     def send_cancel(self, piece_number, offset, length):
         logger.info('send_cancel piece %d offset=%d length=%d to %s', piece_number, offset, length, str(self.peer_info))
@@ -252,23 +531,33 @@ class PeerConnection(object):
     def rcv_choke(self, msg, msg_length):
         logger.info('rcv_choke %d', msg_length)
         self._peer_choking = True
-        pass
+
+        # a fast peer rejects each request it drops
+        if self.fast:
+            return
+
+        # a choking peer discards our pending requests, let others have them
+        dropped = self.drop_outstanding(send_cancel=False)
+        if dropped and self._delegate is not None:
+            self._delegate.peer_did_drop_requests(self, dropped)
 
     def rcv_unchoke(self, msg, msg_length):
         logger.info('rcv_unchoke %d', msg_length)
         self._peer_choking = False
 
-        pass
+        self.fill_pipeline()
 
     def rcv_interested(self, msg, msg_length):
         logger.info('rcv_interested %d', msg_length)
         self._peer_interested = True
-        pass
+        if self._delegate is not None:
+            self._delegate.peer_interest_changed(self)
 
     def rcv_notinterested(self, msg, msg_length):
         logger.info('rcv_notinterested %d', msg_length)
         self._peer_interested = False
-        pass
+        if self._delegate is not None:
+            self._delegate.peer_interest_changed(self)
 
     def rcv_have(self, msg, msg_length):
         logger.debug('rcv_have %d', msg_length)
@@ -276,15 +565,37 @@ class PeerConnection(object):
         # update bitfield to reflect
         have_id = struct.unpack("!I",msg[1:msg_length])[0]
         try:
+            if self._bitfield[have_id]:
+                return
             self._bitfield[have_id] = 1
         except TypeError:
             logger.warning('Received have for client that did not send a valid bitfield.')
-            pass
+            return
+        except IndexError:
+            logger.warning('Received have for invalid piece %d.', have_id)
+            return
+
+        if self._delegate is not None:
+            self._delegate.peer_did_have(self, have_id)
+
+    def rcv_have_all(self, msg, msg_length):
+        if not self.fast:
+            logger.info('have_all from %s, which doesn\'t do the fast extension', str(self.peer_info))
+            return
+        bitfield = BitArray(self.meta.num_pieces())
+        bitfield.invert()
+        self._set_bitfield(bitfield)
+
+    def rcv_have_none(self, msg, msg_length):
+        if not self.fast:
+            logger.info('have_none from %s, which doesn\'t do the fast extension', str(self.peer_info))
+            return
+        self._set_bitfield(BitArray(self.meta.num_pieces()))
 
     def rcv_bitfield(self, msg, msg_length):
-        # parse bitfield
-        bitfield = BitArray(bytes=msg[1:msg_length])
+        self._set_bitfield(BitArray(bytes=bytes(msg[1:msg_length])))
 
+    def _set_bitfield(self, bitfield):
         # validate bitfield
         def validate_bitfield(bitfield):
             num_pieces = self.meta.num_pieces()
@@ -295,115 +606,203 @@ class PeerConnection(object):
                 return False
             return True
 
+        if self.done.called:
+            # some clients send the extension handshake first, which made us
+            # take the peer for having nothing. what it has is news
+            if self._bitfield is not None and validate_bitfield(bitfield):
+                for piece_number in bitfield[0:self.meta.num_pieces()].findall([1]):
+                    if not self._bitfield[piece_number]:
+                        self._bitfield[piece_number] = 1
+                        if self._delegate is not None:
+                            self._delegate.peer_did_have(self, piece_number)
+            return
+
         if validate_bitfield(bitfield):
             self._bitfield = bitfield
         else:
             self._bitfield = None
 
-        self.done.callback(self)
+        if not self.done.called:
+            self.done.callback(self)
 
     def rcv_request(self, msg, msg_length):
-        logger.info('rcv_request %d', msg_length)
-        pass
+        piece_number, offset, length = struct.unpack('!III', msg[1:13])
+        logger.debug('rcv_request piece %d offset=%d length=%d', piece_number, offset, length)
+
+        request = (piece_number, offset, length)
+        if self._delegate is None or request in self.upload_queue:
+            return
+        if self._am_choking and piece_number not in self.allowed_fast_sent:
+            logger.debug('ignoring request from choked peer %s', str(self.peer_info))
+            return self._refuse(request)
+        if length == 0 or length > self.MAX_REQUEST_LENGTH:
+            logger.warning('refusing request of %d bytes from %s', length, str(self.peer_info))
+            return self._refuse(request)
+        if len(self.upload_queue) >= self._settings.max_upload_queue:
+            return self._refuse(request)
+        if not self._delegate.peer_did_request(self, piece_number, offset, length):
+            logger.info('refusing request for piece %d offset %d from %s', piece_number, offset, str(self.peer_info))
+            return self._refuse(request)
+
+        self.upload_queue.append(request)
+        self.serve_requests()
+
+    # a request we won't serve. fast peers are told so
+    def _refuse(self, request):
+        if self.fast:
+            self.send_reject(*request)
 
     def rcv_piece(self, msg, msg_length):
         piece_number = int.from_bytes(msg[1:5], 'big')
         offset = int.from_bytes(msg[5:9], 'big')
-        logger.debug('rcv_piece: id={} off={} len={}'.format(piece_number, offset, msg_length - 1))
-
-        # handle last pieces separately
-        if self.is_last_piece():
-            # append if it is the block we are looking for
-            if offset == self.last_piece_offset:
-                self.piece_array = self.piece_array + msg[9:]
-                # calculate the next offset
-                self.last_piece_offset = self.last_piece_offset + self.BLOCK_SIZE
-            else:
-                logger.debug('recieved offset=%d wanted offset=%d', offset, self.last_piece_offset)
-
-            # check to see if the piece is complete. otherwise request the next piece
-            if (self.last_piece_offset >= self.last_piece_size): # then piece is complete
-                logger.info('piece number %d complete', piece_number)
-                self.validate_piece(self.piece_array)
-            elif self._am_interested and not self._peer_choking:
-                # figure out the length to request. min(BLOCK_SIZE, piece_length - next_offset)
-                request_length = min(self.BLOCK_SIZE, self.last_piece_size - self.last_piece_offset)
-                self.send_request(self.piece_number, self.last_piece_offset, request_length)
-            return
+        logger.debug('rcv_piece: id={} off={} len={}'.format(piece_number, offset, msg_length - 9))
 
+        request = self.outstanding.pop((piece_number, offset), None)
+        if request is None:
+            logger.debug('received unrequested block piece=%d offset=%d', piece_number, offset)
+            return
 
-        # append to piece if it is the block we were looking for
-        if offset == self.next_offset * self.BLOCK_SIZE:
-            self.piece_array = self.piece_array + msg[9:]
-            self.next_offset = self.next_offset + 1
-        else:
-            logger.debug('recieved offset=%d wanted offset=%d', offset, self.next_offset * self.BLOCK_SIZE)
+        length, requested_at = request
+        block = msg[9:msg_length]
+        if len(block) != length:
+            logger.warning('received block of length %d, wanted %d', len(block), length)
+            self._delegate.peer_did_drop_requests(self, [(piece_number, offset, length)])
+            self.fill_pipeline()
+            return
 
-        # check to see if piece is complete. otherwise request the next piece if we can
-        if (self.next_offset * self.BLOCK_SIZE) >= self.meta.piece_length():
-            logger.info('piece number %d complete', piece_number)
-            self.validate_piece(self.piece_array)
-        elif self._am_interested and not self._peer_choking:
-            self.send_request(self.piece_number, self.next_offset * self.BLOCK_SIZE, self.BLOCK_SIZE)
+        self.bytes_downloaded += length
+        self.update_rate(length, requested_at, (piece_number, offset) == self._rtt_probe)
+        self._delegate.peer_did_receive_block(self, piece_number, offset, block)
+        self.fill_pipeline()
 
 
     def rcv_cancel(self, msg, msg_length):
-        logger.info('rcv_cancel %d', msg_length)
-        pass
+        request = struct.unpack('!III', msg[1:13])
+        logger.debug('rcv_cancel piece %d offset=%d length=%d', *request)
+        try:
+            self.upload_queue.remove(request)
+        except ValueError:
+            return
+        # a fast peer gets an answer to every request
+        if self.fast:
+            self.send_reject(*request)
+
+    def rcv_suggest(self, msg, msg_length):
+        piece_number = struct.unpack('!I', msg[1:5])[0]
+        logger.debug('rcv_suggest %d from %s', piece_number, str(self.peer_info))
+        if not self.fast:
+            logger.info('suggest from %s, which doesn\'t do the fast extension', str(self.peer_info))
+            return
+        if piece_number < self.meta.num_pieces() and piece_number not in self._suggested_set:
+            if len(self.suggested) >= self.MAX_SUGGESTED:
+                self._suggested_set.discard(self.suggested.popleft())
+            self.suggested.append(piece_number)
+            self._suggested_set.add(piece_number)
+
+    def rcv_reject(self, msg, msg_length):
+        piece_number, offset, length = struct.unpack('!III', msg[1:13])
+        logger.debug('rcv_reject piece %d offset=%d length=%d', piece_number, offset, length)
+        request = self.outstanding.pop((piece_number, offset), None)
+        if request is not None and self._delegate is not None:
+            self._delegate.peer_did_drop_requests(self, [(piece_number, offset, request[0])])
+
+    def rcv_allowed_fast(self, msg, msg_length):
+        piece_number = struct.unpack('!I', msg[1:5])[0]
+        logger.debug('rcv_allowed_fast %d from %s', piece_number, str(self.peer_info))
+        if self.fast and piece_number < self.meta.num_pieces():
+            self.allowed_fast.add(piece_number)
+            self.fill_pipeline()
 
     def rcv_port(self, msg, msg_length):
-        logger.info('rcv_port %d', msg_length)
-        pass
-
-    def process_buf(self):
-        # if this should a received handshake
-        if (len(self.buf) > 0) and (len(self.buf) >= 49 + self.buf[0]) and (self.state == self._States.WAIT_HANDSHAKE):
-
-            pstrlen = self.buf[0]
-            pstr = self.buf[1:pstrlen + 1]
-            reserved = self.buf[pstrlen + 1:pstrlen + 9]
-            info_hash = self.buf[pstrlen + 9:pstrlen+29]
-            peer_id = self.buf[pstrlen+29:pstrlen+49]
-
-            # check that this is the handshake receipt
-            if (pstr == b"BitTorrent protocol") and (info_hash == self.meta.info_hash()):
-
-                self.state = self._States.LATER
-                data = self.buf[:pstrlen+49]
-
-                self.buf = self.buf[pstrlen+49:]
-                logger.debug('handshake match.')
-
-                return data, 0
-
-            else:
-                logger.info('PROBABLY SHOULD DROP CONNECTION B/C BAD HANDSHAKE')
-
-        # if we don't even have a length at the start
-        if len(self.buf) < 4:
-            return None, 0
-
-        msg_length = struct.unpack("!I", self.buf[:4])[0]
-
-        # if we have the full message in the buffer
-        if len(self.buf) >= 4 + msg_length:
-            data = self.buf[:msg_length+4]
-
-            # remove message from buffer
-            self.buf = self.buf[msg_length+4:]
+        if msg_length != 3:
+            return
+        port = struct.unpack('!H', msg[1:3])[0]
+        logger.debug('rcv_port %d from %s', port, str(self.peer_info))
+        if port and self._delegate is not None:
+            self._delegate.peer_did_send_port(self, port)
 
-            return data, msg_length
+    def rcv_extended(self, msg, msg_length):
+        if msg_length < 2:
+            return
+        extension_id = msg[1]
+        # ut_metadata data follows its dict in the same message
+        data = bytes(msg[2:msg_length])
+        try:
+            payload, end = bencode.decode_at(data)
+        except bencode.BencodeError:
+            logger.info('bad extension message from %s', str(self.peer_info))
+            return
+        if not isinstance(payload, dict):
+            return
 
+        if extension_id == 0:
+            self.rcv_extended_handshake(payload)
+        elif extension_id == self.EXTENSIONS[b'ut_pex'] and self.pex:
+            self.rcv_pex(payload)
+        elif extension_id == self.EXTENSIONS[b'ut_metadata']:
+            self.rcv_metadata(payload, data[end:])
+        else:
+            logger.info('received unknown extension message %d', extension_id)
+
+    def rcv_extended_handshake(self, handshake):
+        m = handshake.get(b'm')
+        if isinstance(m, dict):
+            # later handshakes may add extensions, or turn them off with id 0
+            for name, extension_id in m.items():
+                if isinstance(extension_id, int) and 0 < extension_id < 256:
+                    self.extensions[name] = extension_id
+                else:
+                    self.extensions.pop(name, None)
+        port = handshake.get(b'p')
+        if isinstance(port, int) and 0 < port < 65536:
+            self.remote_listen_port = port
+        if isinstance(handshake.get(b'v'), bytes):
+            self.client = handshake[b'v'].decode('utf-8', 'replace')
+        size = handshake.get(b'metadata_size')
+        if isinstance(size, int) and size > 0:
+            self.metadata_size = size
+        logger.debug('rcv_extended_handshake from %s: %s', str(self.peer_info),
+                     ', '.join(name.decode('utf-8', 'replace') for name in self.extensions))
+        if self._delegate is not None:
+            self._delegate.peer_did_extended_handshake(self)
 
-        # can't figure out this line, but it fails if there's not enough left
-        try:
-            if self.buf[4] != 7:
-                logger.debug('process_buf[unhandled] len=%d want=%d type=%d', len(self.buf), msg_length, self.buf[4])
-        except IndexError:
-            logger.warning('not enough in buffer to check type')
+    def rcv_pex(self, message):
+        added = message.get(b'added', b'')
+        dropped = message.get(b'dropped', b'')
+        if not isinstance(added, bytes) or not isinstance(dropped, bytes):
+            return
+        logger.debug('rcv_pex %d added %d dropped from %s', len(added) // 6, len(dropped) // 6,
+                     str(self.peer_info))
+        if self._delegate is not None:
+            self._delegate.peer_did_send_pex(self, _uncompact(added), _uncompact(dropped))
 
-        return None, 0
+    def rcv_metadata(self, message, data):
+        msg_type = message.get(b'msg_type')
+        piece = message.get(b'piece')
+        if not isinstance(piece, int) or piece < 0:
+            return
+        if msg_type == self.METADATA_REQUEST:
+            if b'ut_metadata' in self.extensions:
+                self.send_metadata(piece)
+            return
 
+        # answers to requests we didn't make are ignored
+        if piece not in self.metadata_requests:
+            return
+        self.metadata_requests.discard(piece)
+        if msg_type == self.METADATA_DATA:
+            total_size = message.get(b'total_size')
+            logger.debug('rcv_metadata %d (%d bytes) from %s', piece, len(data), str(self.peer_info))
+            if self._delegate is not None:
+                self._delegate.peer_did_send_metadata(self, piece, total_size, data)
+        elif msg_type == self.METADATA_REJECT:
+            logger.debug('rcv_metadata reject %d from %s', piece, str(self.peer_info))
+            if self._delegate is not None:
+                self._delegate.peer_did_reject_metadata(self, piece)
+
+    # msg is a view of one complete message, including its length prefix.
+    # it is only valid for the duration of the call, handlers that keep
+    # any part of it must copy it
     def handle_message(self, msg, msg_length):
         # if this is a keep-alive
         if msg_length == 0:
@@ -412,61 +811,96 @@ class PeerConnection(object):
 
         msg_type = msg[4]
 
-        options = {
-            0: self.rcv_choke,
-            1: self.rcv_unchoke,
-            2: self.rcv_interested,
-            3: self.rcv_notinterested,
-            4: self.rcv_have,
-            5: self.rcv_bitfield,
-            6: self.rcv_request,
-            7: self.rcv_piece,
-            8: self.rcv_cancel,
-            9: self.rcv_port
-        }
+        # the bitfield (or have all/none) is optional, a peer without pieces
+        # may skip it
+        if msg_type not in (5, 14, 15) and not self.done.called:
+            self._bitfield = BitArray(self.meta.num_pieces())
+            self.done.callback(self)
 
         try:
-            options[msg_type](msg[4:], msg_length)
+            handler = self._handlers[msg_type]
         except KeyError:
             logger.info('received unknown message_id %d', msg_type)
+            return None
+        handler(msg[4:], msg_length)
 
     # this is called async by your event loop
     def rx_data(self, data):
+        self.framer.feed(data)
+
+        # handle every complete message in the buffer
+        while self._protocol is not None:
+            if self.state == self._States.WAIT_HANDSHAKE:
+                msg = self.framer.next_handshake()
+                if msg is None:
+                    break
+                ok = self.rcv_handshake(msg)
+                msg.release()
+                if not ok:
+                    self.stop()
+                    break
+                if self.inbound:
+                    self.send_handshake()
+                if self._delegate is not None:
+                    self._delegate.peer_did_handshake(self)
+                if self.remote_reserved[5] & 0x10 and self._protocol is not None:
+                    self.send_extended_handshake()
+                if self.dht_port and self.remote_reserved[7] & 0x01 and self._protocol is not None:
+                    self.send_port(self.dht_port)
+            else:
+                msg = self.framer.next_message()
+                if msg is None:
+                    break
+                self.handle_message(msg, len(msg) - 4)
+                msg.release()
 
-        self.buf += data
-
-        next_message, msg_length = self.process_buf()
-
-        if next_message is not None:
-            self.handle_message(next_message, msg_length)
-
-            # check if there are more messages
-            self.rx_data(bytearray())
-
-        # # parse data here
-        # if self.state == self._States.WAIT_HANDSHAKE:
-        #     self.rcv_handshake(data)
-        #     self.request_bitfield()
-        # elif self.state == self._States.WAIT_BITFIELD:
-        #     self.rcv_bitfield(data)
-        # else:
-        #     # unknown message
-        #     pass
+        self.framer.compact()
 
     def did_connect(self, protocol):
         self._protocol = protocol
         self.request_handshake()
 
+    # a connection the peer made to us, it sends its handshake first and we
+    # answer it
+    def did_accept(self, protocol, reactor):
+        self._reactor = reactor
+        self._protocol = protocol
+        self.inbound = True
+        self.state = self._States.WAIT_HANDSHAKE
+
+    def stop(self):
+        if self._protocol is not None:
+            self._protocol.stop()
+            self._protocol = None
+
     def connection_lost(self):
         logger.info('connection with {} lost!'.format(self.peer_info))
+        self._protocol = None
+        if not self.done.called:
+            self.done.errback(ConnectionError('connection lost before the handshake completed'))
+        if self._delegate is not None:
+            self._delegate.peer_connection_lost(self)
 
     def connection_failed(self, result):
         logger.info('failed to connect to peer {}!'.format(self.peer_info))
+        if not self.done.called:
+            self.done.errback(result)
 
     # Properties
     def get_bitfield(self):
         return self._bitfield
 
+# (ip, port) in the compact 6 byte form, and back
+def _compact(address):
+    return socket.inet_aton(address[0]) + struct.pack('!H', address[1])
+
+
+def _uncompact(data):
+    return [(socket.inet_ntoa(ip), port)
+            for ip, port in struct.iter_unpack('!4sH', data[:len(data) - len(data) % 6])
+            if port]
+
+
 class ProtocolAdapter(Protocol):
 
     def __init__(self, delegate):
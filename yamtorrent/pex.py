@@ -0,0 +1,91 @@
+import logging
+
+logger = logging.getLogger('PeerExchange')
+
+# the most peers added or dropped in one message, either way
+MAX_PEERS = 50
+
+# added.f flag: we connected to the peer, so it accepts connections
+CONNECTABLE = 0x10
+
+
+# peer exchange (BEP 11). every peer that supports it is told which peers
+# we're connected to, first all of them and then what changed, at most once
+# every pex_interval seconds. peers telling us about others more often than
+# every half interval are ignored, and of what they send only peers we
+# aren't connected to already are taken.
+class PeerExchange(object):
+
+    def __init__(self, reactor, settings):
+        self._reactor = reactor
+        self._settings = settings
+        self._sent = {}             # peer -> addresses it has from us
+        self._last_sent = {}        # peer -> time
+        self._last_received = {}    # peer -> time
+
+        # monitoring
+        self.peers_received = 0
+
+    # the address others can reach a peer at: the one we connected to, or
+    # the listen port it gave in its extension handshake
+    def address(self, peer):
+        if not peer.inbound:
+            return (peer.peer_info.ip, peer.peer_info.port)
+        if peer.remote_listen_port:
+            return (peer.peer_info.ip, peer.remote_listen_port)
+        return None
+
+    # tell every peer what changed since last time
+    def run(self, peers):
+        for peer in peers:
+            self.update(peer, peers)
+
+    # tell peer about peers it hasn't heard of from us yet, and the ones
+    # we're no longer connected to, if it's due a message
+    def update(self, peer, peers):
+        if not peer.supports_extension(b'ut_pex'):
+            return
+        now = self._reactor.seconds()
+        last = self._last_sent.get(peer)
+        if last is not None and now - last < self._settings.pex_interval:
+            return
+
+        current = {}
+        for other in peers:
+            address = self.address(other)
+            if other is not peer and address is not None:
+                current[address] = 0 if other.inbound else CONNECTABLE
+        sent = self._sent.get(peer, set())
+        added = [(address, flags) for address, flags in current.items()
+                 if address not in sent][:MAX_PEERS]
+        dropped = [address for address in sent if address not in current][:MAX_PEERS]
+        if not added and not dropped:
+            return
+
+        peer.send_pex(added, dropped)
+        self._sent[peer] = (sent | set(address for address, flags in added)) - set(dropped)
+        self._last_sent[peer] = now
+
+    # peer told us about others. returns the ones worth connecting to, as
+    # (ip, port)
+    def received(self, peer, added, peers):
+        now = self._reactor.seconds()
+        last = self._last_received.get(peer)
+        self._last_received[peer] = now
+        if last is not None and now - last < self._settings.pex_interval / 2:
+            logger.info('ignoring peer exchange flood from %s', str(peer.peer_info))
+            return []
+
+        connected = set(self.address(other) for other in peers)
+        result = []
+        for address in added[:MAX_PEERS]:
+            if address not in connected:
+                connected.add(address)
+                result.append(address)
+        self.peers_received += len(result)
+        return result
+
+    def forget(self, peer):
+        self._sent.pop(peer, None)
+        self._last_sent.pop(peer, None)
+        self._last_received.pop(peer, None)
@@ -0,0 +1,112 @@
+import logging
+from collections import OrderedDict
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThreadPool
+
+logger = logging.getLogger('PieceCache')
+
+
+# keeps recently read pieces in memory for serving block requests, so a
+# piece requested block by block (usually by several peers) is read from
+# disk once. whole pieces are read on the reactor's thread pool and the
+# least recently used ones are evicted once more than max_bytes are cached.
+#
+# when a reader asks for the piece right after the last one it asked for,
+# the next read_ahead pieces are read as well, those of them we have.
+# pieces whose data changes (they're downloaded, or fail verification) must
+# be discarded.
+class PieceCache(object):
+
+    def __init__(self, reactor, read, piece_size, num_pieces, max_bytes=16 << 20, read_ahead=2,
+                 has_piece=None):
+        self._reactor = reactor
+        self._read = read                # read(piece_id, offset, length), thread safe
+        self._piece_size = piece_size    # piece_size(piece_id)
+        self._has_piece = has_piece      # has_piece(piece_id), every piece if None
+        self.num_pieces = num_pieces
+        self.max_bytes = max_bytes
+        self.read_ahead = read_ahead
+
+        self._pieces = OrderedDict()     # piece_id -> bytes, least recently used first
+        self._loading = {}               # piece_id -> Deferreds waiting for the read
+        self._stale = set()              # pieces discarded while being read
+        self._last_piece = {}            # reader -> last piece it read
+        self.size = 0
+
+        # monitoring
+        self.hits = 0
+        self.misses = 0
+
+    # returns a Deferred firing with length bytes at offset in a piece
+    def read(self, piece_id, offset, length, reader=None):
+        if reader is not None:
+            last = self._last_piece.get(reader)
+            self._last_piece[reader] = piece_id
+            if last == piece_id - 1:
+                for ahead in range(piece_id + 1, min(piece_id + 1 + self.read_ahead, self.num_pieces)):
+                    if self._has_piece is None or self._has_piece(ahead):
+                        self._load(ahead)
+
+        data = self._pieces.get(piece_id)
+        if data is not None:
+            self.hits += 1
+            self._pieces.move_to_end(piece_id)
+            return succeed(data[offset:offset + length])
+
+        self.misses += 1
+        d = Deferred()
+        d.addCallback(lambda data: data[offset:offset + length])
+        self._load(piece_id).append(d)
+        return d
+
+    # the reader went away
+    def forget(self, reader):
+        self._last_piece.pop(reader, None)
+
+    # the piece's data changed, drop what was read of it
+    def discard(self, piece_id):
+        data = self._pieces.pop(piece_id, None)
+        if data is not None:
+            self.size -= len(data)
+        if piece_id in self._loading:
+            self._stale.add(piece_id)
+
+    def _load(self, piece_id):
+        waiting = self._loading.get(piece_id)
+        if waiting is not None or piece_id in self._pieces:
+            return waiting if waiting is not None else []
+
+        waiting = self._loading[piece_id] = []
+        d = deferToThreadPool(self._reactor, self._reactor.getThreadPool(),
+                              self._read, piece_id, 0, self._piece_size(piece_id))
+        d.addCallbacks(self._loaded, self._load_failed,
+                       callbackArgs=(piece_id,), errbackArgs=(piece_id,))
+        return waiting
+
+    def _loaded(self, data, piece_id):
+        waiting = self._loading.pop(piece_id)
+        stale = piece_id in self._stale
+        self._stale.discard(piece_id)
+        if len(data) != self._piece_size(piece_id):
+            logger.warning('short read of piece %d: %d bytes', piece_id, len(data))
+            error = IOError('short read of piece {}: {} bytes'.format(piece_id, len(data)))
+            for d in waiting:
+                d.errback(error)
+            return
+        if not stale:
+            self._insert(piece_id, data)
+        for d in waiting:
+            d.callback(data)
+
+    def _load_failed(self, failure, piece_id):
+        logger.error('reading piece %d failed: %s', piece_id, str(failure.value))
+        self._stale.discard(piece_id)
+        for d in self._loading.pop(piece_id):
+            d.errback(failure)
+
+    def _insert(self, piece_id, data):
+        self._pieces[piece_id] = data
+        self.size += len(data)
+        while self.size > self.max_bytes and len(self._pieces) > 1:
+            old_id, old = self._pieces.popitem(last=False)
+            self.size -= len(old)
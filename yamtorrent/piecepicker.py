@@ -0,0 +1,203 @@
+import random
+import bisect
+import logging
+
+logger = logging.getLogger('PiecePicker')
+
+
+# keeps track of how many connected peers have each piece (availability) and
+# which pieces we still want, and chooses the next piece to request from a
+# peer. subclasses decide the order pieces are picked in.
+class PiecePicker(object):
+
+    def __init__(self, num_pieces):
+        self.num_pieces = num_pieces
+        self.availability = [0] * num_pieces
+        self._wanted = set()
+
+    # how many wanted pieces are left to pick
+    def num_wanted(self):
+        return len(self._wanted)
+
+    def is_wanted(self, piece_id):
+        return piece_id in self._wanted
+
+    # add or remove a piece from the set of pieces we want to download
+    def want(self, piece_id):
+        if piece_id not in self._wanted:
+            self._wanted.add(piece_id)
+            self._added(piece_id)
+
+    def unwant(self, piece_id):
+        if piece_id in self._wanted:
+            self._wanted.remove(piece_id)
+            self._removed(piece_id)
+
+    # availability updates, from peer bitfields, have messages and disconnects
+    def add_peer(self, bitfield):
+        for piece_id in bitfield.findall('0b1'):
+            if piece_id < self.num_pieces:
+                self.peer_has(piece_id)
+
+    def remove_peer(self, bitfield):
+        for piece_id in bitfield.findall('0b1'):
+            if piece_id < self.num_pieces:
+                self.peer_lost(piece_id)
+
+    def peer_has(self, piece_id):
+        self._set_availability(piece_id, self.availability[piece_id] + 1)
+
+    def peer_lost(self, piece_id):
+        self._set_availability(piece_id, max(0, self.availability[piece_id] - 1))
+
+    def _set_availability(self, piece_id, count):
+        wanted = piece_id in self._wanted
+        if wanted:
+            self._removed(piece_id)
+        self.availability[piece_id] = count
+        if wanted:
+            self._added(piece_id)
+
+    # pick a wanted piece that is set in bitfield and stop wanting it (it's
+    # now in progress, add it back with want() if the download fails).
+    # returns None if the peer has nothing we want
+    def pick(self, bitfield):
+        piece_id = self._choose(bitfield)
+        if piece_id is not None:
+            self.unwant(piece_id)
+        return piece_id
+
+    # hooks for subclasses
+    def _added(self, piece_id):
+        pass
+
+    def _removed(self, piece_id):
+        pass
+
+    def _choose(self, bitfield):
+        raise NotImplementedError()
+
+
+# lowest index first
+class SequentialPicker(PiecePicker):
+
+    def __init__(self, num_pieces):
+        super().__init__(num_pieces)
+        self._order = []
+
+    def _added(self, piece_id):
+        bisect.insort(self._order, piece_id)
+
+    def _removed(self, piece_id):
+        del self._order[bisect.bisect_left(self._order, piece_id)]
+
+    def _choose(self, bitfield):
+        for piece_id in self._order:
+            if bitfield[piece_id]:
+                return piece_id
+        return None
+
+
+# rarest first. wanted pieces are kept in buckets keyed by availability, so
+# a pick only looks at the (few) distinct availability values and the pieces
+# in the rarest bucket the peer can give us. ties are broken randomly by
+# starting the scan of a bucket at a random position.
+class RarestFirstPicker(PiecePicker):
+
+    def __init__(self, num_pieces):
+        super().__init__(num_pieces)
+        self._buckets = {}   # key -> list of piece ids
+        self._position = {}  # piece id -> index in its bucket
+
+    # buckets are visited in increasing key order
+    def _key(self, piece_id):
+        return self.availability[piece_id]
+
+    def _skip(self, key):
+        # nobody has these pieces, don't bother looking
+        return key == 0
+
+    def _added(self, piece_id):
+        bucket = self._buckets.setdefault(self._key(piece_id), [])
+        self._position[piece_id] = len(bucket)
+        bucket.append(piece_id)
+
+    def _removed(self, piece_id):
+        key = self._key(piece_id)
+        bucket = self._buckets[key]
+        index = self._position.pop(piece_id)
+
+        # swap with the last piece so removal is O(1)
+        last = bucket.pop()
+        if last != piece_id:
+            bucket[index] = last
+            self._position[last] = index
+        if not bucket:
+            del self._buckets[key]
+
+    def _choose(self, bitfield):
+        for key in sorted(self._buckets):
+            if self._skip(key):
+                continue
+            bucket = self._buckets[key]
+            start = random.randrange(len(bucket))
+            for i in range(len(bucket)):
+                piece_id = bucket[(start + i) % len(bucket)]
+                if bitfield[piece_id]:
+                    return piece_id
+        return None
+
+
+# rarest first within priority classes. pieces with a higher priority are
+# always picked before lower ones, priority 0 means don't download. skipped
+# pieces stay wanted (their priority can be raised again) but aren't
+# counted by num_wanted, they will never be picked
+class PriorityPicker(RarestFirstPicker):
+
+    DEFAULT_PRIORITY = 1
+
+    def __init__(self, num_pieces):
+        super().__init__(num_pieces)
+        self.priority = [self.DEFAULT_PRIORITY] * num_pieces
+        self._num_skipped = 0   # wanted pieces with priority 0
+
+    def num_wanted(self):
+        return len(self._wanted) - self._num_skipped
+
+    def set_priority(self, piece_id, priority):
+        wanted = piece_id in self._wanted
+        if wanted:
+            self._removed(piece_id)
+        self.priority[piece_id] = priority
+        if wanted:
+            self._added(piece_id)
+
+    def _added(self, piece_id):
+        super()._added(piece_id)
+        if self.priority[piece_id] == 0:
+            self._num_skipped += 1
+
+    def _removed(self, piece_id):
+        super()._removed(piece_id)
+        if self.priority[piece_id] == 0:
+            self._num_skipped -= 1
+
+    def _key(self, piece_id):
+        return (-self.priority[piece_id], self.availability[piece_id])
+
+    def _skip(self, key):
+        return key[0] == 0 or key[1] == 0
+
+
+PICKERS = {
+    'rarest': RarestFirstPicker,
+    'sequential': SequentialPicker,
+    'priority': PriorityPicker
+}
+
+
+def make_picker(policy, num_pieces):
+    try:
+        return PICKERS[policy](num_pieces)
+    except KeyError:
+        raise ValueError('Unknown piece picking policy: ' + str(policy))
@@ -0,0 +1,98 @@
+import logging
+from collections import OrderedDict, deque
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import LoopingCall
+
+logger = logging.getLogger('RateLimiter')
+
+
+# a token bucket shared by several owners (torrents). rate bytes/s are added
+# every interval, up to one second's worth (or min_burst, enough for the
+# largest request, whichever is more). a rate of 0 means no limit.
+#
+# request(owner, amount) waits its turn: waiting requests are granted one
+# owner at a time in rotation so a busy torrent can't starve the others.
+# available()/consume() are for callers that can't wait and take what
+# there is. on_refill is called after every refill while anybody is short.
+class RateLimiter(object):
+
+    def __init__(self, reactor, rate=0, interval=0.1, min_burst=131072):
+        self._reactor = reactor
+        self.rate = rate
+        self.interval = interval
+        self.min_burst = min_burst
+        self.tokens = 0.0
+        self.on_refill = None
+        self._waiting = OrderedDict()  # owner -> deque of (amount, Deferred)
+        self._short = False
+        self._loop = None
+
+    def unlimited(self):
+        return not self.rate
+
+    def start(self):
+        if self._loop is None:
+            self._loop = LoopingCall(self._refill)
+            self._loop.clock = self._reactor
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+
+    # tokens there are now. only meaningful when there is a limit
+    def available(self):
+        self._short = True
+        return self.tokens
+
+    def consume(self, amount):
+        if not self.unlimited():
+            self.tokens -= amount
+
+    # returns a Deferred that fires once amount bytes may be transferred
+    def request(self, owner, amount):
+        if self.unlimited():
+            return succeed(amount)
+        if not self._waiting and self.tokens >= amount:
+            self.tokens -= amount
+            return succeed(amount)
+        d = Deferred()
+        self._waiting.setdefault(owner, deque()).append((amount, d))
+        return d
+
+    # drop the waiting requests of an owner that went away
+    def forget(self, owner):
+        self._waiting.pop(owner, None)
+
+    def _refill(self):
+        if self.unlimited():
+            self.tokens = 0.0
+            granted = [(d, amount) for waiting in self._waiting.values() for amount, d in waiting]
+            self._waiting = OrderedDict()
+            for d, amount in granted:
+                d.callback(amount)
+            return
+
+        burst = max(self.rate, self.min_burst)
+        self.tokens = min(burst, self.tokens + self.rate * self.interval)
+
+        # serve the owners in rotation, one request each per turn
+        granted = []
+        while self._waiting:
+            owner, waiting = next(iter(self._waiting.items()))
+            amount, d = waiting[0]
+            if amount > self.tokens:
+                break
+            self.tokens -= amount
+            waiting.popleft()
+            granted.append((d, amount))
+            del self._waiting[owner]
+            if waiting:
+                self._waiting[owner] = waiting
+        for d, amount in granted:
+            d.callback(amount)
+
+        if self._short and self.on_refill is not None:
+            self._short = False
+            self.on_refill()
@@ -0,0 +1,163 @@
+import os
+import time
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import bencodepy
+from bitstring import BitArray
+
+logger = logging.getLogger('Resume')
+
+READ_CHUNK = 1 << 20
+PIECE_HASH_SIZE = 20
+
+
+# fast resume data, kept in a sidecar file next to the download. records
+# which pieces we have along with the size and modification time of every
+# data file, so the bitfield can be trusted on the next start as long as
+# the files haven't changed since
+class ResumeData(object):
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+
+    # returns the saved bitfield, or None if there is no resume data or it
+    # doesn't match the torrent or the files on disk
+    def load(self, files):
+        try:
+            with open(self.path, 'rb') as f:
+                data = bencodepy.decode(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, bencodepy.exceptions.DecodingError):
+            logger.warning('could not read resume data %s', self.path)
+            return None
+
+        try:
+            if data[b'info-hash'] != self.meta.info_hash():
+                logger.info('resume data %s is for another torrent', self.path)
+                return None
+            if data[b'files'] != self._file_stats(files):
+                logger.info('resume data %s is stale', self.path)
+                return None
+            bitfield = BitArray(bytes=data[b'bitfield'])[0:self.meta.num_pieces()]
+        except (KeyError, OSError):
+            return None
+
+        if len(bitfield) != self.meta.num_pieces():
+            return None
+        return bitfield
+
+    # files is the list of data file paths, they must be flushed to disk
+    # before calling this
+    def save(self, bitfield, files):
+        data = {b'info-hash': self.meta.info_hash(),
+                b'bitfield': bitfield.tobytes(),
+                b'files': self._file_stats(files)}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(bencodepy.encode(data))
+        os.replace(tmp, self.path)
+
+    def _file_stats(self, files):
+        stats = []
+        for path in files:
+            st = os.stat(path)
+            stats.append([path.encode('utf-8'), st.st_size, st.st_mtime_ns])
+        return stats
+
+
+# hash every piece of existing data against the torrent metadata, spread
+# over `processes` worker processes (all cores if 0). files is a list of
+# (path, length) in torrent order. data is streamed, never loaded whole.
+# returns a BitArray of the pieces that are good
+def recheck(meta, files, processes=0):
+    num_pieces = meta.num_pieces()
+    processes = processes or os.cpu_count() or 1
+    hashes = meta.piece_hashes()
+    size = PIECE_HASH_SIZE
+
+    # a few ranges per process so a slow range doesn't hold up the rest
+    num_ranges = min(num_pieces, processes * 4)
+    bounds = [num_pieces * i // num_ranges for i in range(num_ranges + 1)]
+
+    bitfield = BitArray(num_pieces)
+    total_bytes = 0
+    started = time.time()
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+        jobs = [pool.submit(_check_pieces, files, meta.piece_length(), first, last,
+                            bytes(hashes[first * size:last * size]))
+                for first, last in zip(bounds, bounds[1:]) if last > first]
+        for job in jobs:
+            good, read = job.result()
+            total_bytes += read
+            for piece_id in good:
+                bitfield[piece_id] = 1
+
+    elapsed = max(time.time() - started, 1e-6)
+    logger.info('recheck: %d of %d pieces ok, %.1f MB in %.1fs (%.1f MB/s)',
+                bitfield.count(1), num_pieces, total_bytes / 1e6, elapsed,
+                total_bytes / 1e6 / elapsed)
+    return bitfield
+
+
+# worker process: hash pieces [first, last) and return the ids of the ones
+# matching their hash, and the number of bytes read
+def _check_pieces(files, piece_length, first, last, hashes):
+    good = []
+    total = 0
+    reader = _SpanReader(files)
+    try:
+        for i, piece_id in enumerate(range(first, last)):
+            h = hashlib.sha1()
+            offset = piece_id * piece_length
+            end = min(offset + piece_length, reader.length)
+            ok = True
+            while offset < end:
+                chunk = reader.read(offset, min(READ_CHUNK, end - offset))
+                if not chunk:
+                    ok = False
+                    break
+                h.update(chunk)
+                offset += len(chunk)
+                total += len(chunk)
+            if ok and h.digest() == hashes[i * PIECE_HASH_SIZE:(i + 1) * PIECE_HASH_SIZE]:
+                good.append(piece_id)
+    finally:
+        reader.close()
+    return good, total
+
+
+# reads the concatenation of several files by offset
+class _SpanReader(object):
+
+    def __init__(self, files):
+        self.files = []
+        start = 0
+        for path, length in files:
+            self.files.append((start, length, path))
+            start += length
+        self.length = start
+        self._fds = {}
+
+    def read(self, offset, length):
+        for start, file_length, path in self.files:
+            if start <= offset < start + file_length:
+                fd = self._fds.get(path)
+                if fd is None:
+                    try:
+                        fd = os.open(path, os.O_RDONLY)
+                    except OSError:
+                        return b''
+                    self._fds[path] = fd
+                return os.pread(fd, min(length, start + file_length - offset), offset - start)
+        return b''
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
@@ -0,0 +1,222 @@
+import os
+import logging
+import binascii
+from twisted.internet import reactor as treactor
+from twisted.internet.defer import Deferred, succeed
+
+from .settings import Settings
+from .hashpool import HashPool
+from .diskio import DiskWriter
+from .listener import PeerListener
+from .udptracker import UDPTrackerClient
+from .dht import DHT
+from .metadatafetcher import MetadataFetcher
+from .ratelimiter import RateLimiter
+from .metrics import Metrics, render, serve_metrics
+
+logger = logging.getLogger('Session')
+
+
+# everything shared by the torrents of one process: the reactor, the listen
+# port, the disk writer and hash pool, the socket UDP trackers are talked to
+# on, the DHT node, and the global limits. torrents can be added and removed
+# while it runs, from torrent files or magnet links. connections are split
+# evenly between the torrents (each is still held to its own
+# max_connections) and the rate limits are shared, waiting uploads are
+# served one torrent at a time.
+class Session(object):
+
+    def __init__(self, port, peer_id, reactor=None, settings=None):
+        self.port = port
+        self.peer_id = peer_id
+        self._reactor = reactor if reactor else treactor
+        self._settings = settings if settings else Settings()
+        s = self._settings
+
+        self.torrents = {}  # info_hash -> TorrentManager
+        self.fetchers = {}  # info_hash -> MetadataFetcher of a magnet link
+        self._fetch_waiting = {}    # info_hash -> [Deferred] waiting for its torrent
+        self._running = False
+        self._turn = 0
+
+        self.hasher = HashPool(self._reactor, s.hash_threads, s.hash_queue_limit)
+        self.disk = DiskWriter(self._reactor, s.fsync_interval, s.disk_memory_budget, s.disk_batch_bytes)
+        self.disk.on_drain = self.resume_requests
+        self.disk.on_write_error = self.write_failed
+        self.listener = PeerListener(self._reactor)
+        self.udp_tracker = UDPTrackerClient(self._reactor, s)
+        self.dht = None
+        if s.dht:
+            self.dht = DHT(self._reactor, s, os.path.join(s.download_dir, s.dht_state_file),
+                           self._bootstrap_nodes())
+
+        self.upload_limiter = RateLimiter(self._reactor, s.upload_rate_limit)
+        self.download_limiter = RateLimiter(self._reactor, s.download_rate_limit)
+        self.download_limiter.on_refill = self.resume_requests
+
+        self.metrics = Metrics()
+        m = self.metrics
+        m.gauge('torrents', 'Torrents in the session.', lambda: len(self.torrents))
+        m.gauge('hash_queue_depth', 'Pieces waiting to be verified.', self.hasher.pending)
+        m.gauge('disk_queue_depth', 'Writes waiting for the disk.', self.disk.queue_depth)
+        m.gauge('disk_bytes_pending', 'Bytes waiting to be written.', lambda: self.disk.bytes_pending)
+        m.gauge('disk_write_latency_seconds', 'Average time from receiving a block to writing it.',
+                lambda: self.disk.write_latency)
+        if self.dht is not None:
+            m.gauge('dht_nodes', 'Nodes in the DHT routing table.', lambda: len(self.dht.table))
+            m.counter('dht_queries_sent_total', 'DHT queries sent.', lambda: self.dht.queries_sent)
+            m.counter('dht_queries_received_total', 'DHT queries answered.',
+                      lambda: self.dht.queries_received)
+            m.counter('dht_timeouts_total', 'DHT queries that weren\'t answered.',
+                      lambda: self.dht.timeouts)
+
+    # host:port,host:port from the settings
+    def _bootstrap_nodes(self):
+        nodes = []
+        for address in self._settings.dht_bootstrap.split(','):
+            host, sep, port = address.strip().rpartition(':')
+            if host and port.isdigit():
+                nodes.append((host, int(port)))
+        return nodes
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        s = self._settings
+        self.hasher.start()
+        self.disk.start()
+        self.upload_limiter.start()
+        self.download_limiter.start()
+        self.listener.listen(int(self.port))
+        if self.dht is not None and self.dht.start(s.dht_port or self.listener.port() or 0):
+            self._reactor.addSystemEventTrigger('before', 'shutdown', self.dht.stop)
+        if s.metrics_port:
+            serve_metrics(self._reactor, self, s.metrics_port, s.metrics_interface)
+        for torrent in list(self.torrents.values()):
+            torrent.attach()
+        for fetcher in list(self.fetchers.values()):
+            fetcher.start()
+
+    # the port of our DHT node, None if it isn't running
+    def dht_port(self):
+        return self.dht.listening_port() if self.dht is not None else None
+
+    # start the session and run the reactor until it's stopped
+    def run(self):
+        self.start()
+        self._reactor.run()
+
+    # add a torrent, it starts right away if the session is running. meta is
+    # a TorrentMetadata. returns the TorrentManager
+    def add_torrent(self, meta):
+        from .torrentmanager import TorrentManager
+        info_hash = meta.info_hash()
+        if info_hash in self.torrents:
+            return self.torrents[info_hash]
+        torrent = TorrentManager(meta, self.port, self.peer_id, self._reactor, self._settings,
+                                 session=self)
+        self.torrents[info_hash] = torrent
+        self.rebalance()
+        if self._running:
+            torrent.attach()
+        return torrent
+
+    # add the torrent of a magnet link. its metadata is fetched from peers
+    # first, and kept in download_dir as <info hash>.torrent so it needn't
+    # be fetched again. returns a Deferred that fires with the
+    # TorrentManager. raises ValueError if uri isn't a BitTorrent magnet link
+    def add_magnet(self, uri):
+        from .torrentmetadata import TorrentMetadata
+        meta = TorrentMetadata.from_magnet(uri, self.peer_id)
+        info_hash = meta.info_hash()
+        if info_hash in self.torrents:
+            return succeed(self.torrents[info_hash])
+
+        path = self.metadata_path(info_hash)
+        if os.path.exists(path):
+            try:
+                cached = TorrentMetadata(path, self.peer_id)
+            except (OSError, ValueError) as e:
+                logger.warning('ignoring cached metadata %s: %s', path, str(e))
+            else:
+                if cached.info_hash() == info_hash:
+                    return succeed(self.add_torrent(cached))
+
+        d = Deferred()
+        if info_hash in self.fetchers:
+            self._fetch_waiting[info_hash].append(d)
+            return d
+        fetcher = MetadataFetcher(meta, self, self._reactor, self._settings)
+        self.fetchers[info_hash] = fetcher
+        self._fetch_waiting[info_hash] = [d]
+        fetcher.done.addCallbacks(self._metadata_fetched, self._metadata_failed,
+                                  callbackArgs=(path,), errbackArgs=(info_hash,))
+        if self._running:
+            fetcher.start()
+        return d
+
+    # where the metadata fetched for a magnet link is kept
+    def metadata_path(self, info_hash):
+        return os.path.join(self._settings.download_dir,
+                            binascii.hexlify(info_hash).decode() + '.torrent')
+
+    def _metadata_fetched(self, meta, path):
+        info_hash = meta.info_hash()
+        self.fetchers.pop(info_hash, None)
+        try:
+            meta.save(path)
+        except OSError as e:
+            logger.error('can\'t save metadata to %s: %s', path, str(e))
+        torrent = self.add_torrent(meta)
+        for d in self._fetch_waiting.pop(info_hash, []):
+            d.callback(torrent)
+
+    def _metadata_failed(self, failure, info_hash):
+        self.fetchers.pop(info_hash, None)
+        for d in self._fetch_waiting.pop(info_hash, []):
+            d.errback(failure)
+
+    # stop a torrent and forget it. returns a Deferred that fires once its
+    # data and resume data are on disk
+    def remove_torrent(self, info_hash):
+        fetcher = self.fetchers.get(info_hash)
+        if fetcher is not None:
+            return fetcher.stop()
+        torrent = self.torrents.pop(info_hash, None)
+        if torrent is None:
+            return succeed(None)
+        self.upload_limiter.forget(torrent)
+        self.rebalance()
+        return torrent.detach()
+
+    # share the connection limit evenly between the torrents
+    def rebalance(self):
+        if not self.torrents:
+            return
+        share = max(1, self._settings.global_max_connections // len(self.torrents))
+        for torrent in self.torrents.values():
+            torrent.connections.max_connections = min(self._settings.max_connections, share)
+
+    # the disk or hash pool caught up, or there's download budget again. the
+    # torrents take turns starting first so none gets the budget every time
+    def resume_requests(self, result=None):
+        torrents = list(self.torrents.values())
+        if torrents:
+            self._turn = (self._turn + 1) % len(torrents)
+            for torrent in torrents[self._turn:] + torrents[:self._turn]:
+                torrent.resume_requests()
+        return result
+
+    # the disk writer couldn't write blocks of piece_id, tell the torrent
+    # they belong to
+    def write_failed(self, storage, piece_id):
+        for torrent in self.torrents.values():
+            if torrent.storage is storage:
+                torrent.disk_write_failed(piece_id)
+
+    def render(self):
+        collected = self.metrics.collect()
+        for torrent in self.torrents.values():
+            collected.extend(torrent.metrics.collect())
+        return render(collected)
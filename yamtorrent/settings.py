@@ -0,0 +1,170 @@
+import logging
+
+logger = logging.getLogger('Settings')
+
+
+# tunables shared by the session, its torrents and their peer connections.
+# every attribute can be overridden from the command line as
+# --attribute-name=value (see Settings.from_argv)
+class Settings(object):
+
+    # connections: the most peers connected (or being connected to) and
+    # connection attempts in progress, how long (seconds) an attempt may take
+    # to connect and then to get through the handshake, the delay before
+    # reconnecting to a peer (doubled after every failure, up to the max) and
+    # the most peers remembered
+    max_connections = 50
+    max_half_open = 8
+    connect_timeout = 10.0
+    handshake_timeout = 10.0
+    reconnect_backoff = 30.0
+    max_reconnect_backoff = 3600.0
+    max_candidates = 1000
+
+    # limits for the whole session, shared by all its torrents: connections,
+    # and upload and download rates in bytes/s (0 means unlimited)
+    global_max_connections = 200
+    upload_rate_limit = 0
+    download_rate_limit = 0
+
+    # request pipelining: number of blocks kept outstanding per peer.
+    # the depth adapts between the min and max so that roughly
+    # request_queue_time seconds worth of data is in flight
+    initial_queue_depth = 4
+    min_queue_depth = 2
+    max_queue_depth = 250
+    request_queue_time = 3.0
+
+    # block request deadlines adapt to each peer's round trip time within
+    # these bounds (seconds), and are checked every timeout_check_interval.
+    # a peer missing snub_threshold deadlines in a row is snubbed
+    min_request_timeout = 2.0
+    max_request_timeout = 120.0
+    timeout_check_interval = 1.0
+    snub_threshold = 3
+
+    # how often (seconds) a peer's download rate is sampled, and the weight
+    # given to the newest sample in the moving average
+    rate_sample_interval = 1.0
+    rate_smoothing = 0.3
+
+    # worker threads used to verify pieces, and how many pieces may be
+    # waiting to be verified before we stop requesting more data
+    hash_threads = 2
+    hash_queue_limit = 8
+
+    # worker processes used to recheck existing data on startup (0 means one
+    # per core), and how often (seconds) fast resume data is saved
+    recheck_processes = 0
+    resume_save_interval = 60
+
+    # where downloads are saved, the most file descriptors kept open per
+    # torrent, and whether to allocate files fully up front (instead of sparse)
+    download_dir = '.'
+    max_open_files = 64
+    preallocate = False
+
+    # disk writer: bytes of received data that may wait to be written before
+    # we stop requesting more, the most bytes merged into one batch, and how
+    # often (seconds) files are fsynced (0 means only when saving resume data)
+    disk_memory_budget = 64 * 1024 * 1024
+    disk_batch_bytes = 4 * 1024 * 1024
+    fsync_interval = 30.0
+
+    # seeding: bytes of recently read pieces kept in memory, how many pieces
+    # to read ahead for peers requesting pieces in order, and the most block
+    # requests queued per peer
+    read_cache_size = 16 * 1024 * 1024
+    read_ahead_pieces = 2
+    max_upload_queue = 250
+
+    # choking: how many peers we upload to besides the optimistic unchoke,
+    # and how often (seconds) they are chosen and the optimistic one rotated
+    unchoke_slots = 4
+    choke_interval = 10.0
+    optimistic_unchoke_interval = 30.0
+
+    # trackers: the announce interval (seconds) used when a tracker doesn't
+    # give one, the shortest interval we'll announce at whatever it says,
+    # the delay before retrying a tier none of whose trackers answered
+    # (doubled after every failure, up to the max), how long an HTTP
+    # announce may take, how many peers to ask for, and how few connected
+    # peers make us announce early for more. UDP trackers are sent a
+    # request again after udp_tracker_timeout seconds, doubling each time,
+    # up to udp_tracker_retries times
+    announce_interval = 1800.0
+    min_announce_interval = 60.0
+    tracker_retry = 60.0
+    max_tracker_retry = 1800.0
+    tracker_timeout = 30.0
+    num_want = 50
+    low_peer_threshold = 10
+    udp_tracker_timeout = 15.0
+    udp_tracker_retries = 2
+
+    # DHT (BEP 5): whether torrents that aren't private look for peers in it,
+    # its UDP port (0 means the same as the listen port), the file (in
+    # download_dir) its nodes are saved to, the nodes to bootstrap from when
+    # we know too few, how long (seconds) a query may take, and how often a
+    # torrent looks itself up
+    dht = True
+    dht_port = 0
+    dht_state_file = 'dht.state'
+    dht_bootstrap = 'router.bittorrent.com:6881,router.utorrent.com:6881,dht.transmissionbt.com:6881'
+    dht_query_timeout = 5.0
+    dht_announce_interval = 900.0
+
+    # fast extension: how many pieces a new peer may download from us while
+    # we choke it
+    allowed_fast_set_size = 10
+
+    # peer exchange: how often (seconds) peers are told who we're connected
+    # to. peers that tell us more often than every half interval are ignored
+    pex_interval = 60.0
+
+    # magnet links: the largest info dict we'll fetch (bytes), how many of
+    # its pieces are requested from one peer at a time, and how long
+    # (seconds) a peer may take to send one before it's dropped
+    max_metadata_size = 32 * 1024 * 1024
+    metadata_queue_depth = 2
+    metadata_timeout = 10.0
+
+    # port for the Prometheus metrics endpoint (0 means off), and the
+    # address it listens on
+    metrics_port = 0
+    metrics_interface = '127.0.0.1'
+
+    # piece picking policy: rarest, sequential or priority
+    piece_picker = 'rarest'
+
+    def __init__(self, **overrides):
+        for name, value in overrides.items():
+            if not hasattr(type(self), name):
+                raise ValueError('Unknown setting: ' + name)
+            setattr(self, name, value)
+
+    # build settings from command line arguments of the form --name=value,
+    # ignoring any argument that isn't a known setting
+    @classmethod
+    def from_argv(cls, argv):
+        overrides = {}
+        for arg in argv:
+            if not arg.startswith('--') or '=' not in arg:
+                continue
+            name, value = arg[2:].split('=', 1)
+            name = name.replace('-', '_')
+            if name.startswith('_') or not hasattr(cls, name):
+                continue
+            default = getattr(cls, name)
+            if callable(default):
+                continue
+            try:
+                if default is None:
+                    overrides[name] = value
+                elif isinstance(default, bool):
+                    overrides[name] = value.lower() in ('1', 'true', 'yes', 'on')
+                else:
+                    overrides[name] = type(default)(value)
+            except ValueError:
+                logger.error('invalid value for --%s: %s', arg[2:].split('=', 1)[0], value)
+        return cls(**overrides)
@@ -0,0 +1,274 @@
+import os
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('Storage')
+
+
+# one file of the torrent, at offset `start` in the torrent's byte stream
+class FileEntry(object):
+
+    def __init__(self, final_path, length, start):
+        self.final_path = final_path
+        self.part_path = final_path + '.part' # .part to indicate it is an incomplete file
+        self.path = self.part_path
+        self.length = length
+        self.start = start
+
+    def __repr__(self):
+        return '<FileEntry {} start={} length={}>'.format(self.path, self.start, self.length)
+
+
+# an open descriptor of a file: how many reads and writes are using it, and
+# whether it was written to since it was last synced
+class OpenFile(object):
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.users = 0
+        self.dirty = False
+        self.closing = False
+
+
+# maps the torrent's pieces onto the files they're stored in. a piece (or
+# block) can span several files, spans() turns a (piece, offset, length)
+# into (file, file offset, length) pieces using the file start offsets and
+# the first file of each piece, computed once up front. reads and writes use
+# positional I/O so no file position is shared, and at most max_open_files
+# descriptors are kept open (least recently used ones get synced and closed
+# once nothing is using them). the lock only guards the descriptor cache,
+# the I/O itself runs in parallel.
+#
+# while downloading files carry a .part suffix, finalize() renames them.
+# safe to use from several threads.
+class Storage(object):
+
+    def __init__(self, meta, base_dir='.', max_open_files=64, preallocate=False):
+        self.meta = meta
+        self.base_dir = base_dir
+        self.max_open_files = max_open_files
+        self.preallocate = preallocate
+
+        # multi-file torrents keep their files in a folder named after the torrent
+        folder = _safe_path([meta.folder()]) if meta.folder() else ''
+        self.files = []
+        start = 0
+        for path, length in meta.file_list():
+            self.files.append(FileEntry(os.path.join(base_dir, folder, _safe_path(path)), length, start))
+            start += length
+        self.length = start
+
+        # file start offsets for bisect, and the first file of every piece
+        self._starts = [f.start for f in self.files]
+        piece_length = meta.piece_length()
+        self._piece_file = [self._file_at(piece_id * piece_length)
+                            for piece_id in range(meta.num_pieces())]
+
+        self._fds = OrderedDict()  # FileEntry -> OpenFile, least recently used first
+        self._lock = threading.Lock()
+        self._sync_error = None    # a sync on closing failed, flush() reports it
+
+    # index of the (non-empty) file holding byte `offset` of the torrent
+    def _file_at(self, offset):
+        index = bisect.bisect_right(self._starts, offset) - 1
+        while self.files[index].length == 0 and index + 1 < len(self.files):
+            index += 1
+        return index
+
+    # create any missing files (sparse, or preallocated) and pick up files
+    # left by an earlier run, finished or not. returns whether any data was
+    # already there
+    def open(self):
+        existing = False
+        for f in self.files:
+            if os.path.exists(f.final_path) and not os.path.exists(f.part_path):
+                f.path = f.final_path
+            directory = os.path.dirname(f.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if os.path.exists(f.path):
+                size = os.path.getsize(f.path)
+                existing = existing or size > 0
+                if size >= f.length:
+                    continue
+
+            logger.info('creating file %s (%d bytes)', f.path, f.length)
+            fd = os.open(f.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if self.preallocate and f.length and hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, f.length)
+                else:
+                    os.ftruncate(fd, f.length)
+            finally:
+                os.close(fd)
+        return existing
+
+    # the (file, file offset, length) spans covering length bytes at offset
+    # in a piece
+    def spans(self, piece_id, offset, length):
+        position = piece_id * self.meta.piece_length() + offset
+        index = self._piece_file[piece_id]
+        while self.files[index].start + self.files[index].length <= position:
+            index += 1
+
+        spans = []
+        while length > 0 and index < len(self.files):
+            f = self.files[index]
+            n = min(length, f.start + f.length - position)
+            if n > 0:
+                spans.append((f, position - f.start, n))
+                position += n
+                length -= n
+            index += 1
+        return spans
+
+    def write(self, piece_id, offset, data):
+        view = memoryview(data)
+        written = 0
+        for f, file_offset, length in self.spans(piece_id, offset, len(view)):
+            entry = self._acquire(f)
+            try:
+                end = written + length
+                while written < end:
+                    n = os.pwrite(entry.fd, view[written:end], file_offset)
+                    if n == 0:
+                        raise OSError('wrote nothing to {}'.format(f.path))
+                    written += n
+                    file_offset += n
+            finally:
+                self._release(entry, wrote=True)
+
+    def read(self, piece_id, offset, length):
+        chunks = []
+        for f, file_offset, n in self.spans(piece_id, offset, length):
+            entry = self._acquire(f)
+            try:
+                chunk = os.pread(entry.fd, n, file_offset)
+            finally:
+                self._release(entry)
+            chunks.append(chunk)
+            if len(chunk) < n:
+                break
+        return b''.join(chunks)
+
+    # the open descriptor of f, opened if need be. it stays open until
+    # released
+    def _acquire(self, f):
+        with self._lock:
+            entry = self._fds.get(f)
+            if entry is not None:
+                self._fds.move_to_end(f)
+            else:
+                entry = OpenFile(os.open(f.path, os.O_RDWR | os.O_CREAT, 0o644))
+                self._fds[f] = entry
+            entry.users += 1
+            evicted = self._evict()
+        self._close_all(evicted)
+        return entry
+
+    def _release(self, entry, wrote=False):
+        with self._lock:
+            entry.users -= 1
+            entry.dirty = entry.dirty or wrote
+            evicted = self._evict()
+            if entry.closing and entry.users == 0:
+                evicted.append(entry)
+        self._close_all(evicted)
+
+    # take the least recently used descriptors nobody is using out of the
+    # cache until it's back to max_open_files. call with the lock held
+    def _evict(self):
+        evicted = []
+        for f, entry in list(self._fds.items()):
+            if len(self._fds) <= self.max_open_files:
+                break
+            if entry.users == 0:
+                del self._fds[f]
+                evicted.append(entry)
+        return evicted
+
+    # sync (if written to) and close descriptors taken out of the cache
+    def _close_all(self, entries):
+        for entry in entries:
+            try:
+                if entry.dirty:
+                    os.fsync(entry.fd)
+            except OSError as e:
+                logger.error('sync on closing failed: %s', str(e))
+                self._sync_error = e
+            finally:
+                os.close(entry.fd)
+
+    # flush everything written so far to disk. files closed in the meantime
+    # were synced when they were closed
+    def flush(self):
+        error, self._sync_error = self._sync_error, None
+        if error is not None:
+            raise error
+        with self._lock:
+            dirty = [entry for entry in self._fds.values() if entry.dirty]
+            for entry in dirty:
+                entry.users += 1
+                entry.dirty = False
+        try:
+            for entry in dirty:
+                os.fsync(entry.fd)
+        except OSError:
+            for entry in dirty:
+                self._release(entry, wrote=True)
+            raise
+        for entry in dirty:
+            self._release(entry)
+
+    # close every descriptor, ones still in use once they're released
+    def close(self):
+        with self._lock:
+            entries, self._fds = list(self._fds.values()), OrderedDict()
+            idle = []
+            for entry in entries:
+                entry.closing = True
+                if entry.users == 0:
+                    idle.append(entry)
+        self._close_all(idle)
+
+    # the download is complete, drop the .part suffixes
+    def finalize(self):
+        self.flush()
+        self.close()
+        for f in self.files:
+            if f.path == f.final_path:
+                continue
+            try:
+                os.rename(f.part_path, f.final_path)
+                f.path = f.final_path
+            except OSError:
+                logger.error('couldn\'t rename completed file %s to remove .part', f.part_path)
+
+    # where the resume data of the download is kept, next to it and named
+    # after it
+    def resume_path(self):
+        return os.path.join(self.base_dir, _safe_path([self.meta.name()]) + '.resume')
+
+    # current paths of all the files, in torrent order
+    def file_paths(self):
+        return [f.path for f in self.files]
+
+    # (path, length) of all the files, in torrent order
+    def file_spans(self):
+        return [(f.path, f.length) for f in self.files]
+
+
+# join the path components of a file from the torrent metadata, dropping
+# anything that could escape the download directory
+def _safe_path(components):
+    parts = []
+    for c in components:
+        if isinstance(c, bytes):
+            c = c.decode('utf-8', 'replace')
+        c = c.replace('/', '_').replace('\\', '_')
+        if c in ('', '.', '..'):
+            continue
+        parts.append(c)
+    return os.path.join(*parts) if parts else '_'
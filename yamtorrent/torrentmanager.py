@@ -4,25 +4,37 @@ import hashlib
 import bencodepy
 import struct
 import socket
-import os
 from bitstring import BitArray
 from twisted.internet import reactor as treactor
 from twisted.internet.task import LoopingCall
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from twisted.internet.threads import deferToThreadPool
 from twisted.web.client import getPage
 import logging
 from progressbar import ProgressBar
 import progressbar
 from enum import Enum
 
-from . import PeerInfo, TorrentMetadata, PeerConnection, TrackerConnection
+from . import PeerInfo, TorrentMetadata, PeerConnection, TrackerConnection, Settings
+from .piecepicker import make_picker
+from .blockscheduler import BlockScheduler
+from .hashpool import HashError
+from .resume import ResumeData, recheck
+from .storage import Storage
+from .piececache import PieceCache
+from .choker import Choker
+from .metrics import Metrics
+from .connectionmanager import ConnectionManager
+from .pex import PeerExchange
+from .session import Session
 
 TICK_DELAY = 5
-TIMEOUT = 120
 
 logger = logging.getLogger('TorrentManager')
 
-# manages tracker and peer connections for a single torrent
+# manages tracker and peer connections for a single torrent. runs in a
+# Session, which it shares with other torrents (a TorrentManager created
+# without one gets a session of its own)
 class TorrentManager(object):
 
     class _States(Enum):
@@ -33,111 +45,361 @@ class TorrentManager(object):
         SEEDING = 4
         DONE = 5
         IDLE = 6
+        CHECKING = 7
 
-    def __init__(self, meta, port, peer_id, reactor=None):
+    def __init__(self, meta, port, peer_id, reactor=None, settings=None, session=None):
         self.meta = meta
         self.port = port
         self.peer_id = peer_id
         self.num_ticks = 0
         self.tracker = None  # TrackerConnection
-        self.next_piece = 0
         self.mybitfield = BitArray(int(self.meta.num_pieces()))
         self._reactor = reactor if reactor else treactor
+        self._settings = settings if settings else Settings()
         self._bar = None
         self.state = self._States.INITIAL
+        self.session = session if session else Session(port, peer_id, self._reactor, self._settings)
+        self._loops = []
+        self._shutdown_trigger = None
 
         # self.finished_downloading = False
 
-        # the pieces we desire, in order
-        self.desire = list(range(0,int(self.meta.num_pieces())))
+        # the pieces we desire, and how many peers have each of them
+        self.picker = make_picker(self._settings.piece_picker, int(self.meta.num_pieces()))
+        for piece_id in range(0, int(self.meta.num_pieces())):
+            self.picker.want(piece_id)
 
-        # dict mapping piece_id to a PeerConnection
-        self.requests = {}
+        # pieces in progress and which blocks of them are requested from whom.
+        # blocks of a piece can come from any number of peers
+        self.scheduler = BlockScheduler(self.meta, self.picker, PeerConnection.BLOCK_SIZE)
 
-        # dict mapping peer to Boolean connection state
+        # verifies complete pieces off the reactor thread (shared by the
+        # session's torrents). requests are held back while too many pieces
+        # are waiting to be verified
+        self.hasher = self.session.hasher
+        self._requests_blocked = False
+
+        # the peers we're exchanging data with
         self._peers = []
 
-        # file that we will write downloaded data to.
-        self.file = None
+        # peers learn who else we're connected to from us, and we from them
+        # (not for private torrents)
+        self.pex = PeerExchange(self._reactor, self._settings)
+
+        # when we last looked for peers in the DHT, and whether a lookup is
+        # in progress
+        self._dht_last = None
+        self._dht_lookup = False
+
+        # who to connect to, and how many at a time
+        self.connections = ConnectionManager(self._reactor, self._settings,
+                                             self.make_peer, self.peer_did_connect)
+
+        # the files that we will write downloaded data to.
+        self.storage = Storage(self.meta, self._settings.download_dir,
+                               self._settings.max_open_files, self._settings.preallocate)
+        self._existing_data = False
+
+        # blocks are written on the session's disk thread. like the hash
+        # pool, requests are held back while too much data is waiting
+        self.disk = self.session.disk
+
+        # pieces with blocks the disk writer couldn't write. they fail
+        # verification and are downloaded again
+        self._write_failed = set()
+
+        # pieces read back to serve other peers' requests
+        self.cache = PieceCache(self._reactor, self.read_block, self.scheduler.piece_size,
+                                int(self.meta.num_pieces()), self._settings.read_cache_size,
+                                self._settings.read_ahead_pieces, self.has_piece)
+
+        # which peers we upload to
+        self.choker = Choker(self._reactor, self._settings)
+
+        # running totals, kept up to date as things happen so reading them
+        # (metrics, progress) is cheap
+        self.downloaded = 0
+        self.uploaded = 0
+        self.num_have = 0
+        self.pieces_verified = 0
+        self.hash_failures = 0
+        self.metrics = Metrics({'torrent': self.meta.name().decode('utf-8', 'replace')})
+        self.register_metrics()
+
+        # which pieces we have, saved next to the download so a restart
+        # doesn't start from scratch
+        self.resume_data = ResumeData(self.storage.resume_path(), self.meta)
 
     def finished_bitfield(self):
-        return all(self.mybitfield[0:int(self.meta.num_pieces())])
-
-    # takes a bytearray (piece_array) and writes it to the correct
-    # position in file (piece_number * piece_length)
-    # piece_length is given in torrent metadata
-    def write_piece_to_file(self, piece_number, piece_array):
-        self.file.seek(piece_number * self.meta.piece_length())
-        self.file.write(piece_array)
-
-    # create a blank .part file with name coming from torrent metadata
+        return self.num_have == self.meta.num_pieces()
+
+    def register_metrics(self):
+        m = self.metrics
+        m.counter('downloaded_bytes_total', 'Bytes of block data received.', lambda: self.downloaded)
+        m.counter('uploaded_bytes_total', 'Bytes of block data sent.', lambda: self.uploaded)
+        m.counter('pieces_verified_total', 'Pieces that passed verification.', lambda: self.pieces_verified)
+        m.counter('hash_failures_total', 'Pieces that failed verification.', lambda: self.hash_failures)
+        m.gauge('pieces', 'Pieces we have.', lambda: self.num_have)
+        m.gauge('pieces_total', 'Pieces in the torrent.', lambda: self.meta.num_pieces())
+        m.gauge('pieces_in_progress', 'Pieces being downloaded.', lambda: len(self.scheduler.partial))
+        m.gauge('peers', 'Connected peers.', lambda: len(self._peers))
+        m.gauge('tracker_latency_seconds', 'Time the last tracker announce took.',
+                lambda: (self.tracker.latency or 0.0) if self.tracker else 0.0)
+        m.counter('tracker_announces_total', 'Announces sent to trackers.',
+                  lambda: self.tracker.announces if self.tracker else 0)
+        m.counter('tracker_failures_total', 'Announces that failed.',
+                  lambda: self.tracker.failures if self.tracker else 0)
+        m.counter('pex_peers_received_total', 'New peers learned through peer exchange.',
+                  lambda: self.pex.peers_received)
+
+        def per_peer(fn):
+            return lambda: [({'peer': str(p.peer_info)}, fn(p)) for p in self._peers]
+
+        m.gauge('peer_download_rate_bytes', 'Download rate from the peer (bytes/s).',
+                per_peer(self.choker.download_rate))
+        m.gauge('peer_upload_rate_bytes', 'Upload rate to the peer (bytes/s).',
+                per_peer(self.choker.upload_rate))
+        m.gauge('peer_queue_depth', 'Block requests we keep outstanding with the peer.',
+                per_peer(lambda p: p.queue_depth))
+        m.gauge('peer_outstanding_requests', 'Block requests outstanding with the peer.',
+                per_peer(lambda p: len(p.outstanding)))
+        m.gauge('peer_upload_queue', 'Block requests from the peer waiting to be sent.',
+                per_peer(lambda p: len(p.upload_queue)))
+        m.gauge('peer_am_choking', 'Whether we choke the peer.', per_peer(lambda p: p.am_choking()))
+        m.gauge('peer_choking', 'Whether the peer chokes us.', per_peer(lambda p: p.peer_choking()))
+
+    # queues a block to be written to its position in the file(s)
+    def write_block(self, piece_number, offset, block):
+        self.disk.write(self.storage, piece_number, offset, block)
+
+    # reads length bytes at offset in a piece back from the file(s), or from
+    # the write queue if it isn't written yet. safe to call from other threads
+    def read_block(self, piece_number, offset, length):
+        return self.disk.read(self.storage, piece_number, offset, length)
+
+    # create the files to download into, or open the ones left by an earlier
+    # run (or the finished files) to resume
     def create_temp_file(self):
-        logger.info('creating blank file %s', self.meta.name().decode("utf-8") + '.part') # .part to indicate it is an incomplete file
-        self.file = open(self.meta.name().decode("utf-8") + '.part', 'wb+')
-
-    # add a piece number to desire
-    # current implementation sticks it in in order
-    def add_to_desire(self, piece_id):
-
-        # loop until we find something to put it before
-        for i in range(0, len(self.desire)):
-            if piece_id < self.desire[i]:
-                self.desire.insert(i,piece_id)
-                return
-
-        # if we can't find something to put it before, put
-        # it at the end
-        self.desire.append(piece_id)
-        return
-
-    # pick the next piece that we would like to request from a particular peer
-    def pick_next_piece(self, peer):
-
-        # loop through the ordered array of pieces we desire until we get
-        # to one that this peer has, then return that one, and note that we no longer
-        # desire it
-        for d in self.desire:
-            if peer.piece_in_bitfield(d):
-                self.desire.remove(d)
-                return d
-
-        # if we there are no pieces we desire that this peer has
-        return None
+        self._existing_data = self.storage.open()
 
+    # find out which pieces we already have. trusts the fast resume data if it
+    # matches the file on disk, otherwise hashes whatever data is there on all
+    # cores (off the reactor thread). returns a Deferred
+    def check_existing_data(self):
+        bitfield = self.resume_data.load(self.storage.file_paths())
+        if bitfield is not None:
+            logger.info('resuming with %d of %d pieces', bitfield.count(1), self.meta.num_pieces())
+            self.restore_bitfield(bitfield)
+            return succeed(None)
+
+        if not self._existing_data:
+            return succeed(None)
+
+        logger.info('checking existing data')
+        self.state = self._States.CHECKING
+        d = deferToThreadPool(self._reactor, self._reactor.getThreadPool(), recheck,
+                              self.meta, self.storage.file_spans(),
+                              self._settings.recheck_processes)
+        d.addCallback(self.restore_bitfield)
+        return d
+
+    # add the pieces found on disk to the ones we have. pieces verified
+    # meanwhile are kept
+    def restore_bitfield(self, bitfield):
+        self.mybitfield |= bitfield
+        self.num_have = self.mybitfield.count(1)
+        for piece_id in bitfield.findall('0b1'):
+            self.picker.unwant(piece_id)
+        if self.state == self._States.CHECKING:
+            self.state = self._States.INITIAL
+        if self.finished_bitfield():
+            logger.info('all pieces are already here')
+            self.download_complete()
+
+    # waits for queued writes to reach the disk, then saves. returns a Deferred
+    def save_resume_data(self):
+        bitfield = BitArray(self.mybitfield)
+
+        def save(result):
+            try:
+                self.resume_data.save(bitfield, self.storage.file_paths())
+            except OSError as e:
+                logger.error('couldn\'t save resume data: %s', str(e))
+
+        # some of the pieces may not be on disk after all, keep the old data
+        def failed(failure):
+            logger.error('not saving resume data: %s', failure.getErrorMessage())
+
+        return self.disk.flush().addCallbacks(save, failed)
+
+    # every piece is downloaded and verified, drop the .part suffixes once
+    # everything is on disk
+    def finish_download(self):
+        def failed(failure):
+            logger.error('not finishing download: %s', failure.getErrorMessage())
+
+        d = self.disk.flush()
+        d.addCallback(lambda result: self.storage.finalize())
+        d.addCallback(lambda result: self.save_resume_data())
+        d.addErrback(failed)
+        return d
+
+    # blocks of piece_id couldn't be written. a piece that's still being
+    # downloaded or verified fails verification, one we already have is
+    # downloaded again
+    def disk_write_failed(self, piece_id):
+        if not self.mybitfield[piece_id]:
+            self._write_failed.add(piece_id)
+            return
+        logger.warning('piece %d didn\'t make it to disk, downloading it again', piece_id)
+        self.cache.discard(piece_id)
+        self.mybitfield[piece_id] = 0
+        self.num_have -= 1
+        self.picker.want(piece_id)
+        if self.state == self._States.SEEDING:
+            self.state = self._States.DOWNLOADING
+        for p in self._peers:
+            bitfield = p.get_bitfield()
+            if bitfield is not None and bitfield[piece_id] and not p.am_interested():
+                p.send_interested()
+        self.fill_pipelines()
+
+    # check a downloaded piece against its hash in the torrent metadata.
+    # blocks that arrived out of order are read back and hashed on the hash
+    # pool, the result is delivered to peer_piece_success or peer_piece_error
+    def verify_piece(self, peer, piece):
+        expected = self.meta.piece_hash(piece.piece_id)
+
+        def check(digest):
+            if piece.piece_id in self._write_failed:
+                raise IOError('piece {} couldn\'t be written'.format(piece.piece_id))
+            if digest != expected:
+                logger.info('validating piece %i: hash did not match!', piece.piece_id)
+                raise HashError('hash mismatch for piece {}'.format(piece.piece_id))
+            logger.info('validating piece %i: hash matched!', piece.piece_id)
+            return (peer, piece.piece_id)
+
+        def read(offset, length):
+            return self.read_block(piece.piece_id, offset, length)
+
+        d = self.hasher.finish_sha1(piece.hasher, read, piece.hashed, piece.size)
+        d.addCallback(check)
+        d.addCallbacks(self.peer_piece_success,
+                       lambda failure: self.peer_piece_error(peer, piece, failure.value))
+        d.addBoth(self.session.resume_requests)
+        return d
+
+    # requests were held back while the hash pool was full, the disk was
+    # behind or the download rate limit was reached, start again. passes
+    # result through so it can be used as a Deferred callback
+    def resume_requests(self, result=None):
+        if self._requests_blocked and not self.hasher.is_full() and not self.disk.is_congested():
+            self._requests_blocked = False
+            self.fill_pipelines()
+        return result
+
+    # blocks became available (dropped by a peer, or a piece to download
+    # again), give every peer that lets us request a chance to request them
+    # right away: unchoked ones, and choked ones that allowed us some pieces.
+    # snubbed peers go last
+    def fill_pipelines(self, exclude=()):
+        for p in sorted(self._peers, key=lambda p: p.snubbed):
+            if not (p.peer_choking() and not p.allowed_fast) and p not in exclude:
+                p.fill_pipeline()
+
+    # cancel requests that are past their peer's deadline and request the
+    # blocks from other peers first. the peers that timed out are refilled
+    # afterwards, nothing else would ask them for blocks again
+    def expire_requests(self):
+        if self.state != self._States.DOWNLOADING:
+            return
+        now = self._reactor.seconds()
+        timed_out = []
+        for p in self._peers:
+            expired = p.expire_requests(now)
+            if expired:
+                logger.info('%d requests to %s timed out', len(expired), str(p.peer_info))
+                self.scheduler.drop_requests(p, expired)
+                timed_out.append(p)
+        if timed_out:
+            self.fill_pipelines(exclude=timed_out)
+            for p in timed_out:
+                p.fill_pipeline()
+
+    # every piece is here: switch to seeding and finish the files
+    def download_complete(self):
+        logger.info('WE HAVE ALL THE PIECES')
+        self.state = self._States.SEEDING
+        if self.tracker is not None:
+            self.tracker.completed()
+        self.finish_download()
+
+    # run this torrent on its own: start its session and the reactor
     def start(self):
-        self.tracker = TrackerConnection(self.meta, self.port, self.peer_id, self._reactor)
+        self.session.torrents[self.meta.info_hash()] = self
+        self.session.rebalance()
+        self.session.run()
 
-        self.create_temp_file()
-
-        def connect_to_peer(peer_info):
-            logger.info('Connecting to peer: %s', str(peer_info))
-            p = PeerConnection(self.meta, peer_info)
-            p.connect(self._reactor).addCallback(self.peer_did_connect)
-
-        def tracker_connect_success(result):
-            peers = self.tracker.get_peers()
-            # print(peers)
-
-            logger.info('Tracker returned %d peers.', len(peers))
-            # print(list(map(str, peers)))
-            # print(peers[0])
+    # start the torrent in its (running) session
+    def attach(self):
+        self.tracker = TrackerConnection(self.meta, self.port, self.peer_id, self._reactor,
+                                         self._settings, delegate=self,
+                                         udp_client=self.session.udp_tracker)
 
-            self.state = self._States.CONNECTING
-
-            # connect_to_peer(peers[0])
-            # connect_to_peer(peers[1])
-            for p in peers:
-                connect_to_peer(p)
+        self.create_temp_file()
 
         def tracker_connect_error(result):
             logger.error('tracker_connect_error %s', str(result))
 
-        self.tracker.start().addCallbacks(tracker_connect_success,
-                                          tracker_connect_error)
-
-        LoopingCall(self.timer_tick).start(TICK_DELAY)
-
-        self._reactor.run()
+        # announce once we know how much is left. the tracker keeps
+        # announcing from then on. peers that find us through the tracker
+        # connect to the port we announce, they're let in from then on too
+        # so they don't download while the data is being checked
+        def announce(result):
+            self.session.listener.add(self.meta.info_hash(), self)
+            self.find_dht_peers()
+            return self.tracker.start()
+
+        d = self.check_existing_data()
+        d.addCallback(announce)
+        d.addErrback(tracker_connect_error)
+
+        self._shutdown_trigger = self._reactor.addSystemEventTrigger('before', 'shutdown',
+                                                                     self.shutdown)
+        for fn, interval in ((self.timer_tick, TICK_DELAY),
+                             (self.run_choker, self._settings.choke_interval),
+                             (self.expire_requests, self._settings.timeout_check_interval),
+                             (self.run_pex, self._settings.pex_interval)):
+            loop = LoopingCall(fn)
+            loop.clock = self._reactor
+            loop.start(interval)
+            self._loops.append(loop)
+
+    # stop the torrent: drop every connection and save. returns a Deferred
+    # that fires once the data and resume data are on disk
+    def detach(self):
+        for loop in self._loops:
+            if loop.running:
+                loop.stop()
+        self._loops = []
+        if self._shutdown_trigger is not None:
+            self._reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._shutdown_trigger = None
+        self.session.listener.remove(self.meta.info_hash())
+
+        self.state = self._States.IDLE
+        self.connections.stop()
+
+        d = self.shutdown()
+        d.addCallback(lambda result: self.storage.close())
+        return d
+
+    # save, and tell the trackers we're leaving
+    def shutdown(self):
+        ds = [self.save_resume_data()]
+        if self.tracker is not None:
+            ds.append(self.tracker.stop())
+        return DeferredList(ds)
 
     def timer_tick(self):
         self.num_ticks += 1
@@ -148,101 +410,117 @@ class TorrentManager(object):
             self._bar = progressbar.ProgressBar(maxval=num_pieces)
             self._bar.start()
         elif self._bar is not None:
-            self._bar.update(sum(self.mybitfield))
+            self._bar.update(self.num_have)
 
         if self.state == self._States.DONE:
             bar.finish()
 
 
 
-        # could use num_ticks as a timer for timing out requests
-        # would simply require us to pass the peerconnection the
-        # value of num_ticks at the time of initiation
-        # and if any time timer_tick is called, and the value of the peer
-        # connection is greater than x ticks from the values of num_ticks
-        # here, we can cancel the request.
-
-
-        # if we haven't finished downloading all pieces yet
-        if self.state == self._States.DOWNLOADING:
-            idle_peers = self.idle_peers()
-
-            # if we've got all the pieces
-            if self.finished_bitfield():
-
-                # begin seeding
-                self.state == self._States.SEEDING
-
-                # self.finished_downloading = True
-                logger.info('WE HAVE ALL THE PIECES')
-
-                # rename the file to remove .part
-                self.file.close()
-                try:
-                    os.rename(self.meta.name().decode("utf-8") + '.part', self.meta.name().decode("utf-8"))
-                except OSError as e:
-                    logger.error('couldn\'t rename completed file to remove .part')
-
-                return
-            # if self.next_piece >= self.meta.num_pieces():
-            #     return
-
-            # might not be finished, but can't do anything
-            if len(self.desire) == 0:
-                logger.debug('len(desire) == 0')
-                return
-
-
-            # figure out which peers we can be using
-            unchoked = filter(lambda p: not p.peer_choking(), idle_peers)
-            for p in unchoked:
-
-                logger.debug('requesting pieces from unchoked')
-                # self.requests[self.next_piece] = p
-                # d = p.start_piece_download(self.next_piece)
+        if (self.num_ticks * TICK_DELAY) % self._settings.resume_save_interval < TICK_DELAY:
+            self.save_resume_data()
 
-                piece_to_request = self.pick_next_piece(p)
-                self.requests[piece_to_request] = p
-                d = p.start_piece_download(piece_to_request, self.num_ticks)
-                d.addCallbacks(self.peer_piece_success, self.peer_piece_error)
+        # retry candidates whose backoff is over
+        self.connections.fill()
 
-            # check for timeouts among the currently downloading peers
-            busy = self.busy_peers()
-            for p in busy:
+        # most of the peers we heard of are gone, ask for more
+        s = self._settings
+        short = self.state != self._States.SEEDING and len(self._peers) < s.low_peer_threshold
+        if self.tracker is not None and short:
+            self.tracker.need_peers()
+        if self._dht_last is not None:
+            since = self._reactor.seconds() - self._dht_last
+            if since >= s.dht_announce_interval or (short and since >= s.min_announce_interval):
+                self.find_dht_peers()
 
-                # if it has timed out
-                p_start_tick = p.get_start_tick()
-                diff = self.num_ticks - p_start_tick
-                if diff * TICK_DELAY > TIMEOUT:
-
-                    # get the piece number it is downloading
-                    piece_id = p.get_piece_number()
-
-                    logger.info("PEER IS CANCELLING PIECE " + str(piece_id))
-
-                    # tell it to cancel
-                    p.cancel_current_download()
-
-                    # remove the piece/peer from requests
-                    self.requests.pop(piece_id, None)
+        if self.state == self._States.DONE:
+            logger.info('WE ARE QUITTING')
 
-                    # add the piece back to desired
-                    self.add_to_desire(piece_id)
+        # print('has_piece:', self.has_piece(1))
 
+    ######## TRACKER CALLBACKS  #################
 
-        if self.state == self._States.SEEDING:
-            self.state == self._States.DONE
+    def tracker_stats(self):
+        return self.uploaded, self.downloaded, self.bytes_left()
 
-        if self.state == self._States.DONE:
-            logger.info('WE ARE QUITTING')
+    def tracker_did_return_peers(self, peers):
+        if self.state in (self._States.INITIAL, self._States.TRACKER):
+            self.state = self._States.CONNECTING
+        self.connections.add_peers(peers)
 
-        # print('has_piece:', self.has_piece(1))
+    ######## DHT  #################
 
-    def busy_peers(self):
-        return set([p for k, p in self.requests.items()])
+    def use_dht(self):
+        return not self.meta.private() and self.session.dht_port() is not None
 
-    def idle_peers(self):
-        return set(self._peers) - self.busy_peers()
+    # look for peers in the DHT and announce ourselves there
+    def find_dht_peers(self):
+        if not self.use_dht() or self._dht_lookup:
+            return
+        self._dht_lookup = True
+        self._dht_last = self._reactor.seconds()
+
+        def done(peers):
+            self._dht_lookup = False
+            logger.info('DHT lookup found %d peers.', len(peers))
+
+        d = self.session.dht.get_peers(self.meta.info_hash(), self.session.listener.port(),
+                                       self.dht_did_return_peers)
+        d.addCallback(done)
+
+    def dht_did_return_peers(self, peers):
+        self.tracker_did_return_peers(peers)
+
+    # bytes of the pieces we don't have yet
+    def bytes_left(self):
+        last = self.meta.num_pieces() - 1
+        have = self.num_have * self.meta.piece_length()
+        if self.mybitfield[last]:
+            have -= self.meta.piece_length() - self.scheduler.piece_size(last)
+        return self.meta.full_length() - have
+
+    def make_peer(self, peer_info):
+        peer = PeerConnection(self.meta, peer_info, settings=self._settings, delegate=self)
+        peer.listen_port = self.session.listener.port()
+        peer.pex = not self.meta.private()
+        if self.use_dht():
+            peer.dht_port = self.session.dht_port()
+        return peer
+
+    # a peer connected to us asking for this torrent. returns the
+    # PeerConnection taking over the connection, or None to refuse it
+    def accept_peer(self, protocol, address):
+        if self.state == self._States.CHECKING:
+            return None
+        peer = self.make_peer(PeerInfo(address.host, address.port))
+        if not self.connections.add_inbound(peer):
+            logger.info('refusing connection from %s, too many connections', str(peer.peer_info))
+            return None
+        logger.info('accepted connection from %s', str(peer.peer_info))
+        peer.did_accept(protocol, self._reactor)
+        return peer
+
+    # the pieces a peer at ip may request while choked (BEP 6). the same for
+    # every client, so it survives reconnecting from another port
+    def allowed_fast_set(self, ip):
+        num_pieces = self.meta.num_pieces()
+        k = min(self._settings.allowed_fast_set_size, num_pieces)
+        allowed = []
+        x = socket.inet_aton(ip)[:3] + b'\0' + self.meta.info_hash()
+        while len(allowed) < k:
+            x = hashlib.sha1(x).digest()
+            for i in range(0, 20, 4):
+                piece_id = int.from_bytes(x[i:i + 4], 'big') % num_pieces
+                if len(allowed) < k and piece_id not in allowed:
+                    allowed.append(piece_id)
+        return allowed
+
+    def run_choker(self):
+        self.choker.run(self._peers, seeding=self.state == self._States.SEEDING)
+
+    def run_pex(self):
+        if not self.meta.private():
+            self.pex.run(self._peers)
 
     def has_piece(self, piece_id):
         return self.mybitfield[piece_id]
@@ -253,44 +531,182 @@ class TorrentManager(object):
         logger.info('peer_did_connect %s', str(peer.peer_info))
 
         # we can now begin downloading
-        self.state = self._States.DOWNLOADING
-        logger.debug('set state to DOWNLOADING')
+        if self.state not in (self._States.SEEDING, self._States.CHECKING):
+            self.state = self._States.DOWNLOADING
+            logger.debug('set state to DOWNLOADING')
 
         bitfield = peer.get_bitfield()
         if bitfield is not None:
             self._peers.append(peer)
-            # do something else here?
+            self.picker.add_peer(bitfield)
+
+            # let it know if it has something we don't
+            if (bitfield[0:self.meta.num_pieces()] & ~self.mybitfield).any(True):
+                peer.send_interested()
+            peer.fill_pipeline()
+
+            # a peer that's just starting can get a few pieces before it's
+            # unchoked
+            if peer.fast and bitfield.count(1) < self._settings.allowed_fast_set_size:
+                for piece_id in self.allowed_fast_set(peer.peer_info.ip):
+                    if self.mybitfield[piece_id]:
+                        peer.send_allowed_fast(piece_id)
         else:
             peer.stop()
         logger.debug(bitfield)
 
+    def peer_did_have(self, peer, piece_id):
+        if peer in self._peers:
+            self.picker.peer_has(piece_id)
+            if not peer.am_interested() and not self.mybitfield[piece_id]:
+                peer.send_interested()
+            peer.fill_pipeline()
+
+    def peer_connection_lost(self, peer):
+        self.connections.peer_disconnected(peer)
+        self.pex.forget(peer)
+        if peer not in self._peers:
+            return
+        self._peers.remove(peer)
+        self.picker.remove_peer(peer.get_bitfield())
+        self.cache.forget(peer)
+        self.choker.forget(peer)
+
+        # give back the blocks it was working on
+        dropped = peer.drop_outstanding(send_cancel=False)
+        if dropped:
+            self.scheduler.drop_requests(peer, dropped)
+            self.fill_pipelines()
+
+    # the handshake is done, tell the peer what we have
+    def peer_did_handshake(self, peer):
+        if peer.fast and self.finished_bitfield():
+            peer.send_have_all()
+        elif self.mybitfield.any(True):
+            peer.send_bitfield(self.mybitfield)
+        elif peer.fast:
+            peer.send_have_none()
+
+    # the peer runs a DHT node too
+    def peer_did_send_port(self, peer, port):
+        if self.use_dht():
+            self.session.dht.add_node((peer.peer_info.ip, port))
+
+    # the peer told us which extensions it supports. peers that do peer
+    # exchange get our peers right away
+    def peer_did_extended_handshake(self, peer):
+        if not self.meta.private():
+            self.pex.update(peer, self._peers)
+
+    def peer_did_send_pex(self, peer, added, dropped):
+        if self.meta.private() or peer not in self._peers:
+            return
+        addresses = self.pex.received(peer, added, self._peers)
+        if addresses:
+            logger.debug('%s told us about %d peers', str(peer.peer_info), len(addresses))
+            self.connections.add_peers([PeerInfo(ip, port) for ip, port in addresses])
+
+    def peer_interest_changed(self, peer):
+        if peer.peer_interested() and peer in self._peers:
+            self.choker.peer_interested(peer, self._peers)
+
+    # returns whether we can serve a block request from the peer
+    def peer_did_request(self, peer, piece_id, offset, length):
+        return (0 <= piece_id < self.meta.num_pieces() and self.mybitfield[piece_id] and
+                offset + length <= self.scheduler.piece_size(piece_id))
+
+    # returns a Deferred firing with the data of a block requested by the
+    # peer, once the upload rate limit allows sending it
+    def peer_read_block(self, peer, piece_id, offset, length):
+        d = self.session.upload_limiter.request(self, length)
+        d.addCallback(lambda result: self.cache.read(piece_id, offset, length, reader=peer))
+        d.addCallback(self._block_uploaded)
+        return d
+
+    def _block_uploaded(self, data):
+        self.uploaded += len(data)
+        return data
+
+    # the peer has room in its request pipeline
+    def peer_request_blocks(self, peer, count):
+        if self.state != self._States.DOWNLOADING or peer not in self._peers:
+            return []
+        if self.hasher.is_full() or self.disk.is_congested():
+            self._requests_blocked = True
+            return []
+
+        # while choked only its allowed fast pieces may be requested
+        bitfield = None
+        if peer.peer_choking():
+            bitfield = BitArray(self.meta.num_pieces())
+            bitfield.set(True, list(peer.allowed_fast))
+            bitfield &= peer.get_bitfield()[0:self.meta.num_pieces()]
+
+        # only ask for as much as the download rate limit allows
+        limiter = self.session.download_limiter
+        if limiter.unlimited():
+            return self.scheduler.request_blocks(peer, count, bitfield, peer.suggested)
+        count = min(count, int(limiter.available() // PeerConnection.BLOCK_SIZE))
+        if count <= 0:
+            self._requests_blocked = True
+            return []
+        blocks = self.scheduler.request_blocks(peer, count, bitfield, peer.suggested)
+        limiter.consume(sum(length for piece_id, offset, length in blocks))
+        return blocks
+
+    # the peer won't be sending these blocks
+    def peer_did_drop_requests(self, peer, blocks):
+        self.scheduler.drop_requests(peer, blocks)
+        self.fill_pipelines()
+
+    def peer_did_receive_block(self, peer, piece_id, offset, block):
+        self.downloaded += len(block)
+        others = self.scheduler.block_received(peer, piece_id, offset, block)
+        if others is None:
+            return
+        self.write_block(piece_id, offset, block)
+
+        # in endgame the block may be requested from other peers too
+        for p in others:
+            p.cancel_request(piece_id, offset)
+
+        if self.scheduler.piece_complete(piece_id):
+            logger.info('piece number %d complete', piece_id)
+            self.verify_piece(peer, self.scheduler.finish_piece(piece_id))
+
     def peer_piece_success(self, result):
-        (peer, piece_id, piece_array) = result
+        (peer, piece_id) = result
         logger.info('received_piece %d from %s.', piece_id, str(peer.peer_info))
-        if self._bar is not None:
-            self._bar.update(sum(self.mybitfield))
         #if we already had this piece, don't bother
         if self.mybitfield[piece_id] == 1:
             return
 
-        #write this piece to file
-        self.write_piece_to_file(piece_id, piece_array)
-
         # add to availability table to show that we have downloaded this piece
+        self.cache.discard(piece_id)
         self.mybitfield[piece_id] = 1
+        self.num_have += 1
+        self.pieces_verified += 1
+        if self._bar is not None:
+            self._bar.update(self.num_have)
 
-        # TODO this is not correct
-        # self.next_piece = piece_id + 1
-
-
-
-
-        self.requests.pop(piece_id, None)
+        # and let everybody know they can ask us for it
+        for p in self._peers:
+            p.send_have(piece_id)
 
+        if self.finished_bitfield() and self.state == self._States.DOWNLOADING:
+            self.download_complete()
 
-    def peer_piece_error(self, peer, piece_id, error):
-        logger.error('peer_piece_error', str(peer.peer_info))
-        pass
+    # the piece failed verification, download it again
+    def peer_piece_error(self, peer, piece, error):
+        logger.error('peer_piece_error piece %d from %s: %s', piece.piece_id,
+                     ', '.join(str(p.peer_info) for p in piece.contributors), str(error))
+        if piece.piece_id in self._write_failed:
+            self._write_failed.discard(piece.piece_id)
+        else:
+            self.hash_failures += 1
+        self.cache.discard(piece.piece_id)
+        self.scheduler.retry_piece(piece)
+        self.fill_pipelines()
 
 
 
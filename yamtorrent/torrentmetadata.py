@@ -1,6 +1,11 @@
+import os
 import glob
+import base64
 import hashlib
+import binascii
 import bencodepy
+from urllib.parse import urlparse, parse_qs
+from . import bencode
 import logging
 
 logger = logging.getLogger('TorrentMetadata')
@@ -21,49 +26,162 @@ class TorrentMetadata(object):
         logger.debug('opening torrent file {}'.format(filename))
 
         with open(filename, 'rb') as torrentfile:
-            self._metadata = bencodepy.decode(torrentfile.read())
-            
-
-            try:
-                # re-bencode the info section
-                info = self._metadata[b"info"]
-
-                # piece hash values
-                self._piece_hashes = info[b'pieces']
-
-
-                # SHA1 hash of info section
-                self._info_hash = hashlib.sha1(bencodepy.encode(info)).digest()
-                self._name = info[b'name']
-                self._announce = self._metadata[b'announce']
-
-
-
-                if b'length' in info:
-                    # torrent only has one file
-                    self._folder = ''
-                    self._files = list((info[b'name'], info[b'length']))
-                    self._length = info[b'length']
-                else:
-                    self._folder = info[b'name']
-                    self._files = [(f[b'path'], f[b'length']) for f in info[b'files']]
-                    self._length = sum([l for (p, l) in self._files])
-
-                self._num_pieces = int(len(info[b'pieces'])/self.PIECE_HASH_SIZE)
-                self._piece_length = info[b'piece length']
-            except KeyError:
-                raise ValueError('Invalid Torrent File: Missing a field!')
+            self._load(torrentfile.read())
+
+    # the metadata a magnet link gives: the info hash, and maybe a name and
+    # trackers. the info dict has to be fetched from peers (see
+    # MetadataFetcher) and handed to set_info before the torrent can be
+    # downloaded. until then has_info() is false, the name is the one in the
+    # link (or the info hash in hex) and the torrent has no pieces
+    @classmethod
+    def from_magnet(cls, uri, peer_id=None):
+        parsed = urlparse(uri)
+        if parsed.scheme != 'magnet':
+            raise ValueError('Not a magnet link: ' + uri)
+        params = parse_qs(parsed.query)
+
+        info_hash = None
+        for xt in params.get('xt', []):
+            if xt.lower().startswith('urn:btih:'):
+                encoded = xt[9:]
+                try:
+                    if len(encoded) == 40:
+                        info_hash = binascii.unhexlify(encoded)
+                    elif len(encoded) == 32:
+                        info_hash = base64.b32decode(encoded.upper())
+                except (binascii.Error, ValueError):
+                    pass
+        if info_hash is None:
+            raise ValueError('Magnet link without a BitTorrent info hash: ' + uri)
+
+        meta = cls.__new__(cls)
+        meta.peer_id = peer_id
+        meta._data = None
+        meta._info_hash = info_hash
+        if 'dn' in params:
+            meta._name = params['dn'][0].encode('utf-8')
+        else:
+            meta._name = binascii.hexlify(info_hash)
+        # every tracker is a tier of its own, so they're all announced to
+        trackers = [tr.encode('utf-8') for tr in params.get('tr', [])]
+        meta._announce = trackers[0] if trackers else None
+        meta._announce_list = [[tracker] for tracker in trackers]
+        meta._piece_hashes = memoryview(b'')
+        meta._num_pieces = 0
+        meta._piece_length = 0
+        meta._folder = ''
+        meta._files = []
+        meta._length = 0
+        meta._private = False
+        return meta
+
+    # whether the info dict is known, always true unless made from a magnet
+    # link
+    def has_info(self):
+        return self._data is not None
+
+    # the info dict fetched for a magnet link, as encoded. raises ValueError
+    # if it doesn't match the info hash or isn't a valid info dict. the
+    # trackers of the link are kept
+    def set_info(self, info):
+        if hashlib.sha1(info).digest() != self._info_hash:
+            raise ValueError('Metadata doesn\'t match the info hash')
+        torrent = {}
+        if self._announce is not None:
+            torrent[b'announce'] = self._announce
+        if self._announce_list:
+            torrent[b'announce-list'] = self._announce_list
+        self._load(bencodepy.encode(torrent)[:-1] + b'4:info' + bytes(info) + b'e')
+
+    # only the fields every torrent needs are decoded here. the pieces stay
+    # in data, and the file list is decoded the first time it's asked for
+    def _load(self, data):
+        try:
+            spans = bencode.dict_spans(data)
+            info_start, info_end = spans[b'info']
+
+            # SHA1 hash of info section, as it's encoded in the file
+            self._info_span = (info_start, info_end)
+            self._info_hash = hashlib.sha1(memoryview(data)[info_start:info_end]).digest()
+            info = bencode.dict_spans(data, info_start)
+
+            def value(spans, key):
+                return bencode.decode_at(data, spans[key][0])[0]
+
+            # piece hash values
+            pieces_start, pieces_end = bencode.string_span(data, info[b'pieces'][0])
+            self._piece_hashes = memoryview(data)[pieces_start:pieces_end]
+
+            self._name = value(info, b'name')
+            self._announce = value(spans, b'announce') if b'announce' in spans else None
+
+            # BEP 12 tiers of trackers, falling back to the single
+            # announce url
+            tiers = value(spans, b'announce-list') if b'announce-list' in spans else []
+            self._announce_list = [list(tier) for tier in tiers if tier]
+            if not self._announce_list and self._announce:
+                self._announce_list = [[self._announce]]
+
+            if b'length' in info:
+                # torrent only has one file
+                self._folder = ''
+                self._length = value(info, b'length')
+                self._files = [([self._name], self._length)]
+            else:
+                self._folder = self._name
+                self._files_span = info[b'files']
+                self._length = None
+                self._files = None
+
+            self._num_pieces = len(self._piece_hashes) // self.PIECE_HASH_SIZE
+            self._piece_length = value(info, b'piece length')
+            self._private = b'private' in info and value(info, b'private') == 1
+            self._data = data
+        except KeyError:
+            raise ValueError('Invalid Torrent File: Missing a field!')
 
     def announce(self):
         return self._announce
 
+    # list of tiers, each a list of tracker urls. empty for torrents whose
+    # peers come from the DHT only
+    def announce_list(self):
+        return self._announce_list
+
     def info_hash(self):
         return self._info_hash
 
+    # the info dict as encoded in the torrent file, a memoryview
+    def info_bytes(self):
+        start, end = self._info_span
+        return memoryview(self._data)[start:end]
+
+    # write the torrent file to path
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self._data)
+        os.replace(tmp, path)
+
+    # list of (path, length), path being a list of path components
+    # relative to folder()
     def file_list(self):
+        if self._files is None:
+            files = bencode.decode_at(self._data, self._files_span[0])[0]
+            try:
+                self._files = [(f[b'path'], f[b'length']) for f in files]
+            except (KeyError, TypeError):
+                raise ValueError('Invalid Torrent File: Missing a field!')
+            self._length = sum([l for (p, l) in self._files])
         return self._files
 
+    # the directory multi-file torrents are saved in, '' for single files
+    def folder(self):
+        return self._folder
+
     def full_length(self):
+        if self._length is None:
+            self.file_list()
         return self._length
 
     def name(self):
@@ -75,5 +193,15 @@ class TorrentMetadata(object):
     def piece_length(self):
         return self._piece_length
 
+    # the concatenated piece hashes, a memoryview of the torrent file
     def piece_hashes(self):
         return self._piece_hashes
+
+    # the hash of one piece, also a memoryview
+    def piece_hash(self, piece_id):
+        start = piece_id * self.PIECE_HASH_SIZE
+        return self._piece_hashes[start:start + self.PIECE_HASH_SIZE]
+
+    # private torrents get their peers from their trackers only
+    def private(self):
+        return self._private
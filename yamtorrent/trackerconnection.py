@@ -1,124 +1,323 @@
 #!/usr/bin/env python3
 import bencodepy
+import random
 import struct
 import socket
 import sys
 from urllib.parse import urlencode
 from urllib.parse import urlparse
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import DeferredList, fail, succeed
 from twisted.web.client import getPage
 from . import PeerInfo
-from pybtracker import TrackerClient
+from .settings import Settings
+from .udptracker import UDPTrackerClient
 import logging
-import asyncio
 logger = logging.getLogger('TrackerConnection')
 
+# seconds the stopped announce may take, so quitting isn't held up by a
+# tracker that's gone away
+STOP_TIMEOUT = 5
+
 
 class TrackerError(Exception):
     pass
 
 
+# one tier of trackers (BEP 12). the trackers are tried in order until one
+# answers, and the one that did moves to the front so it's asked first
+# next time. the order starts out shuffled
+class Tier(object):
+
+    def __init__(self, urls):
+        self.urls = list(urls)
+        random.shuffle(self.urls)
+        self.tracker_id = None
+        self.interval = None
+        self.min_interval = None
+        self.last_announce = None   # time of the last announce that was answered
+        self.started = False        # a tracker of this tier knows about us
+        self.send_completed = False
+        self.failures = 0
+        self.busy = False           # an announce is in progress
+        self.call = None            # DelayedCall of the next announce
+
+
+# announces a torrent to all of its trackers. every tier is announced to
+# independently (and at the same time), each again after the interval its
+# tracker asked for, or retried with an exponential backoff when none of the
+# tier's trackers answered. need_peers() announces early, as far as the
+# trackers' min interval allows.
+#
+# the delegate supplies the counters (tracker_stats(), returning uploaded,
+# downloaded and left in bytes) and is handed the peers of every answer
+# (tracker_did_return_peers(peers)).
+#
+# UDP trackers are announced to through udp_client, a UDPTrackerClient
+# normally shared by the session's torrents.
 class TrackerConnection(object):
 
-    def __init__(self, metadata, port, peer_id, reactor=None):
+    def __init__(self, metadata, port, peer_id, reactor=None, settings=None, delegate=None,
+                 udp_client=None):
         self._metadata = metadata
         self._port = port
         self._peer_id = peer_id
-        self.tracker_id = ''
-        self.started = False
         self._reactor = reactor
+        self._settings = settings if settings else Settings()
+        self.delegate = delegate
+        self._udp_client = udp_client
+        # identifies us to trackers should our address change
+        self._key = random.getrandbits(32)
+        self.tiers = [Tier(urls) for urls in metadata.announce_list()]
+        self.stopped = True
+        self._peers = []
+
+        # monitoring
+        self.latency = None         # seconds the last answered announce took
+        self.announces = 0
+        self.failures = 0
 
+    # announce to every tier. returns a Deferred that fires with self once
+    # a tier answers, or fails with TrackerError if none does. a torrent
+    # without trackers has nothing to announce to
     def start(self):
-        uploaded = b'0'
-        downloaded = b'0'
+        self.stopped = False
+        if not self.tiers:
+            return succeed(self)
+        d = DeferredList([self._announce_tier(tier) for tier in self.tiers],
+                         fireOnOneCallback=True, consumeErrors=True)
+
+        def done(result):
+            if isinstance(result, tuple):
+                return self
+            raise TrackerError('No tracker of {} answered'
+                               .format(self._metadata.name().decode('utf-8', 'replace')))
+        return d.addCallback(done)
+
+    # the download finished: tell the trackers that know about us. the
+    # others learn it from left being 0 when they first hear from us
+    def completed(self):
+        for tier in self.tiers:
+            if tier.started:
+                tier.send_completed = True
+                if not tier.busy:
+                    self._announce_tier(tier).addErrback(lambda failure: None)
+
+    # announce now to the tiers that may be asked again already. returns
+    # whether any were
+    def need_peers(self):
+        if self.stopped:
+            return False
+        now = self._reactor.seconds()
+        announced = False
+        for tier in self.tiers:
+            if tier.busy or tier.last_announce is None:
+                continue
+            if now - tier.last_announce < self._min_interval(tier):
+                continue
+            logger.info('announcing early to %s, short of peers', tier.urls[0].decode())
+            self._announce_tier(tier).addErrback(lambda failure: None)
+            announced = True
+        return announced
+
+    # stop announcing and tell the trackers that know about us that we're
+    # gone. returns a Deferred that fires once they've been told (or failed
+    # to listen)
+    def stop(self):
+        self.stopped = True
+        ds = []
+        for tier in self.tiers:
+            if tier.call is not None and tier.call.active():
+                tier.call.cancel()
+            tier.call = None
+            if tier.started:
+                tier.started = False
+                url = tier.urls[0]
+                d = self.announce_to(url, self._params(tier, b'stopped'), stopping=True)
+                d.addErrback(self._stop_failed, url)
+                ds.append(d)
+        return DeferredList(ds)
 
-        left = self._metadata.full_length()
+    def _stop_failed(self, failure, url):
+        logger.info('stopped announce to %s failed: %s', url.decode(), failure.getErrorMessage())
+
+    def get_peers(self):
+        return self._peers
+
+    def _min_interval(self, tier):
+        return max(tier.min_interval or 0, self._settings.min_announce_interval)
+
+    def _event(self, tier):
+        if not tier.started:
+            return b'started'
+        if tier.send_completed:
+            return b'completed'
+        return b''
+
+    def _params(self, tier, event):
+        if self.delegate is not None:
+            uploaded, downloaded, left = self.delegate.tracker_stats()
+        else:
+            uploaded, downloaded, left = 0, 0, self._metadata.full_length()
 
-        compact = b'1'
-        event = b'started'
         p = {'info_hash': self._metadata.info_hash(),
              'peer_id': self._peer_id,
              'port': self._port,
              'uploaded': uploaded,
              'downloaded': downloaded,
              'left': left,
-             'compact': compact,
-             'event': event}
+             'compact': 1,
+             'key': self._key,
+             'numwant': self._settings.num_want}
+        if event:
+            p['event'] = event
+        if tier.tracker_id is not None:
+            p['trackerid'] = tier.tracker_id
+        return p
 
-        url = self._metadata.announce().decode()
+    # announce to the trackers of a tier until one answers. returns a
+    # Deferred that fires with the peers
+    def _announce_tier(self, tier):
+        if tier.call is not None and tier.call.active():
+            tier.call.cancel()
+        tier.call = None
+        tier.busy = True
+        event = self._event(tier)
+        d = self._try_tracker(tier, 0, event)
+        d.addCallbacks(self._tier_answered, self._tier_failed,
+                       callbackArgs=(tier, event), errbackArgs=(tier,))
+        return d
 
-        protocol = urlparse(url)[0]
-        if protocol == 'udp':
-            logger.info('udp tracker')
-            return self.get_udp(url, p)
-        elif protocol == 'http' or protocol == 'https':
-            logger.info('%s tracker', protocol)
-            return self.get_http(url, p)
-        else:
-            logger.info('tracker protocol: %s', protocol)
-            d = Deferred()
-            self._reactor.callLater(0.5, d.errback, ValueError('Invalid tracker protocol'))
-            return d
+    def _try_tracker(self, tier, index, event):
+        url = tier.urls[index]
+        started = self._reactor.seconds()
+        self.announces += 1
 
+        def answered(response):
+            self.latency = self._reactor.seconds() - started
+            if index:
+                tier.urls.remove(url)
+                tier.urls.insert(0, url)
+            return response
 
-    def get_udp(self, url, params):
+        def failed(failure):
+            self.failures += 1
+            logger.info('tracker %s failed: %s', url.decode(), failure.getErrorMessage())
+            if index + 1 < len(tier.urls) and not self.stopped:
+                return self._try_tracker(tier, index + 1, event)
+            return failure
 
-        # url = url.replace('announce', 'scrape')
-        print('\n')
-        logger.critical('UDP Trackers are not really supported.')
-        print('\n')
+        d = self.announce_to(url, self._params(tier, event))
+        return d.addCallbacks(answered, failed)
 
-        logger.info(url)
-        info_hash = params['info_hash']
+    def _tier_answered(self, response, tier, event):
+        tier.busy = False
+        tier.failures = 0
+        tier.last_announce = self._reactor.seconds()
+        tier.started = True
+        if event == b'completed':
+            tier.send_completed = False
+        tier.interval = response.get('interval', tier.interval)
+        tier.min_interval = response.get('min interval', tier.min_interval)
+        tier.tracker_id = response.get('tracker id', tier.tracker_id)
 
-        d = Deferred()
-        async def announce():
-            client = TrackerClient(announce_uri=url)
-            await client.start()
-            peers = await client.announce(
-                params['info_hash'],  # infohash
-                int(params['downloaded']),                    # downloaded
-                int(params['left']),                    # left
-                int(params['uploaded']),                     # uploaded
-                2,                        # event (0=none), 1=completed, 2=started, 3=stopped
-                50                       # number of peers wanted
-            )
+        peers = response['peers']
+        logger.info('Tracker %s returned %d peers.', tier.urls[0].decode(), len(peers))
+        if self.stopped:
+            return peers
 
-            self._peers = list(map(lambda peer_data: PeerInfo(*peer_data), peers))
-            d.callback(self)
+        interval = max(tier.interval or self._settings.announce_interval, self._min_interval(tier))
+        if tier.send_completed:
+            # finished while this announce was on its way
+            interval = 0
+        tier.call = self._reactor.callLater(interval, self._reannounce, tier)
+        self._peers = peers
+        if self.delegate is not None:
+            self.delegate.tracker_did_return_peers(peers)
+        return peers
 
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(announce())
+    def _tier_failed(self, failure, tier):
+        tier.busy = False
+        tier.failures += 1
+        if not self.stopped:
+            s = self._settings
+            delay = min(s.tracker_retry * 2 ** (tier.failures - 1), s.max_tracker_retry)
+            logger.error('no tracker of tier %s answered, retrying in %d seconds',
+                         ', '.join(url.decode() for url in tier.urls), delay)
+            tier.call = self._reactor.callLater(delay, self._reannounce, tier)
+        return failure
 
-        # self._reactor.callLater(0.5, d.errback, ValueError('Invalid tracker protocol: udp'))
-        return d
+    def _reannounce(self, tier):
+        tier.call = None
+        self._announce_tier(tier).addErrback(lambda failure: None)
+
+    # announce to one tracker. returns a Deferred that fires with the
+    # response as a dict: peers (a list of PeerInfo) and the interval,
+    # min interval and tracker id the tracker gave, if any. the stopped
+    # announce gets one short try
+    def announce_to(self, url, params, stopping=False):
+        url = url.decode()
+        protocol = urlparse(url)[0]
+        if protocol == 'udp':
+            return self.get_udp(url, params, 0 if stopping else None)
+        elif protocol == 'http' or protocol == 'https':
+            timeout = STOP_TIMEOUT if stopping else self._settings.tracker_timeout
+            return self.get_http(url, params, timeout)
+        else:
+            logger.info('tracker protocol: %s', protocol)
+            return fail(TrackerError('Invalid tracker protocol: ' + protocol))
+
+    def get_udp(self, url, params, retries):
+        parsed = urlparse(url)
+        if not parsed.hostname or not parsed.port:
+            return fail(TrackerError('Invalid tracker url: ' + url))
+        if self._udp_client is None:
+            self._udp_client = UDPTrackerClient(self._reactor, self._settings)
+        logger.info('Connecting to tracker: %s', url)
+        return self._udp_client.announce((parsed.hostname, parsed.port), params, retries)
 
-    def get_http(self, url,  params):
-        tracker_addr = url + '?' + urlencode(params)
+    def get_http(self, url, params, timeout):
+        tracker_addr = url + ('&' if '?' in url else '?') + urlencode(params)
         logger.info('Connecting to tracker: %s', str(url))
-        d = getPage(tracker_addr.encode())
-        return d.addCallbacks(self._decode, self._page_connect_error)
+        d = getPage(tracker_addr.encode(), timeout=int(timeout))
+        return d.addCallbacks(self._decode, self._page_connect_error, errbackArgs=(url,))
 
 
     def _decode(self, content):
         try:
             response = bencodepy.decode(content)
-            self._decode_peers(response[b'peers'])
         except bencodepy.exceptions.DecodingError:
-            raise TrackerError('Failed to decode tracker response {}'
-                               .format(self._metadata.announce()))
+            raise TrackerError('Failed to decode tracker response')
+        if not isinstance(response, dict):
+            raise TrackerError('Failed to decode tracker response')
+
+        if b'failure reason' in response:
+            raise TrackerError('Tracker refused the announce: ' +
+                               response[b'failure reason'].decode('utf-8', 'replace'))
+        if b'warning message' in response:
+            logger.warning('tracker warning: %s',
+                           response[b'warning message'].decode('utf-8', 'replace'))
+
+        result = {'peers': self._decode_peers(response.get(b'peers', b''))}
+        for key in (b'interval', b'min interval'):
+            if isinstance(response.get(key), int) and response[key] > 0:
+                result[key.decode()] = response[key]
+        if b'tracker id' in response:
+            result['tracker id'] = response[b'tracker id']
+        return result
 
 
     def _decode_peers(self, raw_peers):
+        # the original format, a list of dictionaries
+        if isinstance(raw_peers, list):
+            return [PeerInfo(ip=peer[b'ip'].decode(), port=peer[b'port'])
+                    for peer in raw_peers if b'ip' in peer and b'port' in peer]
+
         def make_peer(peer_data):
             return PeerInfo(ip=socket.inet_ntoa(peer_data[0]),
                             port=peer_data[1])
-        peers = map(make_peer, struct.iter_unpack('!4sH', raw_peers))
-        self._peers = list(peers)
-
-    def _page_connect_error(self, error):
-        raise TrackerError("Failed to connect to the tracker {}"
-                           .format(self._metadata.announce()))
+        raw_peers = raw_peers[:len(raw_peers) - len(raw_peers) % 6]
+        return list(map(make_peer, struct.iter_unpack('!4sH', raw_peers)))
 
-    def get_peers(self):
-        return self._peers
+    def _page_connect_error(self, error, url):
+        raise TrackerError("Failed to connect to the tracker {}: {}"
+                           .format(url, error.getErrorMessage()))
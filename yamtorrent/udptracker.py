@@ -0,0 +1,228 @@
+import os
+import struct
+import socket
+import logging
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.error import CannotListenError
+
+from . import PeerInfo
+from .settings import Settings
+
+logger = logging.getLogger('UDPTracker')
+
+PROTOCOL_ID = 0x41727101980
+
+CONNECT = 0
+ANNOUNCE = 1
+SCRAPE = 2
+ERROR = 3
+
+# event numbers of the UDP tracker protocol
+EVENTS = {b'': 0, b'completed': 1, b'started': 2, b'stopped': 3}
+
+# a connection id may be used for a minute after it's received
+CONNECTION_ID_LIFETIME = 60
+
+
+class UDPTrackerError(Exception):
+    pass
+
+
+# a request waiting for its response
+class _Transaction(object):
+
+    def __init__(self, address, action, packet, retries):
+        self.address = address
+        self.action = action
+        self.packet = packet
+        self.retries = retries
+        self.attempt = 0
+        self.deferred = Deferred()
+        self.call = None  # DelayedCall of the retransmission
+
+
+# a UDP tracker client (BEP 15) on the reactor. one socket serves every
+# tracker and torrent: responses are matched to requests by transaction id.
+# connection ids are kept for a minute per tracker, and requests made while
+# one is being fetched wait for it. a request that isn't answered is sent
+# again after timeout * 2^n seconds, n counting the attempts so far, and
+# fails after retries retransmissions (BEP 15 allows up to 8, which takes
+# over an hour).
+#
+# addresses are (host, port), the host being resolved on every request.
+class UDPTrackerClient(DatagramProtocol):
+
+    def __init__(self, reactor, settings=None):
+        self._reactor = reactor
+        self._settings = settings if settings else Settings()
+        self._port = None
+        self._transactions = {}     # transaction id -> _Transaction
+        self._connections = {}      # (ip, port) -> (connection id, time received)
+        self._connecting = {}       # (ip, port) -> [Deferred] waiting for a connection id
+
+    # open the socket. requests open it if it isn't yet
+    def start(self, port=0, interface=''):
+        if self._port is None:
+            try:
+                self._port = self._reactor.listenUDP(port, self, interface=interface)
+            except CannotListenError as e:
+                logger.error('can\'t open a UDP socket: %s', str(e))
+                raise UDPTrackerError(str(e))
+
+    def stop(self):
+        for transaction in list(self._transactions.values()):
+            self._fail(transaction, UDPTrackerError('Client stopped'))
+        if self._port is not None:
+            d = self._port.stopListening()
+            self._port = None
+            return d
+
+    # announce to the tracker at address. params are those of an HTTP
+    # announce (info_hash, peer_id, port, uploaded, downloaded, left, event,
+    # key, numwant). returns a Deferred that fires with the response as a
+    # dict: peers, interval, complete and incomplete
+    def announce(self, address, params, retries=None):
+        def send(address, connection_id):
+            packet = struct.pack('!QII20s20sQQQIIIiH', connection_id, ANNOUNCE, 0,
+                                 params['info_hash'], params['peer_id'],
+                                 int(params['downloaded']), int(params['left']),
+                                 int(params['uploaded']), EVENTS[params.get('event', b'')],
+                                 0, int(params.get('key', 0)) & 0xffffffff,
+                                 int(params.get('numwant', -1)), int(params['port']))
+            return self._request(address, ANNOUNCE, packet, retries)
+        return self._with_connection(address, send, retries).addCallback(self._decode_announce)
+
+    # scrape the tracker at address for up to about 70 torrents. returns a
+    # Deferred that fires with info_hash -> (seeders, completed, leechers)
+    def scrape(self, address, info_hashes, retries=None):
+        info_hashes = list(info_hashes)
+
+        def send(address, connection_id):
+            packet = struct.pack('!QII', connection_id, SCRAPE, 0) + b''.join(info_hashes)
+            return self._request(address, SCRAPE, packet, retries)
+
+        def decode(data):
+            counts = struct.iter_unpack('!III', data[:len(data) - len(data) % 12])
+            return dict(zip(info_hashes, counts))
+        return self._with_connection(address, send, retries).addCallback(decode)
+
+    def _decode_announce(self, data):
+        if len(data) < 12:
+            raise UDPTrackerError('Short announce response')
+        interval, leechers, seeders = struct.unpack_from('!III', data)
+        raw_peers = data[12:len(data) - (len(data) - 12) % 6]
+        peers = [PeerInfo(ip=socket.inet_ntoa(ip), port=port)
+                 for ip, port in struct.iter_unpack('!4sH', raw_peers)]
+        result = {'peers': peers, 'complete': seeders, 'incomplete': leechers}
+        if interval > 0:
+            result['interval'] = interval
+        return result
+
+    # resolve address, get a connection id for it and call send(address,
+    # connection id) with the resolved address
+    def _with_connection(self, address, send, retries):
+        if self._port is None:
+            try:
+                self.start()
+            except UDPTrackerError:
+                return fail()
+        host, port = address
+        d = self._reactor.resolve(host)
+
+        def resolved(ip):
+            address = (ip, port)
+            d = self._connection_id(address, retries)
+            return d.addCallback(lambda connection_id: send(address, connection_id))
+        return d.addCallback(resolved)
+
+    def _connection_id(self, address, retries):
+        cached = self._connections.get(address)
+        if cached is not None and self._reactor.seconds() - cached[1] < CONNECTION_ID_LIFETIME:
+            return succeed(cached[0])
+        self._connections.pop(address, None)
+
+        d = Deferred()
+        if address in self._connecting:
+            self._connecting[address].append(d)
+            return d
+        self._connecting[address] = [d]
+
+        def connected(data):
+            if len(data) < 8:
+                raise UDPTrackerError('Short connect response')
+            connection_id, = struct.unpack_from('!Q', data)
+            self._connections[address] = (connection_id, self._reactor.seconds())
+            for waiting in self._connecting.pop(address, []):
+                waiting.callback(connection_id)
+
+        def failed(failure):
+            for waiting in self._connecting.pop(address, []):
+                waiting.errback(failure)
+
+        packet = struct.pack('!QII', PROTOCOL_ID, CONNECT, 0)
+        self._request(address, CONNECT, packet, retries).addCallback(connected).addErrback(failed)
+        return d
+
+    # send a packet and wait for the response. the transaction id is
+    # filled in here
+    def _request(self, address, action, packet, retries):
+        if retries is None:
+            retries = self._settings.udp_tracker_retries
+        while True:
+            transaction_id = struct.unpack('!I', os.urandom(4))[0]
+            if transaction_id not in self._transactions:
+                break
+        packet = packet[:12] + struct.pack('!I', transaction_id) + packet[16:]
+        transaction = _Transaction(address, action, packet, retries)
+        self._transactions[transaction_id] = transaction
+        self._send(transaction_id)
+        return transaction.deferred
+
+    def _send(self, transaction_id):
+        transaction = self._transactions.get(transaction_id)
+        if transaction is None:
+            return
+        if transaction.attempt > transaction.retries:
+            del self._transactions[transaction_id]
+            # the tracker may have forgotten us, get a new connection id
+            self._connections.pop(transaction.address, None)
+            transaction.deferred.errback(UDPTrackerError('Tracker {}:{} timed out'
+                                                         .format(*transaction.address)))
+            return
+        timeout = self._settings.udp_tracker_timeout * 2 ** transaction.attempt
+        transaction.attempt += 1
+        transaction.call = self._reactor.callLater(timeout, self._send, transaction_id)
+        try:
+            self.transport.write(transaction.packet, transaction.address)
+        except socket.error as e:
+            logger.info('sending to %s:%d failed: %s', transaction.address[0],
+                        transaction.address[1], str(e))
+
+    def _fail(self, transaction, error):
+        for transaction_id, t in list(self._transactions.items()):
+            if t is transaction:
+                del self._transactions[transaction_id]
+        if transaction.call is not None and transaction.call.active():
+            transaction.call.cancel()
+        transaction.deferred.errback(error)
+
+    def datagramReceived(self, data, address):
+        if len(data) < 8:
+            return
+        action, transaction_id = struct.unpack_from('!II', data)
+        transaction = self._transactions.get(transaction_id)
+        if transaction is None or transaction.address != address:
+            return
+        del self._transactions[transaction_id]
+        if transaction.call is not None and transaction.call.active():
+            transaction.call.cancel()
+
+        if action == ERROR:
+            message = data[8:].decode('utf-8', 'replace')
+            transaction.deferred.errback(UDPTrackerError('Tracker refused the request: ' + message))
+        elif action != transaction.action:
+            transaction.deferred.errback(UDPTrackerError('Unexpected response action {}'
+                                                         .format(action)))
+        else:
+            transaction.deferred.callback(data[8:])